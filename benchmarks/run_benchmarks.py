@@ -0,0 +1,228 @@
+"""
+Times the main operations of the comparator on generated sheets and saves the results as JSON, so regressions can be spotted between commits.
+
+Each benchmark runs in a fresh process, so the peak RSS reported is that benchmark's own (including its setup, e.g. comparing
+the sheets before timing write_issues). The fastest of --repeat runs is reported.
+Benchmarks whose optional dependencies aren't installed are recorded as skipped.
+
+Run like so from the repo's folder:
+python benchmarks/run_benchmarks.py --rows 100000 --columns 20
+python benchmarks/run_benchmarks.py --baseline benchmarks/results/<earlier results>.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from instrumentation_logic import peak_rss_mb
+from sheet_generator import generate_sheet_pair, generate_folder_pair, add_generator_arguments, generator_options_from_arguments
+
+BENCHMARKS = {} # name: function which takes the generated data, does any setup and returns (function to time, rows it processes)
+
+def benchmark(name: str):
+    """ Registers a benchmark. """
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+@benchmark('xlsx_to_csv')
+def bench_xlsx_to_csv(data: dict) -> tuple:
+    from common_logic import xlsx_to_csv
+    def run():
+        _, rows = xlsx_to_csv(data["xlsx_original"])
+        for _ in rows:
+            pass
+    return run, data["rows"]
+
+def _bench_read_csv(reader_backend: str):
+    def setup(data: dict) -> tuple:
+        from common_logic import READER_BACKEND, read_csv
+        def run():
+            _, rows = read_csv(data["csv_original"], READER_BACKEND(reader_backend))
+            with rows:
+                for _ in rows:
+                    pass
+        return run, data["rows"]
+    return setup
+
+for reader_backend in ('stdlib', 'pandas', 'pyarrow'):
+    benchmark(f'read_csv[{reader_backend}]')(_bench_read_csv(reader_backend))
+
+def _bench_find_discrepancies(engine: str):
+    def setup(data: dict) -> tuple:
+        from sheet_comparator_logic import find_discrepancies
+        if engine == 'columnar':
+            from columnar_logic import get_column_backend
+            get_column_backend() # Raises ImportError if neither pyarrow nor NumPy is installed
+        def run():
+            find_discrepancies(data["csv_uploaded"], data["csv_original"], comparison_engine=engine)
+        return run, data["rows"]
+    return setup
+
+for engine in ('hash', 'external_sort', 'columnar'):
+    benchmark(f'find_discrepancies[{engine}]')(_bench_find_discrepancies(engine))
+
+def _bench_write_issues(use_excel: bool):
+    def setup(data: dict) -> tuple:
+        from sheet_comparator_logic import find_discrepancies, write_issues
+        issues = find_discrepancies(data["csv_uploaded"], data["csv_original"])
+        output_dir = tempfile.mkdtemp(dir=data["work_dir"])
+        def run():
+            write_issues(issues, output_dir, use_excel)
+        return run, len(issues.issue_list)
+    return setup
+
+benchmark('write_issues[text]')(_bench_write_issues(False))
+benchmark('write_issues[excel]')(_bench_write_issues(True))
+
+def _bench_compare_csv_folders(mode: str):
+    def setup(data: dict) -> tuple:
+        from sheet_comparator_logic import compare_csv_folders, compare_csv_folders_single_threaded
+        def run():
+            if mode == 'single_threaded':
+                compare_csv_folders_single_threaded(data["uploaded_folder"], data["original_folder"])
+            else:
+                compare_csv_folders(data["uploaded_folder"], data["original_folder"], use_processes=(mode == 'processes'))
+        return run, data["rows"] * data["files"]
+    return setup
+
+benchmark('compare_csv_folders_single_threaded')(_bench_compare_csv_folders('single_threaded'))
+benchmark('compare_csv_folders[threads]')(_bench_compare_csv_folders('threads'))
+benchmark('compare_csv_folders[processes]')(_bench_compare_csv_folders('processes'))
+
+@benchmark('merge_dfs')
+def bench_merge_dfs(data: dict) -> tuple:
+    import pandas as pd
+    from sheet_combiner_logic import merge_dfs
+    df1 = pd.read_csv(data["csv_original"], dtype=object)
+    df2 = pd.read_csv(data["csv_uploaded"], dtype=object)
+    def run():
+        merge_dfs(df1, df2, 'ID', 'ID')
+    return run, data["rows"]
+
+@benchmark('combine_dataframes')
+def bench_combine_dataframes(data: dict) -> tuple:
+    import pandas as pd
+    from sheet_combiner_logic import combine_dataframes
+    df1 = pd.read_csv(data["csv_original"], dtype=object)
+    df2 = pd.read_csv(data["csv_uploaded"], dtype=object)
+    # Same join as merge_dfs, keeping every column
+    column_mapping = {column: column for column in df1.columns}
+    def run():
+        combine_dataframes(df1, [(df2, 'ID', 'ID')], column_mapping)
+    return run, data["rows"]
+
+def run_benchmark(name: str, data: dict, repeat: int) -> dict:
+    """ Runs a single benchmark, meant to be called in a fresh process. """
+    try:
+        run, rows = BENCHMARKS[name](data)
+    except ImportError as e:
+        return {"name": name, "skipped": f'{type(e).__name__}: {e}'}
+    timings = []
+    for _ in range(max(1, repeat)):
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+    seconds = min(timings)
+    return {"name": name,
+            "seconds": round(seconds, 4),
+            "rows": rows,
+            "rows_per_second": round(rows / seconds, 1) if seconds > 0 else None,
+            "peak_rss_mb": round(peak_rss_mb(), 1) if peak_rss_mb() != None else None}
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def generate_data(work_dir: str, generator_options: dict, num_files: int) -> dict:
+    """ Generates every sheet the benchmarks need. """
+    csv_original, csv_uploaded = generate_sheet_pair(work_dir, 'bench', 'csv', **generator_options)
+    xlsx_original, _ = generate_sheet_pair(work_dir, 'bench', 'xlsx', **generator_options)
+    original_folder, uploaded_folder = generate_folder_pair(os.path.join(work_dir, 'folders'), num_files, 'csv', **generator_options)
+    return {"work_dir": work_dir,
+            "rows": generator_options["num_rows"],
+            "files": num_files,
+            "csv_original": csv_original,
+            "csv_uploaded": csv_uploaded,
+            "xlsx_original": xlsx_original,
+            "original_folder": original_folder,
+            "uploaded_folder": uploaded_folder}
+
+def print_results(results: list[dict], baseline: dict = None) -> None:
+    baseline_rows_per_second = {result["name"]: result.get("rows_per_second") for result in (baseline or {}).get("results", [])}
+    print(f'{"benchmark":<40}{"seconds":>10}{"rows/s":>14}{"peak MB":>10}{"vs baseline":>14}')
+    for result in results:
+        if "skipped" in result:
+            print(f'{result["name"]:<40}  skipped, {result["skipped"]}')
+            continue
+        change = ''
+        if baseline_rows_per_second.get(result["name"]) and result["rows_per_second"]:
+            change = f'{(result["rows_per_second"] / baseline_rows_per_second[result["name"]] - 1) * 100:+.1f}%'
+        print(f'{result["name"]:<40}{result["seconds"]:>10.3f}{result["rows_per_second"] or 0:>14,.0f}{result["peak_rss_mb"] or 0:>10.1f}{change:>14}')
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmarks the sheet comparator on generated sheets.')
+    add_generator_arguments(parser)
+    parser.add_argument('--files', type=int, default=4, help='Number of file pairs in the folder comparison benchmarks.')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of each benchmark, the fastest is reported.')
+    parser.add_argument('--only', nargs='*', help='Only run benchmarks whose names contain any of these.')
+    parser.add_argument('--output', help='JSON file to save the results to, defaults to benchmarks/results/.')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against.')
+    args = parser.parse_args()
+
+    generator_options = generator_options_from_arguments(args)
+    names = [name for name in BENCHMARKS if not args.only or any(part in name for part in args.only)]
+
+    work_dir = tempfile.mkdtemp(prefix='sheet_comparator_bench_')
+    try:
+        print(f'Generating sheets in {work_dir}')
+        data = generate_data(work_dir, generator_options, args.files)
+        results = []
+        for name in names:
+            print(f'Running {name}')
+            # A fresh process for each benchmark keeps their peak memory separate
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                results.append(executor.submit(run_benchmark, name, data, args.repeat).result())
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {"commit": git_commit(),
+              "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+              "python": platform.python_version(),
+              "platform": platform.platform(),
+              "cpu_count": os.cpu_count(),
+              "generator_options": generator_options,
+              "files": args.files,
+              "repeat": args.repeat,
+              "results": results}
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if baseline.get("generator_options") != generator_options or baseline.get("files") != args.files:
+            print('WARNING: The baseline was run on differently generated sheets, its rows/s may not be comparable.')
+    print_results(results, baseline)
+
+    output_path = args.output or os.path.join(BENCHMARKS_DIR, 'results', f'benchmark_{time.strftime("%Y_%m_%d_%H_%M_%S", time.gmtime())}_{report["commit"] or "unknown"}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Saved results to {output_path}')
+
+if __name__ == "__main__":
+    main()
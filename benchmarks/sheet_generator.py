@@ -0,0 +1,154 @@
+"""
+Generates pairs of original and uploaded sheets with known differences, for benchmarking and trying out the comparator.
+
+The same arguments and seed always generate the same sheets, so timings can be compared between commits.
+The identifier is always the first column of both sheets.
+
+Run like so: python benchmarks/sheet_generator.py output_folder --rows 100000 --columns 20 --file-format xlsx
+"""
+import os
+import csv
+import random
+import argparse
+
+def _cell_value(rng: random.Random, row_num: int, col_num: int) -> str:
+    # Mix of numbers, decimals and text, similar to an export from an ERP system
+    kind = col_num % 3
+    if kind == 0:
+        return str(rng.randrange(1000000))
+    if kind == 1:
+        return f'{rng.randrange(100000) / 100:.2f}'
+    return f'value {row_num}-{col_num} {rng.choice("ABCDEFGHJKLMNPQRSTUVWXYZ")}'
+
+def generate_sheet_rows(num_rows: int = 10000,
+                        num_columns: int = 10,
+                        discrepancy_rate: float = 0.01,
+                        missing_row_rate: float = 0.01,
+                        extra_row_rate: float = 0.0,
+                        reorder_columns: bool = False,
+                        whitespace_noise_rate: float = 0.0,
+                        seed: int = 0) -> tuple:
+    """
+    Generates the fields and rows of an original sheet and an uploaded sheet which should match it.
+
+    Args:
+        num_columns: Number of columns including the identifier.
+        discrepancy_rate: Share of uploaded rows which have one of their cells changed.
+        missing_row_rate: Share of original rows which are left out of the uploaded sheet.
+        extra_row_rate: Share of original rows, as a count, of rows added to the uploaded sheet which aren't in the original.
+        reorder_columns: Shuffle the order of the uploaded sheet's columns, the identifier stays first.
+        whitespace_noise_rate: Share of uploaded rows which have leading or trailing whitespaces added to one of their cells.
+
+    Returns:
+        (original fields, original rows, uploaded fields, uploaded rows). The uploaded rows are in a shuffled order.
+    """
+    rng = random.Random(seed)
+    num_columns = max(2, num_columns)
+    original_fields = ['ID'] + [f'Column {col_num}' for col_num in range(1, num_columns)]
+    original_rows = [[f'ID{row_num:09d}'] + [_cell_value(rng, row_num, col_num) for col_num in range(1, num_columns)] for row_num in range(num_rows)]
+
+    uploaded_rows = []
+    for row in original_rows:
+        if rng.random() < missing_row_rate:
+            continue
+        uploaded_row = list(row)
+        if rng.random() < discrepancy_rate:
+            col_num = rng.randrange(1, num_columns)
+            uploaded_row[col_num] = uploaded_row[col_num] + 'X'
+        if rng.random() < whitespace_noise_rate:
+            col_num = rng.randrange(1, num_columns)
+            uploaded_row[col_num] = rng.choice([' ', '  ', '\t']) + uploaded_row[col_num] + rng.choice(['', ' '])
+        uploaded_rows.append(uploaded_row)
+    for extra_row_num in range(int(num_rows * extra_row_rate)):
+        uploaded_rows.append([f'EXTRA{extra_row_num:09d}'] + [_cell_value(rng, extra_row_num, col_num) for col_num in range(1, num_columns)])
+    rng.shuffle(uploaded_rows)
+
+    # Column order of the uploaded sheet, as indexes into the original's columns
+    column_order = list(range(num_columns))
+    if reorder_columns:
+        other_columns = column_order[1:]
+        rng.shuffle(other_columns)
+        column_order = [0] + other_columns
+    uploaded_fields = [original_fields[col_num] for col_num in column_order]
+    uploaded_rows = [[row[col_num] for col_num in column_order] for row in uploaded_rows]
+    return original_fields, original_rows, uploaded_fields, uploaded_rows
+
+def write_sheet(file_path: str, fields: list[str], rows: list[list[str]]) -> str:
+    """ Writes a sheet as CSV or Excel depending on the file's extension. """
+    if file_path.endswith('.xlsx'):
+        from openpyxl import Workbook
+        wb = Workbook(write_only=True)
+        sheet = wb.create_sheet()
+        sheet.append(fields)
+        for row in rows:
+            sheet.append(row)
+        wb.save(file_path)
+        return file_path
+    with open(file_path, 'w', newline='') as f:
+        csv_writer = csv.writer(f)
+        csv_writer.writerow(fields)
+        csv_writer.writerows(rows)
+    return file_path
+
+def generate_sheet_pair(output_dir: str, name: str = 'bench', file_format: str = 'csv', **generator_options) -> tuple:
+    """
+    Generates a pair of sheets, see generate_sheet_rows for the options.
+
+    Returns:
+        The paths of the original and uploaded sheets.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    original_fields, original_rows, uploaded_fields, uploaded_rows = generate_sheet_rows(**generator_options)
+    original_file_path = write_sheet(os.path.join(output_dir, f'{name}-original.{file_format}'), original_fields, original_rows)
+    uploaded_file_path = write_sheet(os.path.join(output_dir, f'{name}-uploaded.{file_format}'), uploaded_fields, uploaded_rows)
+    return original_file_path, uploaded_file_path
+
+def generate_folder_pair(output_dir: str, num_files: int = 4, file_format: str = 'csv', seed: int = 0, **generator_options) -> tuple:
+    """
+    Generates an original and an uploaded folder of sheets, paired by the prefix of their names like compare_csv_folders expects.
+
+    Returns:
+        The paths of the original and uploaded folders.
+    """
+    original_folder_path = os.path.join(output_dir, 'original')
+    uploaded_folder_path = os.path.join(output_dir, 'uploaded')
+    os.makedirs(original_folder_path, exist_ok=True)
+    os.makedirs(uploaded_folder_path, exist_ok=True)
+    for file_num in range(num_files):
+        original_fields, original_rows, uploaded_fields, uploaded_rows = generate_sheet_rows(seed=seed + file_num, **generator_options)
+        write_sheet(os.path.join(original_folder_path, f'sheet{file_num}-original.{file_format}'), original_fields, original_rows)
+        write_sheet(os.path.join(uploaded_folder_path, f'sheet{file_num}-uploaded.{file_format}'), uploaded_fields, uploaded_rows)
+    return original_folder_path, uploaded_folder_path
+
+def add_generator_arguments(parser: argparse.ArgumentParser) -> None:
+    """ Adds the options of generate_sheet_rows to a command line parser. """
+    parser.add_argument('--rows', type=int, default=10000, help='Number of rows in the original sheet.')
+    parser.add_argument('--columns', type=int, default=10, help='Number of columns including the identifier.')
+    parser.add_argument('--discrepancy-rate', type=float, default=0.01)
+    parser.add_argument('--missing-row-rate', type=float, default=0.01)
+    parser.add_argument('--extra-row-rate', type=float, default=0.0)
+    parser.add_argument('--reorder-columns', action='store_true')
+    parser.add_argument('--whitespace-noise-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=0)
+
+def generator_options_from_arguments(args: argparse.Namespace) -> dict:
+    return {
+        "num_rows": args.rows,
+        "num_columns": args.columns,
+        "discrepancy_rate": args.discrepancy_rate,
+        "missing_row_rate": args.missing_row_rate,
+        "extra_row_rate": args.extra_row_rate,
+        "reorder_columns": args.reorder_columns,
+        "whitespace_noise_rate": args.whitespace_noise_rate,
+        "seed": args.seed,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generates a pair of sheets with known differences.')
+    parser.add_argument('output_dir')
+    parser.add_argument('--name', default='bench')
+    parser.add_argument('--file-format', choices=['csv', 'xlsx'], default='csv')
+    add_generator_arguments(parser)
+    args = parser.parse_args()
+    for file_path in generate_sheet_pair(args.output_dir, args.name, args.file_format, **generator_options_from_arguments(args)):
+        print(file_path)
@@ -0,0 +1,303 @@
+"""
+On-disk caches which persist between runs.
+
+DiskCache is a folder of pickled entries with a size cap, the least recently used entries are evicted once the cap is exceeded.
+ResultCache stores the ISSUES_MAIN of each compared file pair, keyed by the contents of both files and the comparison options,
+so rerunning a folder comparison only recompares the pairs which changed.
+SnapshotCache stores the parsed rows of Excel sheets, so comparing many uploaded sheets against the same original workbook only parses it once.
+"""
+import os
+import gc
+import sys
+import json
+import mmap
+import time
+import pickle
+import struct
+import marshal
+import hashlib
+import tempfile
+import threading
+from itertools import chain
+from common_logic import SheetRows
+
+# Bump whenever the layout of ISSUES_MAIN changes, so stale results are never loaded
+CACHE_FORMAT_VERSION = 6
+# Start of every snapshot file, bump the number whenever the layout of snapshots changes
+SNAPSHOT_MAGIC = b'SCSNAP01'
+# Rows in each chunk of a snapshot, only one chunk is loaded into memory at a time
+SNAPSHOT_CHUNK_ROWS = 65536
+# Layout of the length of a snapshot's footer, the last bytes of the file
+SNAPSHOT_FOOTER_LENGTH = struct.Struct('<Q')
+
+def default_cache_dir() -> str:
+    """ Platform specific cache folder for the app, falls back to the home folder if appdirs isn't installed. """
+    try:
+        from appdirs import user_cache_dir
+        return user_cache_dir(appname='Sheet Comparator', appauthor='seanntxj')
+    except ImportError:
+        return os.path.join(os.path.expanduser('~'), '.sheet_comparator_cache')
+
+def file_fingerprint(file_path: str, chunk_size: int = 1024*1024) -> str:
+    """ Hash of a file's contents. """
+    digest = hashlib.blake2b(digest_size=20)
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class DiskCache:
+    ENTRY_EXTENSION = 'pickle'
+
+    def __init__(self, cache_dir: str, max_size_mb: int = 512) -> None:
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_mb * 1024 * 1024
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index = self._load_index() # key: {"size": bytes, "last_used": timestamp}
+
+    def _load_index(self) -> dict:
+        try:
+            with open(self.index_path, 'r') as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        # Drop entries whose files have gone missing
+        return {key: entry for key, entry in index.items() if os.path.isfile(self._entry_path(key))}
+
+    def _save_index(self) -> None:
+        # Worker processes may share the cache, keep the entries they added since the index was loaded
+        for key, entry in self._load_index().items():
+            self.index.setdefault(key, entry)
+        self._write_atomically(self.index_path, json.dumps(self.index).encode('utf-8'))
+
+    def __getstate__(self) -> dict:
+        # Locks can't be sent to worker processes, each process gets its own
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def _write_atomically(self, file_path: str, data: bytes) -> None:
+        # Write to a temporary file first so a crash never leaves a half written entry behind
+        with tempfile.NamedTemporaryFile('wb', dir=self.cache_dir, delete=False) as f:
+            f.write(data)
+        os.replace(f.name, file_path)
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f'{key}.{self.ENTRY_EXTENSION}')
+
+    def get(self, key: str):
+        """ Returns the cached object or None if it isn't cached. """
+        with self.lock:
+            if key not in self.index:
+                return None
+            try:
+                with open(self._entry_path(key), 'rb') as f:
+                    value = pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+                self._remove(key)
+                self._save_index()
+                return None
+            self.index[key]["last_used"] = time.time()
+            self._save_index()
+            return value
+
+    def put(self, key: str, value) -> None:
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            # Entries larger than the whole cache are not worth keeping
+            if len(data) > self.max_size_bytes:
+                return
+            self._write_atomically(self._entry_path(key), data)
+            self._add_to_index(key, len(data))
+
+    def _add_to_index(self, key: str, size: int) -> None:
+        """ Adds an entry whose file has been written, evicting older entries if the cache is now over its size cap. """
+        self.index[key] = {"size": size, "last_used": time.time()}
+        self._evict()
+        self._save_index()
+
+    def _remove(self, key: str) -> None:
+        self.index.pop(key, None)
+        try:
+            os.remove(self._entry_path(key))
+        except OSError:
+            pass
+
+    def _evict(self) -> None:
+        """ Removes the least recently used entries until the cache fits within its size cap. """
+        total_size = sum(entry["size"] for entry in self.index.values())
+        for key in sorted(self.index, key=lambda key: self.index[key]["last_used"]):
+            if total_size <= self.max_size_bytes:
+                break
+            total_size -= self.index[key]["size"]
+            self._remove(key)
+
+    def size(self) -> int:
+        """ Total size of the cached entries in bytes. """
+        with self.lock:
+            return sum(entry["size"] for entry in self.index.values())
+
+    def clear(self) -> None:
+        """ Removes every entry from the cache. """
+        with self.lock:
+            for key in list(self.index):
+                self._remove(key)
+            self._save_index()
+
+class ResultCache(DiskCache):
+    """ Caches the ISSUES_MAIN result of comparing a pair of files. """
+    def __init__(self, cache_dir: str = None, max_size_mb: int = 512) -> None:
+        super().__init__(os.path.join(cache_dir or default_cache_dir(), 'results'), max_size_mb)
+
+    def key_for(self, uploaded_file_path: str, original_file_path: str, options: dict) -> str:
+        """
+        Key for a comparison, made from the contents and names of both files and every option which changes the result.
+        The file names are included as they name the ISSUES_MAIN.
+        """
+        key_parts = json.dumps({
+            "version": CACHE_FORMAT_VERSION,
+            "uploaded": [os.path.basename(uploaded_file_path), file_fingerprint(uploaded_file_path)],
+            "original": [os.path.basename(original_file_path), file_fingerprint(original_file_path)],
+            "options": options,
+        }, sort_keys=True, default=str)
+        return hashlib.blake2b(key_parts.encode('utf-8'), digest_size=20).hexdigest()
+
+def _load_snapshot_chunk(snapshot: mmap.mmap, offset: int, length: int) -> list[list[str]]:
+    # Every object created while loading is still in use, collecting garbage part way through would only slow the load down
+    was_gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return marshal.loads(snapshot[offset:offset + length])
+    finally:
+        if was_gc_enabled:
+            gc.enable()
+
+class SnapshotCache(DiskCache):
+    """
+    Caches the parsed rows of sheets which are slow to parse, i.e. Excel sheets, keyed by the path, size, modification time and contents of the file.
+    CSV files are never snapshotted, parsing them is as fast as loading a snapshot.
+
+    A snapshot holds the sheet's rows as chunks of marshalled lists, followed by a footer with the fields and where each chunk starts.
+    It's read through mmap one chunk at a time, so loading a snapshot costs about as much as reading a CSV file of the same sheet.
+    """
+    ENTRY_EXTENSION = 'snapshot'
+
+    def __init__(self, cache_dir: str = None, max_size_mb: int = 2048) -> None:
+        super().__init__(os.path.join(cache_dir or default_cache_dir(), 'snapshots'), max_size_mb)
+
+    def key_for(self, file_path: str, sheet_name: str = None) -> str:
+        """ Key for a sheet of a file, None being its active sheet. Marshalled data can change between Python versions, so the version is part of the key too. """
+        file_stat = os.stat(file_path)
+        key_parts = json.dumps({
+            "format": SNAPSHOT_MAGIC.decode('ascii'),
+            "python": list(sys.version_info[:2]),
+            "path": os.path.abspath(file_path),
+            "sheet": sheet_name,
+            "size": file_stat.st_size,
+            "modified": file_stat.st_mtime_ns,
+            "contents": file_fingerprint(file_path),
+        }, sort_keys=True)
+        return hashlib.blake2b(key_parts.encode('utf-8'), digest_size=20).hexdigest()
+
+    def open_sheet(self, file_path: str, open_sheet_uncached, sheet_name: str = None) -> tuple:
+        """
+        Opens a sheet from its snapshot. If there isn't one yet, the sheet is opened with open_sheet_uncached and 
+        a snapshot is written as its rows are read, it's only added to the cache once every row has been read.
+
+        Args:
+            open_sheet_uncached: Opens the sheet without the cache, returning its fields and a SheetRows like common_logic.xlsx_to_csv.
+            sheet_name: Sheet of the file to open, passed on to open_sheet_uncached.
+
+        Returns:
+            The fields of the sheet and a SheetRows of its rows.
+        """
+        key = self.key_for(file_path, sheet_name)
+        snapshot = self._open_snapshot(key)
+        if snapshot != None:
+            return snapshot
+        fields, rows = open_sheet_uncached(file_path, sheet_name)
+        recorded_rows = self._record_rows(key, fields, rows)
+        def close():
+            # Stops the recording first, so a snapshot of a sheet which wasn't read to the end is thrown away
+            recorded_rows.close()
+            rows.close()
+        return fields, SheetRows(recorded_rows, close)
+
+    def _open_snapshot(self, key: str) -> tuple:
+        """ Returns the fields and a SheetRows of a cached snapshot, or None if it isn't cached. """
+        with self.lock:
+            if key not in self.index:
+                return None
+            self.index[key]["last_used"] = time.time()
+            self._save_index()
+        try:
+            with open(self._entry_path(key), 'rb') as f:
+                snapshot = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                if snapshot[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+                    raise ValueError('Not a snapshot.')
+                footer_length, = SNAPSHOT_FOOTER_LENGTH.unpack(snapshot[-SNAPSHOT_FOOTER_LENGTH.size:])
+                footer_start = len(snapshot) - SNAPSHOT_FOOTER_LENGTH.size - footer_length
+                fields, chunks = marshal.loads(snapshot[footer_start:footer_start + footer_length])
+            except BaseException:
+                snapshot.close()
+                raise
+        except (OSError, ValueError, EOFError, TypeError, struct.error):
+            with self.lock:
+                self._remove(key)
+                self._save_index()
+            return None
+        rows = chain.from_iterable(_load_snapshot_chunk(snapshot, offset, length) for offset, length in chunks)
+        return fields, SheetRows(rows, snapshot.close)
+
+    def _record_rows(self, key: str, fields: list[str], rows):
+        """ Yields every row while writing them to a snapshot, which is only cached once the last row has been yielded. """
+        f = tempfile.NamedTemporaryFile('wb', dir=self.cache_dir, suffix='.tmp', delete=False)
+        is_recording = True
+        is_cached = False
+        try:
+            f.write(SNAPSHOT_MAGIC)
+            chunks = [] # (offset, length) of each chunk
+            chunk = []
+            for row in rows:
+                yield row
+                if not is_recording:
+                    continue
+                chunk.append(row)
+                if len(chunk) >= SNAPSHOT_CHUNK_ROWS:
+                    data = marshal.dumps(chunk)
+                    chunks.append((f.tell(), len(data)))
+                    f.write(data)
+                    chunk = []
+                    # Snapshots larger than the whole cache are not worth keeping
+                    is_recording = f.tell() <= self.max_size_bytes
+            if not is_recording:
+                return
+            if len(chunk):
+                data = marshal.dumps(chunk)
+                chunks.append((f.tell(), len(data)))
+                f.write(data)
+            footer = marshal.dumps((fields, chunks))
+            f.write(footer)
+            f.write(SNAPSHOT_FOOTER_LENGTH.pack(len(footer)))
+            f.close()
+            size = os.path.getsize(f.name)
+            if size > self.max_size_bytes:
+                return
+            with self.lock:
+                os.replace(f.name, self._entry_path(key))
+                is_cached = True
+                self._add_to_index(key, size)
+        finally:
+            f.close()
+            if not is_cached:
+                try:
+                    os.remove(f.name)
+                except OSError:
+                    pass
@@ -0,0 +1,386 @@
+"""
+Columnar comparison engine.
+
+Both sheets are loaded column by column, and the rows are aligned on their identifier with a join.
+Each column is then compared in a single vectorised operation rather than cell by cell, which pays off on wide sheets.
+Apache Arrow is used when pyarrow is installed, CSV files are then parsed straight into columns without creating a Python string per cell.
+Otherwise NumPy object arrays are used. Issues are reported exactly as find_discrepancies would report them.
+"""
+from itertools import zip_longest
+from common_logic import READER_BACKEND, sniff_csv
+from instrumentation_logic import PHASE, Instrumentation, start_phase, finish_phase
+from sheet_comparator_logic import ISSUES_MAIN, ISSUE_TYPE, NATURE_OF_ISSUES, RESULT_MODE, open_sheet, issues_name, check_fields, resolve_identifying_field_indexes, compile_compared_columns, log_unmatched_uploaded_rows
+
+def _transpose(rows, width: int) -> list:
+    """ Turns rows into a list of columns, short rows are padded with blanks. """
+    columns = list(zip_longest(*rows, fillvalue=u""))[:width]
+    return columns + [() for _ in range(width - len(columns))]
+
+class ArrowColumns:
+    """ Column operations backed by pyarrow. """
+    def __init__(self) -> None:
+        import pyarrow
+        import pyarrow.compute
+        import pyarrow.csv
+        self.pa = pyarrow
+        self.pc = pyarrow.compute
+        self.pa_csv = pyarrow.csv
+
+    def _load_rows(self, file_path: str, reader_backend: READER_BACKEND = READER_BACKEND.AUTO, snapshot_cache = None, sheet_name: str = None) -> tuple:
+        """ Reads the sheet row by row like the other engines, then turns it into columns. """
+        fields, rows = open_sheet(file_path, reader_backend, snapshot_cache, sheet_name)
+        with rows:
+            rows = list(rows)
+        width = max([len(fields), *map(len, rows)])
+        return fields, [self.pa.array(column, type=self.pa.string()) for column in _transpose(rows, width)]
+
+    def load(self, file_path: str, reader_backend: READER_BACKEND = READER_BACKEND.AUTO, snapshot_cache = None, sheet_name: str = None) -> tuple:
+        """
+        Returns the fields of a sheet and a list of its columns. CSV files are parsed by Arrow whatever the reader_backend,
+        unless their rows have different numbers of cells which Arrow can't parse, they're then read by the csv module like the hash engine would.
+        """
+        if file_path.split('.')[-1] != 'csv':
+            return self._load_rows(file_path, snapshot_cache=snapshot_cache, sheet_name=sheet_name)
+        # Only the header is read with the csv module, the rest is parsed by Arrow as plain strings
+        encoding, delimiter, is_rectangular = sniff_csv(file_path)
+        if not is_rectangular:
+            return self._load_rows(file_path, READER_BACKEND.STDLIB)
+        fields, rows = open_sheet(file_path, READER_BACKEND.STDLIB)
+        rows.close()
+        column_names = [f'column_{i}' for i in range(len(fields))]
+        try:
+            table = self.pa_csv.read_csv(file_path,
+                                         # Arrow skips a UTF-8 byte order mark itself, other encodings are transcoded to UTF-8 first
+                                         read_options=self.pa_csv.ReadOptions(column_names=column_names, skip_rows_after_names=1, encoding='utf8' if encoding == 'utf-8-sig' else encoding),
+                                         parse_options=self.pa_csv.ParseOptions(delimiter=delimiter, newlines_in_values=True),
+                                         convert_options=self.pa_csv.ConvertOptions(column_types={name: self.pa.string() for name in column_names},
+                                                                                    strings_can_be_null=False,
+                                                                                    quoted_strings_can_be_null=False,
+                                                                                    null_values=[]))
+        except self.pa.ArrowInvalid:
+            # A row past the sniffed sample has a different number of cells, e.g. a trailing delimiter
+            return self._load_rows(file_path, READER_BACKEND.STDLIB)
+        return fields, [column.combine_chunks() for column in table.columns]
+
+    def align(self, original_identifiers, uploaded_identifiers) -> object:
+        """
+        For each original row, returns the index of the uploaded row with the same identifier or null if there isn't one.
+        If an identifier is repeated in the uploaded sheet the last row wins, same as caching it into a dictionary.
+        """
+        positions_in_reversed = self.pc.index_in(original_identifiers, value_set=uploaded_identifiers[::-1])
+        return self.pc.subtract(len(uploaded_identifiers) - 1, positions_in_reversed)
+
+    def find_first(self, identifiers, searched_identifiers) -> list:
+        """ For each identifier, returns the index of the first row in searched_identifiers with the same identifier or None if there isn't one. """
+        return self.pc.index_in(identifiers, value_set=searched_identifiers).to_pylist()
+
+    def unmatched_uploaded(self, original_identifiers, uploaded_identifiers) -> tuple:
+        """
+        Returns the indexes of the uploaded rows whose identifier isn't in the original sheet, 
+        and the indexes of the uploaded rows which were replaced by a later row with the same identifier.
+        """
+        row_indexes = self.pa.array(range(len(uploaded_identifiers)), type=self.pa.int64())
+        last_of_identifier = self.pc.equal(self.align(uploaded_identifiers, uploaded_identifiers), row_indexes)
+        in_original = self.pc.is_in(uploaded_identifiers, value_set=original_identifiers)
+        extra_rows = self.pc.and_(last_of_identifier, self.pc.invert(in_original))
+        return self.indices(extra_rows), self.indices(self.pc.invert(last_of_identifier))
+
+    def matched(self, positions) -> tuple:
+        """ Returns the uploaded row index of every matched original row, and the index of those original rows. """
+        return self.pc.drop_null(positions), self.pc.indices_nonzero(self.pc.is_valid(positions))
+
+    def missing_mask(self, positions) -> list[bool]:
+        return self.pc.is_null(positions).to_pylist()
+
+    def take(self, column, indexes):
+        # Lists are typed explicitly, an empty list of indexes would otherwise be a null array which can't be taken with
+        if isinstance(indexes, list):
+            indexes = self.pa.array(indexes, type=self.pa.int64())
+        return column.take(indexes)
+
+    def strip(self, column):
+        return self.pc.utf8_trim_whitespace(column)
+
+    def not_equal(self, column_a, column_b):
+        return self.pc.not_equal(column_a, column_b)
+
+    def any_mismatch(self, mismatches: list) -> list[int]:
+        """ Returns the indexes which mismatch in any of the columns. """
+        any_mismatch = mismatches[0]
+        for mismatch in mismatches[1:]:
+            any_mismatch = self.pc.or_(any_mismatch, mismatch)
+        return self.pc.indices_nonzero(any_mismatch).to_pylist()
+
+    def indices(self, mask) -> list[int]:
+        return self.pc.indices_nonzero(mask).to_pylist()
+
+    def clear(self, mask, indexes: list[int]):
+        """ Returns a copy of the mask with the given indexes set to False. """
+        cleared_mask = mask.to_numpy(zero_copy_only=False).copy()
+        cleared_mask[indexes] = False
+        return self.pa.array(cleared_mask)
+
+    def to_list(self, array) -> list:
+        return array.to_pylist()
+
+    def rows(self, columns: list, indexes: list[int]) -> list[list[str]]:
+        """ Materialises the given rows as lists of strings. """
+        indexes = self.pa.array(indexes, type=self.pa.int64())
+        return [list(row) for row in zip(*[self.to_list(column.take(indexes)) for column in columns])]
+
+class NumpyColumns:
+    """ Column operations backed by NumPy object arrays, used when pyarrow is not installed. """
+    def __init__(self) -> None:
+        import numpy
+        self.np = numpy
+
+    def _to_array(self, values) -> object:
+        # Object arrays share the row's strings rather than copying them
+        column = self.np.empty(len(values), dtype=object)
+        column[:] = values
+        return column
+
+    def load(self, file_path: str, reader_backend: READER_BACKEND = READER_BACKEND.AUTO, snapshot_cache = None, sheet_name: str = None) -> tuple:
+        fields, rows = open_sheet(file_path, reader_backend, snapshot_cache, sheet_name)
+        with rows:
+            rows = list(rows)
+        width = max([len(fields), *map(len, rows)])
+        return fields, [self._to_array(column) for column in _transpose(rows, width)]
+
+    def align(self, original_identifiers, uploaded_identifiers) -> object:
+        np = self.np
+        positions = np.full(len(original_identifiers), -1, dtype=np.int64)
+        if len(uploaded_identifiers) == 0 or len(original_identifiers) == 0:
+            return positions
+        # Unique on the reversed identifiers finds the last occurrence of each identifier
+        unique_identifiers, first_in_reversed = np.unique(uploaded_identifiers[::-1], return_index=True)
+        last_positions = len(uploaded_identifiers) - 1 - first_in_reversed
+        # Binary search each original identifier among the sorted unique identifiers
+        candidates = np.searchsorted(unique_identifiers, original_identifiers)
+        in_bounds = candidates < len(unique_identifiers)
+        found = np.zeros(len(original_identifiers), dtype=bool)
+        found[in_bounds] = unique_identifiers[candidates[in_bounds]] == original_identifiers[in_bounds]
+        positions[found] = last_positions[candidates[found]]
+        return positions
+
+    def find_first(self, identifiers, searched_identifiers) -> list:
+        np = self.np
+        if len(searched_identifiers) == 0:
+            return [None] * len(identifiers)
+        # Unique keeps the first occurrence of each identifier
+        unique_identifiers, first_positions = np.unique(searched_identifiers, return_index=True)
+        candidates = np.minimum(np.searchsorted(unique_identifiers, identifiers), len(unique_identifiers) - 1)
+        return [int(first_positions[candidate]) if unique_identifiers[candidate] == identifier else None 
+                for candidate, identifier in zip(candidates.tolist(), identifiers.tolist())]
+
+    def unmatched_uploaded(self, original_identifiers, uploaded_identifiers) -> tuple:
+        np = self.np
+        last_of_identifier = self.align(uploaded_identifiers, uploaded_identifiers) == np.arange(len(uploaded_identifiers))
+        in_original = np.isin(uploaded_identifiers, original_identifiers)
+        return self.indices(last_of_identifier & ~in_original), self.indices(~last_of_identifier)
+
+    def matched(self, positions) -> tuple:
+        matched_rows = self.np.flatnonzero(positions >= 0)
+        return positions[matched_rows], matched_rows
+
+    def missing_mask(self, positions) -> list[bool]:
+        return (positions < 0).tolist()
+
+    def take(self, column, indexes):
+        return column[indexes]
+
+    def strip(self, column):
+        return self.np.frompyfunc(str.strip, 1, 1)(column)
+
+    def not_equal(self, column_a, column_b):
+        return self.np.asarray(column_a != column_b, dtype=bool)
+
+    def any_mismatch(self, mismatches: list) -> list[int]:
+        return self.np.flatnonzero(self.np.logical_or.reduce(mismatches)).tolist()
+
+    def indices(self, mask) -> list[int]:
+        return self.np.flatnonzero(mask).tolist()
+
+    def clear(self, mask, indexes: list[int]):
+        cleared_mask = mask.copy()
+        cleared_mask[indexes] = False
+        return cleared_mask
+
+    def to_list(self, array) -> list:
+        return array.tolist()
+
+    def rows(self, columns: list, indexes: list[int]) -> list[list[str]]:
+        return [list(row) for row in zip(*[self.to_list(column[indexes]) for column in columns])]
+
+def get_column_backend():
+    """ Returns the fastest column backend available, Arrow if pyarrow is installed otherwise NumPy. """
+    try:
+        return ArrowColumns()
+    except ImportError:
+        pass
+    try:
+        return NumpyColumns()
+    except ImportError:
+        raise ImportError('The columnar engine requires pyarrow or NumPy, install one with "pip install pyarrow".')
+
+def find_discrepancies_columnar(uploaded_file_path: str,
+                                original_file_path: str,
+                                progress_to_show_in_gui = None,
+                                status_to_show_in_gui = None,
+                                uploaded_file_identifying_field_index: int = 0,
+                                original_file_identifying_field_index: int = 0,
+                                ignore_leading_and_trailing_whitespaces: bool = False,
+                                column_backend = None,
+                                normalisation_rules: dict = None,
+                                full_outer_diff: bool = True,
+                                result_mode: RESULT_MODE = RESULT_MODE.FULL,
+                                max_issues: int = None,
+                                issue_sink = None,
+                                reader_backend: READER_BACKEND = READER_BACKEND.AUTO,
+                                snapshot_cache = None,
+                                uploaded_sheet_name: str = None,
+                                original_sheet_name: str = None,
+                                instrumentation: Instrumentation = None) -> ISSUES_MAIN:
+    """
+    Finds the difference between two sheets by comparing whole columns at a time, see find_discrepancies.
+    Both sheets are held in memory, use the external sort engine for sheets larger than memory.
+
+    Args:
+        column_backend: ArrowColumns or NumpyColumns, defaults to the fastest one installed.
+        reader_backend: Parser for CSV files when using NumpyColumns, ArrowColumns always parses them with Arrow.
+    """
+    backend = column_backend or get_column_backend()
+
+    # Initialise issues custom class to hold all the found issues (if any)
+    issues = ISSUES_MAIN()
+    issues.name = issues_name(original_file_path, original_sheet_name)
+    issues.original_identifying_field_index = original_file_identifying_field_index
+    issues.set_result_mode(result_mode, max_issues)
+    issues.issue_sink = issue_sink
+
+    # Update status
+    if status_to_show_in_gui:
+        status_to_show_in_gui(f'Loading sheets {issues.name}')
+    if progress_to_show_in_gui != None:
+        progress_to_show_in_gui(0)
+
+    # Both sheets are parsed whole while loading
+    phase = start_phase(instrumentation, PHASE.OPEN, issues.name)
+    issues.uploaded_fields, uploaded_columns = backend.load(uploaded_file_path, reader_backend, sheet_name=uploaded_sheet_name)
+    issues.original_fields, ori_columns = backend.load(original_file_path, reader_backend, snapshot_cache, original_sheet_name)
+    fields_match = check_fields(issues)
+    rows_loaded = sum(len(columns[0]) for columns in (uploaded_columns, ori_columns) if len(columns))
+    finish_phase(instrumentation, phase, rows=rows_loaded, issues=len(issues.issue_list))
+    if not fields_match:
+        return issues
+    uploaded_file_identifying_field_index, original_file_identifying_field_index = resolve_identifying_field_indexes(issues, uploaded_file_identifying_field_index, original_file_identifying_field_index)
+
+    phase = start_phase(instrumentation, PHASE.MAP_FIELDS, issues.name)
+    compared_columns = compile_compared_columns(issues, normalisation_rules, ignore_leading_and_trailing_whitespaces)
+    finish_phase(instrumentation, phase)
+
+    # Update status
+    if progress_to_show_in_gui != None:
+        progress_to_show_in_gui(25)
+
+    # Join the rows of both sheets on their identifiers, this takes the place of caching the uploaded sheet into a dictionary
+    phase = start_phase(instrumentation, PHASE.HASH_UPLOADED, issues.name)
+    positions = backend.align(ori_columns[original_file_identifying_field_index], uploaded_columns[uploaded_file_identifying_field_index])
+    matched_positions, matched_rows = backend.matched(positions)
+    finish_phase(instrumentation, phase, rows=len(uploaded_columns[uploaded_file_identifying_field_index]))
+
+    # Update status
+    if status_to_show_in_gui:
+        status_to_show_in_gui(f'Comparing sheet {issues.name}')
+    if progress_to_show_in_gui != None:
+        progress_to_show_in_gui(50)
+
+    # Compare each column of the matched rows in bulk
+    phase = start_phase(instrumentation, PHASE.COMPARE, issues.name)
+    mismatches = []
+    previous_update = 50
+    for col_num, upl_col_num, cells_match in compared_columns:
+        ori_column = backend.take(ori_columns[col_num], matched_rows)
+        uploaded_column = backend.take(uploaded_columns[upl_col_num], matched_positions)
+        if ignore_leading_and_trailing_whitespaces:
+            ori_column = backend.strip(ori_column)
+            uploaded_column = backend.strip(uploaded_column)
+        mismatch = backend.not_equal(ori_column, uploaded_column)
+        # Identical cells always match, so the column's rules only run on the cells which differ
+        if cells_match != None:
+            candidate_indexes = backend.indices(mismatch)
+            if len(candidate_indexes):
+                candidate_pairs = zip(candidate_indexes, 
+                                      backend.to_list(backend.take(ori_column, candidate_indexes)), 
+                                      backend.to_list(backend.take(uploaded_column, candidate_indexes)))
+                mismatch = backend.clear(mismatch, [index for index, cell_a, cell_b in candidate_pairs if cells_match(cell_a, cell_b)])
+        mismatches.append(mismatch)
+
+        # GUI progress bars
+        progress_in_percentage = int((col_num+1) / len(compared_columns) * 40) + 50
+        if progress_to_show_in_gui != None and previous_update != progress_in_percentage:
+            progress_to_show_in_gui(progress_in_percentage)
+            previous_update = progress_in_percentage
+
+    # Work out which rows have issues, only those rows are turned back into Python lists
+    missing_mask = backend.missing_mask(positions)
+    matched_rows = backend.to_list(matched_rows)
+    matched_indexes_with_mismatches = backend.any_mismatch(mismatches) if len(mismatches) else []
+    mismatch_columns = [backend.to_list(backend.take(mismatch, matched_indexes_with_mismatches)) for mismatch in mismatches]
+    mismatched_columns_by_row = {}
+    for matched_index, mismatch_row in zip(matched_indexes_with_mismatches, zip(*mismatch_columns)):
+        mismatched_columns_by_row[matched_rows[matched_index]] = [col_num for col_num, is_mismatched in enumerate(mismatch_row) if is_mismatched]
+    rows_with_issues = sorted([row_num for row_num, is_missing in enumerate(missing_mask) if is_missing] + list(mismatched_columns_by_row))
+    # Only the rows of the first issues are needed when the comparison stops early
+    if issues.max_issues != None:
+        rows_with_issues = rows_with_issues[:issues.max_issues - issues.issue_count]
+
+    if issues.keep_rows:
+        positions = backend.to_list(positions)
+        ori_rows = backend.rows(ori_columns, rows_with_issues)
+        uploaded_rows = iter(backend.rows(uploaded_columns, [positions[row_num] for row_num in rows_with_issues if not missing_mask[row_num]]))
+
+        # Log the issues in the order of the original sheet
+        for row_num, row_from_ori_csv in zip(rows_with_issues, ori_rows):
+            if missing_mask[row_num]:
+                issues.insert_issue_missing_uploaded_row(row_from_ori_csv, row_from_ori_csv[original_file_identifying_field_index], original_file_identifying_field_index, row_num)
+            else:
+                issues.insert_issue(row_from_ori_csv, next(uploaded_rows), mismatched_columns_by_row[row_num], row_num)
+    else:
+        # Only counted, so no rows are turned back into lists
+        for row_num in rows_with_issues:
+            if missing_mask[row_num]:
+                issues.count_issue(ISSUE_TYPE.MISSING_ROW)
+            else:
+                issues.count_issue(ISSUE_TYPE.MISMATCH, mismatched_columns_by_row[row_num])
+
+    # Uploaded rows which were never compared, logged after the rows of the original sheet
+    if full_outer_diff and not issues.limit_reached:
+        ori_identifiers = ori_columns[original_file_identifying_field_index]
+        uploaded_identifiers = uploaded_columns[uploaded_file_identifying_field_index]
+        extra_indexes, duplicate_indexes = backend.unmatched_uploaded(ori_identifiers, uploaded_identifiers)
+        unmatched_indexes = extra_indexes + duplicate_indexes
+        original_rows_by_duplicate_identifier = {}
+        unmatched_rows = [None] * len(unmatched_indexes)
+        if issues.keep_rows and len(duplicate_indexes):
+            duplicate_identifiers = backend.take(uploaded_identifiers, duplicate_indexes)
+            first_original_rows = {identifier: position for identifier, position in zip(backend.to_list(duplicate_identifiers), backend.find_first(duplicate_identifiers, ori_identifiers)) if position != None}
+            original_rows_by_duplicate_identifier = dict(zip(first_original_rows, backend.rows(ori_columns, list(first_original_rows.values())))) if len(first_original_rows) else {}
+        if issues.keep_rows and len(unmatched_indexes):
+            unmatched_rows = backend.rows(uploaded_columns, unmatched_indexes)
+        unmatched_rows = list(zip(unmatched_indexes, unmatched_rows))
+        log_unmatched_uploaded_rows(issues, 
+                                    unmatched_rows[:len(extra_indexes)], 
+                                    unmatched_rows[len(extra_indexes):], 
+                                    original_rows_by_duplicate_identifier, 
+                                    uploaded_file_identifying_field_index, 
+                                    original_file_identifying_field_index)
+
+    # Mark issues found
+    if issues.issue_count: issues.nature_of_issues.append(NATURE_OF_ISSUES.DISCREPANCY)
+    finish_phase(instrumentation, phase, rows=len(ori_columns[original_file_identifying_field_index]), issues=issues.issue_count)
+
+    if status_to_show_in_gui:
+        status_to_show_in_gui(f'Finished comparing {issues.name}')
+
+    return issues
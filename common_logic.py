@@ -1,14 +1,327 @@
-from openpyxl import load_workbook
-
-def xlsx_to_csv(excel_file_path: str) -> tuple:
-    wb = load_workbook(excel_file_path)
-    sh = wb.active.values
-    fields = [] # headers of the sheet
-    rest = [] # the data/content of the sheet
-    for i, row in enumerate(sh): 
-        if i == 0: # if its the first row, it is the fields
-            fields = [str(cell) for cell in row if cell != None]
-        else: # rest is normal data rows
-            rest.append([(u"" if cell == None else str(cell)) for cell in row]) # Ensure empty cells are blanks rather than "None" objects, also convert to string to prevent typing discrepancies
-    wb.close()
-    return fields, rest 
+"""
+Readers which open a sheet as its fields and a stream of its remaining rows as lists of strings.
+
+CSV files are sniffed once before being read, the encoding from their byte order mark (or whether the whole file decodes as UTF-8) and
+the delimiter from the first few rows. They are then read with one of the READER_BACKENDs, every backend gives the same rows.
+A CSV file can also be memory-mapped with map_csv, so its rows can be read again by row number without being kept in memory.
+"""
+import os
+import re
+import csv
+import mmap
+import codecs
+from enum import Enum
+from array import array
+from operator import methodcaller
+
+class READER_BACKEND(Enum):
+    AUTO = "auto" # The fastest backend installed for the sheet, see fastest_reader_backend
+    STDLIB = "stdlib" # Python's csv module, always available and the only backend which keeps rows with a different number of cells as they are
+    PANDAS = "pandas" # pandas' C parser, read in chunks
+    PYARROW = "pyarrow" # Arrow's multithreaded parser, read in blocks
+
+# Bytes read from the start of a CSV file to sniff its encoding and delimiter
+SNIFF_SAMPLE_BYTES = 64 * 1024
+# Bytes decoded at once when checking the rest of a CSV file is in the sniffed encoding
+ENCODING_CHECK_CHUNK_BYTES = 1024 * 1024
+# Rows parsed from the start of a CSV file to sniff its delimiter
+SNIFF_SAMPLE_ROWS = 20
+# Delimiters which can be sniffed, see _sniff_delimiter
+CSV_DELIMITERS = (',', ';', '\t', '|')
+# Byte order marks, UTF-32 first as its little endian mark starts with the UTF-16 one
+BOM_ENCODINGS = ((codecs.BOM_UTF32_LE, 'utf-32'),
+                 (codecs.BOM_UTF32_BE, 'utf-32'),
+                 (codecs.BOM_UTF8, 'utf-8-sig'),
+                 (codecs.BOM_UTF16_LE, 'utf-16'),
+                 (codecs.BOM_UTF16_BE, 'utf-16'))
+# Encodings tried in order for files without a byte order mark, latin-1 decodes anything
+FALLBACK_ENCODINGS = ('utf-8', 'cp1252', 'latin-1')
+# Rows read at once by the pandas backend
+PANDAS_CHUNK_ROWS = 65536
+# Encodings in which every line ends with a single b'\n' byte, so a mapped file can be split into lines without decoding it
+MAPPABLE_ENCODINGS = ('utf-8', 'utf-8-sig', 'cp1252', 'latin-1')
+# Line breaks the csv module splits on but mmap's readline doesn't
+LONE_CARRIAGE_RETURN = re.compile(rb'\r(?!\n)')
+# Widest sheet AUTO reads with Arrow, its rows are built column by column so the cells of a row end up far apart in memory,
+# which makes comparing rows of wide sheets slower than parsing them on every core saves
+PYARROW_AUTO_MAX_COLUMNS = 16
+
+class SheetRows:
+    """
+    The rows of a sheet after its header. Iterating goes straight to the underlying reader so nothing is added to each row.
+    Close it, or use it as a context manager, to close the file whether or not every row was read.
+    """
+    def __init__(self, rows, close = None) -> None:
+        self._rows = iter(rows)
+        self._close = close
+
+    def __iter__(self):
+        return self._rows
+
+    def __next__(self) -> list[str]:
+        return next(self._rows)
+
+    def close(self) -> None:
+        if self._close != None:
+            self._close()
+            self._close = None
+
+    def __enter__(self) -> 'SheetRows':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+def _decodes_as(f, sample: bytes, encoding: str, is_whole_file: bool) -> bool:
+    """ Whether the whole file decodes in the encoding, the rest of the file after the sample is read from f in chunks. """
+    decoder = codecs.getincrementaldecoder(encoding)()
+    try:
+        # The sample may end partway through a character unless it's the whole file
+        decoder.decode(sample, final=is_whole_file)
+        if is_whole_file:
+            return True
+        # A byte which isn't valid in the encoding can be anywhere in the file, not just in the sample
+        f.seek(len(sample))
+        for chunk in iter(lambda: f.read(ENCODING_CHECK_CHUNK_BYTES), b''):
+            decoder.decode(chunk)
+        decoder.decode(b'', final=True)
+        return True
+    except UnicodeDecodeError:
+        return False
+
+def _sniff_delimiter(sample_text: str, is_whole_file: bool) -> tuple:
+    """
+    Returns the delimiter, and whether every sampled row has as many cells as the header.
+    The first SNIFF_SAMPLE_ROWS rows are parsed with each of CSV_DELIMITERS. Delimiters giving every one of those rows the same number
+    of cells (more than one) are preferred, so a header name containing another delimiter doesn't win, then the one splitting the header
+    into the most cells, then the earliest of CSV_DELIMITERS.
+    """
+    lines = sample_text.splitlines(keepends=True)
+    # The last line of a sample may be cut short
+    if not is_whole_file and len(lines) > 1:
+        lines = lines[:-1]
+
+    def row_widths(delimiter: str) -> list[int]:
+        widths = [len(row) for row in csv.reader(lines, delimiter=delimiter) if len(row)]
+        # A quoted value running past the end of the sample can leave the last row short
+        if not is_whole_file:
+            widths = widths[:-1] or widths
+        return widths or [0]
+
+    def score(delimiter: str) -> tuple:
+        widths = row_widths(delimiter)[:SNIFF_SAMPLE_ROWS]
+        return (widths[0] > 1 and all(width == widths[0] for width in widths), widths[0])
+
+    # max keeps the first of CSV_DELIMITERS on a tie
+    delimiter = max(CSV_DELIMITERS, key=score)
+    widths = row_widths(delimiter)
+    return delimiter, all(width == widths[0] for width in widths)
+
+def sniff_csv(file_path: str) -> tuple:
+    """
+    Sniffs the start of a CSV file. Files without a byte order mark are checked all the way through, so they're only read as UTF-8
+    if every byte decodes, else as cp1252 (or latin-1, which decodes anything).
+
+    Returns:
+        The encoding, the delimiter, and whether the sampled rows all have as many cells as the header.
+    """
+    with open(file_path, 'rb') as f:
+        sample = f.read(SNIFF_SAMPLE_BYTES)
+        is_whole_file = len(sample) < SNIFF_SAMPLE_BYTES or f.read(1) == b''
+        encoding = next((encoding for bom, encoding in BOM_ENCODINGS if sample.startswith(bom)), None)
+        if encoding == None:
+            encoding = next(encoding for encoding in FALLBACK_ENCODINGS if _decodes_as(f, sample, encoding, is_whole_file))
+    sample_text = codecs.getincrementaldecoder(encoding)(errors='replace').decode(sample, final=is_whole_file)
+    delimiter, is_rectangular = _sniff_delimiter(sample_text, is_whole_file)
+    return encoding, delimiter, is_rectangular
+
+def _import_backend(reader_backend: READER_BACKEND) -> None:
+    try:
+        if reader_backend == READER_BACKEND.PANDAS:
+            import pandas
+        elif reader_backend == READER_BACKEND.PYARROW:
+            import pyarrow.csv
+    except ImportError:
+        raise ImportError(f'The {reader_backend.value} reader needs {reader_backend.value}, install it with "pip install {reader_backend.value}".')
+
+def fastest_reader_backend(num_columns: int) -> READER_BACKEND:
+    """
+    Arrow when it's installed, the host has more than one core and the sheet has at most PYARROW_AUTO_MAX_COLUMNS columns, otherwise Python's csv module.
+    Both spend most of their time creating a string for each cell, Arrow only comes out ahead when it can parse on several cores.
+    pandas is only used when asked for, turning its chunks back into rows of strings makes it slower than the csv module.
+    """
+    if num_columns > PYARROW_AUTO_MAX_COLUMNS or (os.cpu_count() or 1) < 2:
+        return READER_BACKEND.STDLIB
+    try:
+        _import_backend(READER_BACKEND.PYARROW)
+        return READER_BACKEND.PYARROW
+    except ImportError:
+        return READER_BACKEND.STDLIB
+
+def _pyarrow_rows(file_path: str, fields: list[str], encoding: str, delimiter: str):
+    import pyarrow
+    import pyarrow.csv
+    column_names = [f'column_{i}' for i in range(len(fields))]
+    reader = None
+    try:
+        # Arrow skips a UTF-8 byte order mark itself, other encodings are transcoded to UTF-8 first
+        reader = pyarrow.csv.open_csv(file_path,
+                                      read_options=pyarrow.csv.ReadOptions(column_names=column_names, skip_rows_after_names=1, encoding='utf8' if encoding == 'utf-8-sig' else encoding),
+                                      parse_options=pyarrow.csv.ParseOptions(delimiter=delimiter, newlines_in_values=True),
+                                      convert_options=pyarrow.csv.ConvertOptions(column_types={name: pyarrow.string() for name in column_names},
+                                                                                 strings_can_be_null=False,
+                                                                                 quoted_strings_can_be_null=False,
+                                                                                 null_values=[]))
+        for batch in reader:
+            yield from map(list, zip(*[column.to_pylist() for column in batch.columns]))
+    except pyarrow.ArrowInvalid as e:
+        raise ValueError(f'STOP: {file_path} could not be read by the pyarrow reader, rows may have a different number of cells. Try the stdlib reader. {e}') from e
+    finally:
+        if reader != None and hasattr(reader, 'close'):
+            reader.close()
+
+def _pandas_rows(file_path: str, encoding: str, delimiter: str):
+    import pandas
+    with pandas.read_csv(file_path,
+                         sep=delimiter,
+                         encoding=encoding,
+                         header=0,
+                         index_col=False,
+                         dtype=str,
+                         na_filter=False,
+                         keep_default_na=False,
+                         engine='c',
+                         chunksize=PANDAS_CHUNK_ROWS) as chunks:
+        for chunk in chunks:
+            # Rows with fewer cells than the header are padded with blanks
+            yield from chunk.fillna(u"").values.tolist()
+
+def read_csv(file_path: str, reader_backend: READER_BACKEND = READER_BACKEND.AUTO) -> tuple:
+    """
+    Opens a CSV file, returning its fields and a SheetRows of the rest of its rows, same as xlsx_to_csv.
+    The header is always read by the csv module so every backend gives the same fields.
+
+    Args:
+        reader_backend: Parser to read the rows with. AUTO uses the fastest installed for the sheet (see fastest_reader_backend),
+            or the csv module if the sampled rows have different numbers of cells as only it keeps such rows as they are.
+    """
+    reader_backend = READER_BACKEND(reader_backend)
+    encoding, delimiter, is_rectangular = sniff_csv(file_path)
+
+    f = open(file_path, 'r', encoding=encoding, newline='')
+    try:
+        csv_reader = csv.reader(f, delimiter=delimiter)
+        # Field names
+        fields = next(csv_reader)
+        if reader_backend == READER_BACKEND.AUTO:
+            reader_backend = fastest_reader_backend(len(fields)) if is_rectangular else READER_BACKEND.STDLIB
+        _import_backend(reader_backend)
+    except BaseException:
+        f.close()
+        raise
+    if reader_backend == READER_BACKEND.STDLIB:
+        return fields, SheetRows(csv_reader, f.close)
+    f.close()
+
+    if reader_backend == READER_BACKEND.PYARROW:
+        rows = _pyarrow_rows(file_path, fields, encoding, delimiter)
+    else:
+        rows = _pandas_rows(file_path, encoding, delimiter)
+    return fields, SheetRows(rows, rows.close)
+
+def xlsx_to_csv(excel_file_path: str, sheet_name: str = None) -> tuple:
+    """
+    Opens an Excel file in read-only mode, returning its fields and a SheetRows which yields the rest of its rows as lists of strings.
+    Rows are read from the file lazily, so only one row is held in memory at a time. The workbook is closed once all rows have been read or the rows are closed.
+
+    Args:
+        sheet_name: Sheet to read, defaults to the workbook's active sheet.
+    """
+    # Only imported when an Excel file is read, so CSV only runs start quickly
+    from openpyxl import load_workbook
+    wb = load_workbook(excel_file_path, read_only=True)
+    if sheet_name == None:
+        ws = wb.active
+    elif sheet_name in wb.sheetnames:
+        ws = wb[sheet_name]
+    else:
+        wb.close()
+        raise ValueError(f'STOP: {excel_file_path} has no sheet named "{sheet_name}", its sheets are {wb.sheetnames}.')
+    sh = ws.iter_rows(values_only=True)
+    header = next(sh, ())
+    fields = [str(cell) for cell in header if cell != None] # headers of the sheet
+    # Read-only sheets may leave out trailing empty cells, pad rows out to the full width of the sheet like a normal workbook would
+    width = max(ws.max_column or 0, len(header))
+
+    def rest(): # the data/content of the sheet
+        try:
+            for row in sh:
+                converted_row = [(u"" if cell == None else str(cell)) for cell in row] # Ensure empty cells are blanks rather than "None" objects, also convert to string to prevent typing discrepancies
+                if len(converted_row) < width:
+                    converted_row.extend([u""] * (width - len(converted_row)))
+                yield converted_row
+        finally:
+            wb.close()
+    return fields, SheetRows(rest(), wb.close)
+
+class MappedCSV:
+    """
+    A memory-mapped CSV file. Iterating reads its rows after the header once, keeping only the byte offset each row starts at,
+    after which any row can be parsed again from the mapped file with row(row_num). The mapped pages belong to the file rather
+    than the process, so the operating system can drop them whenever memory is short instead of the rows being held as strings.
+    """
+    def __init__(self, file_path: str, encoding: str, delimiter: str) -> None:
+        self._encoding = encoding
+        self._delimiter = delimiter
+        with open(file_path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # Offset of the start of each row, and of the end of the last row
+        self._offsets = array('q')
+        try:
+            self._csv_reader = csv.reader(self._lines(), delimiter=delimiter)
+            self.fields = next(self._csv_reader, [])
+        except BaseException:
+            self._mm.close()
+            raise
+        self._offsets.append(self._mm.tell())
+
+    def _lines(self):
+        # Decoded line by line in C, the csv module only asks for the next line once it needs it so tell() is always at the end of the last row read
+        return map(methodcaller('decode', self._encoding), iter(self._mm.readline, b''))
+
+    def __iter__(self):
+        for row in self._csv_reader:
+            self._offsets.append(self._mm.tell())
+            yield row
+
+    def row(self, row_num: int) -> list[str]:
+        """ Parses a row which has already been iterated over again, numbered from 0 after the header. """
+        return next(csv.reader([self._mm[self._offsets[row_num]:self._offsets[row_num + 1]].decode(self._encoding)], delimiter=self._delimiter))
+
+    def close(self) -> None:
+        self._mm.close()
+
+    def __enter__(self) -> 'MappedCSV':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+def map_csv(file_path: str) -> MappedCSV:
+    """
+    Memory-maps a CSV file, see MappedCSV.
+
+    Returns:
+        The MappedCSV, or None if the file can't be split into rows byte by byte (it's empty, or in UTF-16 or UTF-32, or has lines
+        ending in a lone carriage return) and has to be read with read_csv instead.
+    """
+    if file_path.split('.')[-1] != 'csv' or os.path.getsize(file_path) == 0:
+        return None
+    encoding, delimiter, _ = sniff_csv(file_path)
+    if encoding not in MAPPABLE_ENCODINGS:
+        return None
+    # A lone carriage return can be anywhere in the file, the regex searches the mapped file without reading it into memory
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if LONE_CARRIAGE_RETURN.search(mm):
+            return None
+    return MappedCSV(file_path, encoding, delimiter)
@@ -0,0 +1,314 @@
+"""
+Out-of-core comparison for sheets which are too large to be cached in memory.
+
+Both sheets are split into runs which fit within the memory budget, each run is sorted by its identifier and written to a
+temporary file. The sorted runs are then merged into one stream per sheet and the two streams are joined on their identifier,
+so only a handful of rows are ever held in memory at once. Issues are reported in the same order as find_discrepancies.
+The memory budget is split between the two sheets, and uploaded rows with no original counterpart are written to runs of their
+own sorted by row number once they outgrow the uploaded sheet's share, so they can be reported in order at the end.
+"""
+import csv
+import heapq
+import itertools
+import tempfile
+from instrumentation_logic import PHASE, Instrumentation, start_phase, finish_phase
+from common_logic import READER_BACKEND
+from sheet_comparator_logic import ISSUES_MAIN, NATURE_OF_ISSUES, ISSUE_TYPE, RESULT_MODE, PROGRESS_CHECK_INTERVAL_ROWS, open_sheets, issues_name, check_fields, resolve_identifying_field_indexes, compile_compared_columns, find_mismatched_columns, log_unmatched_uploaded_row
+
+# Rough number of bytes Python uses to hold a row and each of its cells on top of the text itself
+ROW_OVERHEAD_BYTES = 64
+CELL_OVERHEAD_BYTES = 50
+# Maximum number of runs to merge at once, keeps the number of open files well below OS limits
+MAX_RUNS_PER_MERGE = 128
+# Digits of the row numbers unmatched rows are sorted by in their runs, zero padded so they sort as text like identifiers do
+ROW_NUMBER_SORT_KEY_DIGITS = 20
+
+def _write_run(sorted_rows: list, temp_dir: str) -> str:
+    """ Writes sorted (identifier, row number, row) tuples to a temporary file, returns the path of the file. """
+    with tempfile.NamedTemporaryFile('w', dir=temp_dir, suffix='.csv', newline='', encoding='utf-8', delete=False) as f:
+        csv_writer = csv.writer(f)
+        for identifier, row_num, row in sorted_rows:
+            csv_writer.writerow([identifier, row_num, *row])
+        return f.name
+
+def _read_run(run_path: str):
+    """ Yields the (identifier, row number, row) tuples from a run written by _write_run. """
+    with open(run_path, 'r', newline='', encoding='utf-8') as f:
+        for record in csv.reader(f):
+            yield record[0], int(record[1]), record[2:]
+
+def _merge_runs(run_paths: list[str], temp_dir: str):
+    """ Merges sorted runs into a single sorted stream, merging in multiple passes if there are too many runs to open at once. """
+    while len(run_paths) > MAX_RUNS_PER_MERGE:
+        run_paths = [_write_run(heapq.merge(*[_read_run(run_path) for run_path in run_paths[i:i+MAX_RUNS_PER_MERGE]]), temp_dir)
+                     for i in range(0, len(run_paths), MAX_RUNS_PER_MERGE)]
+    # Row numbers are unique, so tuples never fall through to comparing the rows themselves
+    return heapq.merge(*[_read_run(run_path) for run_path in run_paths])
+
+def _row_size(row: list) -> int:
+    """ Rough number of bytes a row takes up in memory. """
+    return ROW_OVERHEAD_BYTES + CELL_OVERHEAD_BYTES*len(row) + sum(map(len, row))
+
+def sort_rows_externally(rows, identifying_field_index: int, memory_budget_bytes: int, temp_dir: str) -> tuple:
+    """
+    Sorts rows by their identifier using temporary files so that memory use stays within the budget.
+
+    Returns:
+        An iterator of (identifier, row number, row) tuples sorted by identifier then row number, and the number of rows read.
+    """
+    run_paths = []
+    buffer = []
+    buffer_size = 0
+    row_count = 0
+    for row_num, row in enumerate(rows):
+        buffer.append((row[identifying_field_index], row_num, row))
+        buffer_size += _row_size(row)
+        row_count += 1
+        if buffer_size >= memory_budget_bytes:
+            buffer.sort()
+            run_paths.append(_write_run(buffer, temp_dir))
+            buffer = []
+            buffer_size = 0
+    buffer.sort()
+    # Avoid touching the disk at all if everything fit in a single run
+    if len(run_paths) == 0:
+        return iter(buffer), row_count
+    run_paths.append(_write_run(buffer, temp_dir))
+    return _merge_runs(run_paths, temp_dir), row_count
+
+class UnmatchedUploadedRows:
+    """
+    Uploaded rows which are never compared against an original row. The merge join finds them in the order of their identifiers,
+    but they're reported in the order of the uploaded sheet. They're held in memory until they outgrow the budget, then written
+    out as a run sorted by row number, and the runs are merged back together by row number when they're logged.
+    Rows are only counted when the result mode doesn't keep them.
+    """
+    def __init__(self, memory_budget_bytes: int, temp_dir: str, keep_rows: bool = True) -> None:
+        self.memory_budget_bytes = memory_budget_bytes
+        self.temp_dir = temp_dir
+        self.keep_rows = keep_rows
+        self.extra_row_count = 0
+        self.duplicate_row_count = 0
+        # (row number, whether it's an extra row, the first original row with its identifier if it's a duplicate, row)
+        self._buffer = []
+        self._buffer_size = 0
+        self._run_paths = []
+
+    def add(self, row_num: int, row: list, is_extra_row: bool, original_row: list = None) -> None:
+        """ See log_unmatched_uploaded_row. """
+        if is_extra_row:
+            self.extra_row_count += 1
+        else:
+            self.duplicate_row_count += 1
+        if not self.keep_rows:
+            return
+        self._buffer.append((row_num, is_extra_row, original_row, row))
+        self._buffer_size += _row_size(row)
+        if self._buffer_size >= self.memory_budget_bytes:
+            self._write_buffer()
+
+    def _write_buffer(self) -> None:
+        self._buffer.sort(key=lambda item: item[0])
+        # Written in the same format as the sorted runs of a sheet, with the zero padded row number in place of the identifier.
+        # The original row's cells go first, after the number of them (-1 for none) and whether the row is an extra row
+        self._run_paths.append(_write_run(((f'{row_num:0{ROW_NUMBER_SORT_KEY_DIGITS}d}', row_num, ['1' if is_extra_row else '0', -1 if original_row == None else len(original_row), *(original_row or ()), *row])
+                                           for row_num, is_extra_row, original_row, row in self._buffer), self.temp_dir))
+        self._buffer = []
+        self._buffer_size = 0
+
+    def __iter__(self):
+        """ Yields the rows as they were added, in the order of the uploaded sheet. """
+        self._buffer.sort(key=lambda item: item[0])
+        if len(self._run_paths) == 0:
+            yield from self._buffer
+            return
+        self._write_buffer()
+        sorted_runs = _merge_runs(self._run_paths, self.temp_dir)
+        try:
+            for _, row_num, record in sorted_runs:
+                num_original_cells = int(record[1])
+                original_row = None if num_original_cells < 0 else record[2:2 + num_original_cells]
+                yield row_num, record[0] == '1', original_row, record[2 + max(num_original_cells, 0):]
+        finally:
+            sorted_runs.close()
+
+    def log(self, issues: ISSUES_MAIN, uploaded_file_identifying_field_index: int = 0, original_file_identifying_field_index: int = 0) -> None:
+        """ Logs every row, same as log_unmatched_uploaded_rows. """
+        if not self.keep_rows:
+            # Only counted, the rows may not have been read
+            if self.extra_row_count:
+                issues.count_issue(ISSUE_TYPE.EXTRA_ROW, count=self.extra_row_count)
+            if self.duplicate_row_count:
+                issues.count_issue(ISSUE_TYPE.DUPLICATE_KEY, count=self.duplicate_row_count)
+            return
+        rows = iter(self)
+        try:
+            for row_num, is_extra_row, original_row, row in rows:
+                if issues.limit_reached:
+                    return
+                log_unmatched_uploaded_row(issues, row_num, row, is_extra_row, original_row, uploaded_file_identifying_field_index, original_file_identifying_field_index)
+        finally:
+            rows.close()
+
+def find_discrepancies_external_sort(uploaded_file_path: str,
+                                     original_file_path: str,
+                                     progress_to_show_in_gui = None,
+                                     status_to_show_in_gui = None,
+                                     uploaded_file_identifying_field_index: int = 0,
+                                     original_file_identifying_field_index: int = 0,
+                                     ignore_leading_and_trailing_whitespaces: bool = False,
+                                     memory_budget_mb: int = 256,
+                                     temp_dir: str = None,
+                                     normalisation_rules: dict = None,
+                                     full_outer_diff: bool = True,
+                                     result_mode: RESULT_MODE = RESULT_MODE.FULL,
+                                     max_issues: int = None,
+                                     issue_sink = None,
+                                     reader_backend: READER_BACKEND = READER_BACKEND.AUTO,
+                                     snapshot_cache = None,
+                                     uploaded_sheet_name: str = None,
+                                     original_sheet_name: str = None,
+                                     instrumentation: Instrumentation = None) -> ISSUES_MAIN:
+    """
+    Finds the difference between two sheets with an external sort-merge join, see find_discrepancies.
+
+    Args:
+        memory_budget_mb: Approximate memory to use, split evenly between sorting the two sheets. Larger budgets mean fewer temporary files.
+        temp_dir: Folder to write the temporary sorted runs to, defaults to the system's temporary folder.
+    """
+    # Each sheet gets half, when both fit in a single run both are held in memory during the join
+    memory_budget_bytes = max(1, memory_budget_mb) * 1024 * 1024 // 2
+
+    # Initialise issues custom class to hold all the found issues (if any)
+    issues = ISSUES_MAIN()
+    issues.name = issues_name(original_file_path, original_sheet_name)
+    issues.original_identifying_field_index = original_file_identifying_field_index
+    issues.set_result_mode(result_mode, max_issues)
+    issues.issue_sink = issue_sink
+
+    phase = start_phase(instrumentation, PHASE.OPEN, issues.name)
+    fields_uploaded_csv, uploaded_csv_reader, fields_ori_csv, ori_csv_reader = open_sheets(uploaded_file_path, original_file_path, reader_backend, snapshot_cache, uploaded_sheet_name=uploaded_sheet_name, original_sheet_name=original_sheet_name)
+    # Both sheets are closed however the comparison ends, even if it stops early or fails partway through
+    try:
+        issues.original_fields = fields_ori_csv
+        issues.uploaded_fields = fields_uploaded_csv
+        fields_match = check_fields(issues)
+        finish_phase(instrumentation, phase, issues=len(issues.issue_list))
+        if not fields_match:
+            return issues
+        uploaded_file_identifying_field_index, original_file_identifying_field_index = resolve_identifying_field_indexes(issues, uploaded_file_identifying_field_index, original_file_identifying_field_index)
+
+        phase = start_phase(instrumentation, PHASE.MAP_FIELDS, issues.name)
+        compared_columns = compile_compared_columns(issues, normalisation_rules, ignore_leading_and_trailing_whitespaces)
+        finish_phase(instrumentation, phase)
+
+        with tempfile.TemporaryDirectory(dir=temp_dir, prefix='sheet_comparator_') as run_dir:
+            # Sort both sheets by their identifier
+            if status_to_show_in_gui:
+                status_to_show_in_gui(f'Sorting uploaded sheet {issues.name}')
+            if progress_to_show_in_gui != None:
+                progress_to_show_in_gui(0)
+            # Sorting the uploaded sheet takes the place of caching it into a dictionary
+            phase = start_phase(instrumentation, PHASE.HASH_UPLOADED, issues.name)
+            sorted_uploaded_rows, uploaded_row_count = sort_rows_externally(uploaded_csv_reader, uploaded_file_identifying_field_index, memory_budget_bytes, run_dir)
+            uploaded_csv_reader.close()
+            finish_phase(instrumentation, phase, rows=uploaded_row_count)
+
+            if status_to_show_in_gui:
+                status_to_show_in_gui(f'Sorting original sheet {issues.name}')
+            if progress_to_show_in_gui != None:
+                progress_to_show_in_gui(25)
+            phase = start_phase(instrumentation, PHASE.COMPARE, issues.name)
+            sorted_ori_rows, ori_row_count = sort_rows_externally(ori_csv_reader, original_file_identifying_field_index, memory_budget_bytes, run_dir)
+            ori_csv_reader.close()
+
+            if status_to_show_in_gui:
+                status_to_show_in_gui(f'Comparing sheet {issues.name}')
+            if progress_to_show_in_gui != None:
+                progress_to_show_in_gui(50)
+
+            # Merge join both sorted sheets, each issue keeps its row number so they can be put back in the original order.
+            # The uploaded sheet's share of the budget is free once it's sorted, unmatched rows are held within it (when it's held
+            # in a single run the unmatched rows are the same objects, so holding them again costs next to nothing)
+            unmatched_uploaded_rows = UnmatchedUploadedRows(memory_budget_bytes, run_dir, issues.keep_rows)
+            rows_compared = 0
+            previous_update = 50
+            next_progress_check = PROGRESS_CHECK_INTERVAL_ROWS
+
+            def unmatched_uploaded_group(uploaded_group) -> None:
+                # All but the last row of a repeated identifier were replaced, the last row has no original counterpart
+                previous_row = None
+                for _, upl_row_num, row in uploaded_group:
+                    if previous_row != None:
+                        unmatched_uploaded_rows.add(*previous_row, is_extra_row=False)
+                    previous_row = (upl_row_num, row)
+                unmatched_uploaded_rows.add(*previous_row, is_extra_row=True)
+
+            uploaded_groups = itertools.groupby(sorted_uploaded_rows, key=lambda item: item[0])
+            uploaded_identifier, uploaded_group = next(uploaded_groups, (None, None))
+            for ori_identifier, ori_group in itertools.groupby(sorted_ori_rows, key=lambda item: item[0]):
+                # Skip past uploaded rows which have no original counterpart
+                while uploaded_group != None and uploaded_identifier < ori_identifier:
+                    if full_outer_diff:
+                        unmatched_uploaded_group(uploaded_group)
+                    uploaded_identifier, uploaded_group = next(uploaded_groups, (None, None))
+
+                row_from_uploaded_csv = None
+                uploaded_rows_replaced = []
+                if uploaded_group != None and uploaded_identifier == ori_identifier:
+                    # The last row of a repeated identifier wins, same as caching it into a dictionary
+                    uploaded_rows = [(upl_row_num, row) for _, upl_row_num, row in uploaded_group]
+                    _, row_from_uploaded_csv = uploaded_rows[-1]
+                    uploaded_rows_replaced = uploaded_rows[:-1]
+                    uploaded_identifier, uploaded_group = next(uploaded_groups, (None, None))
+
+                for _, row_num, row_from_ori_csv in ori_group:
+                    if full_outer_diff and len(uploaded_rows_replaced):
+                        for upl_row_num, row in uploaded_rows_replaced:
+                            unmatched_uploaded_rows.add(upl_row_num, row, is_extra_row=False, original_row=row_from_ori_csv)
+                        uploaded_rows_replaced = []
+                    rows_compared += 1
+                    if row_from_uploaded_csv == None:
+                        issues.insert_issue_missing_uploaded_row(row_from_ori_csv, ori_identifier, original_file_identifying_field_index, row_num)
+                        continue
+                    mismatched_fields = find_mismatched_columns(row_from_ori_csv, row_from_uploaded_csv, compared_columns)
+                    if len(mismatched_fields) > 0:
+                        issues.insert_issue(row_from_ori_csv, row_from_uploaded_csv, mismatched_fields, row_num)
+                if issues.limit_reached:
+                    break
+
+                # GUI progress bars, only checked every so many rows to keep the loop fast
+                if progress_to_show_in_gui != None and rows_compared >= next_progress_check:
+                    next_progress_check = rows_compared + PROGRESS_CHECK_INTERVAL_ROWS
+                    progress_in_percentage = min( int(rows_compared / max(ori_row_count, 1)*50) + 50, 100)
+                    if previous_update != progress_in_percentage:
+                        progress_to_show_in_gui(progress_in_percentage)
+                        previous_update = progress_in_percentage
+
+            # Uploaded rows after the last original identifier
+            while full_outer_diff and uploaded_group != None and not issues.limit_reached:
+                unmatched_uploaded_group(uploaded_group)
+                uploaded_identifier, uploaded_group = next(uploaded_groups, (None, None))
+
+            # Close any runs which weren't read to the end (e.g. the comparison stopped early) so the temporary folder can be removed
+            for sorted_rows in (sorted_uploaded_rows, sorted_ori_rows):
+                if hasattr(sorted_rows, 'close'):
+                    sorted_rows.close()
+
+            # Put the issues back in the order of the original sheet, followed by the uploaded rows which were never compared.
+            # Logged before the temporary folder is removed as their runs are in it
+            issues.issue_list.sort(key=lambda issue: issue.row_number)
+            if full_outer_diff and not issues.limit_reached:
+                unmatched_uploaded_rows.log(issues, uploaded_file_identifying_field_index, original_file_identifying_field_index)
+    finally:
+        uploaded_csv_reader.close()
+        ori_csv_reader.close()
+
+    # Mark issues found
+    if issues.issue_count: issues.nature_of_issues.append(NATURE_OF_ISSUES.DISCREPANCY)
+    finish_phase(instrumentation, phase, rows=ori_row_count, issues=issues.issue_count)
+
+    if status_to_show_in_gui:
+        status_to_show_in_gui(f'Finished comparing {issues.name}')
+
+    return issues
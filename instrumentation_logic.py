@@ -0,0 +1,141 @@
+"""
+Structured timings of each phase of comparing a pair of sheets and writing its issues.
+
+Pass an Instrumentation to find_discrepancies, write_issues or the folder comparisons to have every phase of every file pair recorded:
+its wall time, rows processed, issues found and the peak memory of the process. Hooks subscribed to the Instrumentation are called
+with each record as soon as its phase finishes, and the records can be exported as JSON lines or a summary table.
+
+Sheets are read lazily, so the time spent parsing CSV or Excel rows is part of the phase which reads them
+(e.g. HASH_UPLOADED for the uploaded sheet) rather than OPEN. The columnar engine reads both sheets whole during OPEN.
+"""
+import os
+import sys
+import json
+import time
+import threading
+from enum import Enum
+
+class PHASE(Enum):
+    OPEN = "open" # Opening both sheets and checking their fields
+    MAP_FIELDS = "map_fields" # Mapping the uploaded sheet's fields to the original's and compiling the normalisation rules
+    HASH_UPLOADED = "hash_uploaded" # Caching (or sorting) the uploaded sheet by its identifier
+    COMPARE = "compare" # Comparing the original sheet's rows against the uploaded sheet
+    SPLIT = "split" # Splitting both sheets into parts to compare in parallel
+    WRITE_ISSUES = "write_issues" # Writing the issue log
+
+def peak_rss_mb() -> float:
+    """ Peak resident memory of this process in MB, or None if it can't be measured on this platform. """
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+            return psutil.Process().memory_info().peak_wset / 1024 / 1024 # Windows only
+        except (ImportError, AttributeError):
+            return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return peak_rss / 1024 / 1024 if sys.platform == 'darwin' else peak_rss / 1024
+
+class PhaseRecord:
+    """ Measurements of one phase of one file pair. """
+    def __init__(self, phase: PHASE, file_pair: str) -> None:
+        self.phase = phase
+        self.file_pair = file_pair
+        self.started_at = time.time()
+        self.wall_seconds = 0.0
+        self.rows = 0
+        self.issues = 0
+        self.peak_rss_mb = None # Peak memory of the process when the phase finished
+        self.peak_rss_growth_mb = None # How much the peak memory of the process grew during the phase
+        self.process_id = os.getpid()
+        self._start = time.perf_counter()
+        self._peak_rss_at_start = peak_rss_mb()
+
+    def to_dict(self) -> dict:
+        return {"phase": self.phase.value,
+                "file_pair": self.file_pair,
+                "started_at": self.started_at,
+                "wall_seconds": self.wall_seconds,
+                "rows": self.rows,
+                "rows_per_second": self.rows / self.wall_seconds if self.wall_seconds > 0 else None,
+                "issues": self.issues,
+                "peak_rss_mb": self.peak_rss_mb,
+                "peak_rss_growth_mb": self.peak_rss_growth_mb,
+                "process_id": self.process_id}
+
+class Instrumentation:
+    def __init__(self) -> None:
+        self.records: list[PhaseRecord] = []
+        self.hooks = []
+        self.lock = threading.Lock()
+
+    def subscribe(self, hook) -> None:
+        """ Calls hook with each PhaseRecord as soon as its phase finishes. Hooks may be called from worker threads. """
+        self.hooks.append(hook)
+
+    def start(self, phase: PHASE, file_pair: str) -> PhaseRecord:
+        return PhaseRecord(phase, file_pair)
+
+    def finish(self, record: PhaseRecord, rows: int = 0, issues: int = 0) -> None:
+        record.wall_seconds = time.perf_counter() - record._start
+        record.rows = rows
+        record.issues = issues
+        record.peak_rss_mb = peak_rss_mb()
+        if record.peak_rss_mb != None:
+            record.peak_rss_growth_mb = record.peak_rss_mb - record._peak_rss_at_start
+        self.add(record)
+
+    def add(self, record: PhaseRecord) -> None:
+        """ Adds a finished record, e.g. one measured in a worker process. """
+        with self.lock:
+            self.records.append(record)
+        for hook in self.hooks:
+            hook(record)
+
+    def to_json_lines(self) -> str:
+        with self.lock:
+            return ''.join(json.dumps(record.to_dict()) + '\n' for record in self.records)
+
+    def write_json_lines(self, file_path: str) -> None:
+        with open(file_path, 'w', encoding='utf-8') as f:
+            f.write(self.to_json_lines())
+
+    def summary_table(self) -> str:
+        """ Totals of each phase over every file pair, as a plain text table. """
+        with self.lock:
+            records = list(self.records)
+        lines = [f'{"phase":<16}{"runs":>6}{"seconds":>12}{"rows":>14}{"rows/s":>14}{"issues":>12}{"peak MB":>10}']
+        for phase in PHASE:
+            phase_records = [record for record in records if record.phase == phase]
+            if len(phase_records) == 0:
+                continue
+            wall_seconds = sum(record.wall_seconds for record in phase_records)
+            rows = sum(record.rows for record in phase_records)
+            rows_per_second = f'{rows / wall_seconds:,.0f}' if wall_seconds > 0 and rows > 0 else '-'
+            peak_rss = max([record.peak_rss_mb for record in phase_records if record.peak_rss_mb != None], default=None)
+            lines.append(f'{phase.value:<16}{len(phase_records):>6}{wall_seconds:>12.3f}{rows:>14,}{rows_per_second:>14}{sum(record.issues for record in phase_records):>12,}{peak_rss if peak_rss != None else 0:>10.1f}')
+        return '\n'.join(lines)
+
+class JsonLinesWriter:
+    """ Hook which appends each record to a JSON lines file as soon as its phase finishes. """
+    def __init__(self, file_path: str) -> None:
+        self.file_path = file_path
+        self.lock = threading.Lock()
+
+    def __call__(self, record: PhaseRecord) -> None:
+        with self.lock:
+            with open(self.file_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record.to_dict()) + '\n')
+
+def start_phase(instrumentation: Instrumentation, phase: PHASE, file_pair: str) -> PhaseRecord:
+    """ Starts measuring a phase, does nothing if instrumentation is None. """
+    if instrumentation == None:
+        return None
+    return instrumentation.start(phase, file_pair)
+
+def finish_phase(instrumentation: Instrumentation, record: PhaseRecord, rows: int = 0, issues: int = 0) -> None:
+    """ Finishes measuring a phase started with start_phase, does nothing if instrumentation is None. """
+    if instrumentation == None:
+        return
+    instrumentation.finish(record, rows, issues)
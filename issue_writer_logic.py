@@ -0,0 +1,356 @@
+"""
+Writers for issue logs, which write each issue as soon as they're given it rather than needing every issue up front.
+
+Pass a writer to find_discrepancies as its issue_sink to write the issues while the sheets are still being compared,
+so the issues never build up in memory:
+with TextIssueWriter(output_dir) as writer:
+    issues = find_discrepancies(uploaded_file_path, original_file_path, issue_sink=writer)
+Any object with a write_issue(issues, issue_item) method can be used as an issue_sink.
+write_issues uses the same writers for issues which were collected first.
+
+The text and Excel logs are for people to read. The CSV, JSON lines and Parquet logs are for tools, they hold one record
+of LONG_FORMAT_FIELDS per cell which differs so they can be loaded straight into e.g. pandas.
+"""
+import csv
+import time
+from enum import Enum
+from itertools import chain, repeat
+from json.encoder import encode_basestring
+
+class OUTPUT_FORMAT(Enum):
+    TEXT = "text" # Original and uploaded rows with the mismatched cells marked as <|value|>
+    EXCEL = "excel" # Original and uploaded rows with the mismatched cells highlighted
+    CSV = "csv" # One row per cell which differs
+    JSONL = "jsonl" # One JSON object per line for each cell which differs
+    PARQUET = "parquet" # One row per cell which differs, needs pyarrow
+
+# Excel's maximum number of rows in a sheet
+EXCEL_MAX_ROWS = 1048576
+# Highlight colours for cells with discrepancies
+ORIGINAL_HIGHLIGHT_COLOUR = "26B688"
+UPLOADED_HIGHLIGHT_COLOUR = "FF8080"
+# Fields of each record of the CSV, JSON lines and Parquet logs. The column is the original sheet's field name, 
+# and the original or uploaded value is empty (null) when that side's row or column is missing
+LONG_FORMAT_FIELDS = ('issue_type', 'row_number', 'key', 'column', 'original', 'uploaded')
+# Number of records the CSV, JSON lines and Parquet writers hold before writing them out together
+LONG_FORMAT_BATCH_RECORDS = 65536
+
+class IssueLogWriter:
+    """
+    The log is only created once the first issue is written, named after the ISSUES_MAIN the issue belongs to (or name if given)
+    as issues_<name>_<time>.<extension> in output_dir. Subclasses implement open, write and finish.
+    """
+    extension = ''
+
+    def __init__(self, output_dir: str = "", name: str = None) -> None:
+        self.output_dir = output_dir
+        self.name = name
+        self.log_file_path = None
+        self.issues_written = 0
+        self.is_open = False
+
+    def write_issue(self, issues, issue_item) -> None:
+        if self.log_file_path == None:
+            self.log_file_path = f'{self.output_dir}/issues_{self.name or issues.name}_{time.strftime("%Y_%m_%d_%H_%M_%S", time.gmtime())}.{self.extension}'
+            self.open(issues)
+            self.is_open = True
+        self.write(issue_item)
+        self.issues_written += 1
+
+    def close(self) -> str:
+        """ Finishes writing the log, returning its path or None if no issues were written. """
+        if self.is_open:
+            self.is_open = False
+            self.finish()
+        return self.log_file_path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def open(self, issues) -> None:
+        raise NotImplementedError
+
+    def write(self, issue_item) -> None:
+        raise NotImplementedError
+
+    def finish(self) -> None:
+        raise NotImplementedError
+
+class TextIssueWriter(IssueLogWriter):
+    extension = 'txt'
+
+    def open(self, issues) -> None:
+        self.f = open(self.log_file_path, 'a+', encoding='utf-8')
+
+    @staticmethod
+    def marked_row(label: str, row: list, mismatched_columns_indexes) -> str:
+        # Only the mismatched cells are touched, the rest of the row is joined as it is
+        cells = [label, *map(str, row)]
+        for x in mismatched_columns_indexes:
+            if x+1 < len(cells):
+                cells[x+1] = f'<|{cells[x+1]}|>'
+        return ' '.join(cells)
+
+    def write(self, issue_item) -> None:
+        original_row = self.marked_row('ORI |', issue_item.original_row, issue_item.mismatched_columns_indexes)
+        uploaded_row = self.marked_row('UPL |', issue_item.uploaded_row, issue_item.mismatched_columns_indexes)
+        self.f.write(f'{original_row}\n{uploaded_row}\n\n')
+
+    def finish(self) -> None:
+        self.f.close()
+
+class ExcelIssueWriter(IssueLogWriter):
+    """
+    Streams rows to a write-only workbook. Output is split over multiple sheets once a sheet reaches max_rows_per_sheet,
+    and over multiple files once a file has max_sheets_per_file sheets.
+    """
+    extension = 'xlsx'
+
+    def __init__(self, output_dir: str = "", name: str = None, max_rows_per_sheet: int = EXCEL_MAX_ROWS, max_sheets_per_file: int = 16) -> None:
+        super().__init__(output_dir, name)
+        self.max_rows_per_sheet = max_rows_per_sheet
+        self.max_sheets_per_file = max_sheets_per_file
+
+    def open(self, issues) -> None:
+        # Only imported when writing Excel, so text only runs start quickly
+        from openpyxl import Workbook, styles
+        from openpyxl.cell import WriteOnlyCell
+        self.Workbook = Workbook
+        self.WriteOnlyCell = WriteOnlyCell
+        # Every highlighted cell shares one of two fills
+        self.original_highlight_fill = styles.PatternFill(fill_type="solid", fgColor=ORIGINAL_HIGHLIGHT_COLOUR)
+        self.uploaded_highlight_fill = styles.PatternFill(fill_type="solid", fgColor=UPLOADED_HIGHLIGHT_COLOUR)
+        self.original_fields = issues.original_fields
+        self.wb = None
+        self.sheet = None
+        self.rows_in_sheet = 0
+        self.sheets_in_file = 0
+        self.file_number = 1
+
+    def excel_file_path(self, file_number: int) -> str:
+        if file_number == 1:
+            return self.log_file_path
+        return self.log_file_path.replace('.xlsx', f'_part{file_number}.xlsx')
+
+    def highlighted_row(self, issue_item, label: str, values: list, fill) -> list:
+        row = [label, *values]
+        for mismatched_column_index in issue_item.mismatched_columns_indexes:
+            # Ensure to offset the column as the first column is always the identifier
+            if mismatched_column_index+1 >= len(row):
+                row.extend([None] * (mismatched_column_index+2 - len(row)))
+            cell = self.WriteOnlyCell(self.sheet, value=row[mismatched_column_index+1])
+            cell.fill = fill
+            row[mismatched_column_index+1] = cell
+        return row
+
+    def write(self, issue_item) -> None:
+        # Start a new sheet once the next issue would not fit under Excel's row limit, and a new file once the file has enough sheets
+        if self.sheet == None or self.rows_in_sheet + 2 > self.max_rows_per_sheet:
+            if self.wb != None and self.sheets_in_file >= self.max_sheets_per_file:
+                self.wb.save(self.excel_file_path(self.file_number))
+                self.wb = None
+                self.file_number += 1
+            if self.wb == None:
+                self.wb = self.Workbook(write_only=True)
+                self.sheets_in_file = 0
+            self.sheets_in_file += 1
+            self.sheet = self.wb.create_sheet(title='Issues' if self.sheets_in_file == 1 else f'Issues {self.sheets_in_file}')
+            # Insert the fields based on the original file
+            self.sheet.append([None, *self.original_fields])
+            self.rows_in_sheet = 1
+
+        self.sheet.append(self.highlighted_row(issue_item, 'ORI', issue_item.original_row, self.original_highlight_fill))
+        self.sheet.append(self.highlighted_row(issue_item, 'UPL', issue_item.uploaded_row, self.uploaded_highlight_fill))
+        self.rows_in_sheet += 2
+
+    def finish(self) -> None:
+        self.wb.save(self.excel_file_path(self.file_number))
+
+class LongFormatIssueWriter(IssueLogWriter):
+    """
+    Writes one record of LONG_FORMAT_FIELDS for each cell which differs. Records are held as columns until there are 
+    LONG_FORMAT_BATCH_RECORDS of them and then written out together, subclasses implement open_records, write_batch and finish_records.
+    """
+    def open(self, issues) -> None:
+        self.original_fields = issues.original_fields
+        self.identifying_field_index = issues.original_identifying_field_index
+        self.clear_batch()
+        self.open_records()
+
+    def clear_batch(self) -> None:
+        # Held once per issue along with its number of cells, only repeated for each cell when the batch is written
+        self.issue_types = []
+        self.row_numbers = []
+        self.keys = []
+        self.cell_counts = []
+        # Held for each cell
+        self.column_indexes = []
+        self.original_values = []
+        self.uploaded_values = []
+
+    def write(self, issue_item) -> None:
+        column_indexes, original_values, uploaded_values = issue_item.discrepant_cells()
+        self.issue_types.append(issue_item.issue_type.name)
+        self.row_numbers.append(issue_item.row_number)
+        self.keys.append(issue_item.key(self.identifying_field_index))
+        self.cell_counts.append(len(column_indexes))
+        self.column_indexes.extend(column_indexes)
+        self.original_values.extend(original_values)
+        self.uploaded_values.extend(uploaded_values)
+        if len(self.column_indexes) >= LONG_FORMAT_BATCH_RECORDS:
+            self.write_batch()
+            self.clear_batch()
+
+    def for_each_cell(self, issue_values: list) -> list:
+        """ Repeats a value held once per issue for each of the issue's cells. """
+        return list(chain.from_iterable(map(repeat, issue_values, self.cell_counts)))
+
+    def columns(self) -> list:
+        """ LONG_FORMAT_FIELDS of the held records, as a list for each field. """
+        original_fields = self.original_fields
+        return [self.for_each_cell(self.issue_types), 
+                self.for_each_cell(self.row_numbers), 
+                self.for_each_cell(self.keys), 
+                [original_fields[column_index] for column_index in self.column_indexes], 
+                self.original_values, 
+                self.uploaded_values]
+
+    def finish(self) -> None:
+        if len(self.column_indexes):
+            self.write_batch()
+        self.clear_batch()
+        self.finish_records()
+
+    def open_records(self) -> None:
+        raise NotImplementedError
+
+    def write_batch(self) -> None:
+        raise NotImplementedError
+
+    def finish_records(self) -> None:
+        raise NotImplementedError
+
+class CsvIssueWriter(LongFormatIssueWriter):
+    """ Written with pyarrow when it's installed as it's several times faster, otherwise with the csv module. """
+    extension = 'csv'
+
+    def open_records(self) -> None:
+        try:
+            import pyarrow
+            import pyarrow.csv
+            self.pa = pyarrow
+        except ImportError:
+            self.pa = None
+        if self.pa != None:
+            # pyarrow writes the encoded bytes itself
+            self.f = open(self.log_file_path, 'wb')
+            self.f.write((','.join(LONG_FORMAT_FIELDS) + '\n').encode('utf-8'))
+        else:
+            self.f = open(self.log_file_path, 'w', newline='', encoding='utf-8')
+            self.csv_writer = csv.writer(self.f)
+            self.csv_writer.writerow(LONG_FORMAT_FIELDS)
+
+    def write_batch(self) -> None:
+        if self.pa == None:
+            self.csv_writer.writerows(zip(*self.columns()))
+            return
+        pa = self.pa
+        table = pa.Table.from_arrays([pa.array(column, type=pa.int64() if field == 'row_number' else pa.string()) for field, column in zip(LONG_FORMAT_FIELDS, self.columns())], 
+                                     names=list(LONG_FORMAT_FIELDS))
+        pa.csv.write_csv(table, self.f, write_options=pa.csv.WriteOptions(include_header=False))
+
+    def finish_records(self) -> None:
+        self.f.close()
+
+def _json_values(values: list) -> list:
+    """ Encodes values as JSON strings, or null for None. """
+    if None in values:
+        return ['null' if value == None else encode_basestring(value) for value in values]
+    return list(map(encode_basestring, values))
+
+class JsonLinesIssueWriter(LongFormatIssueWriter):
+    extension = 'jsonl'
+
+    def open_records(self) -> None:
+        self.f = open(self.log_file_path, 'w', encoding='utf-8')
+        self.encoded_fields = [encode_basestring(field) for field in self.original_fields]
+
+    def write_batch(self) -> None:
+        # Built directly rather than through json.dumps, the field names never change so only the values need encoding.
+        # The start of each line is shared by every cell of an issue so it's only built once per issue
+        issue_starts = [f'{{"issue_type": "{issue_type}", "row_number": {"null" if row_number == None else row_number}, "key": {key}, "column": ' 
+                        for issue_type, row_number, key in zip(self.issue_types, self.row_numbers, _json_values(self.keys))]
+        encoded_fields = self.encoded_fields
+        self.f.write(''.join([f'{issue_start}{encoded_fields[column_index]}, "original": {original}, "uploaded": {uploaded}}}\n'
+                              for issue_start, column_index, original, uploaded in zip(self.for_each_cell(issue_starts), 
+                                                                                       self.column_indexes, 
+                                                                                       _json_values(self.original_values), 
+                                                                                       _json_values(self.uploaded_values))]))
+
+    def finish_records(self) -> None:
+        self.f.close()
+
+class ParquetIssueWriter(LongFormatIssueWriter):
+    """ Each batch of records is written as a row group. """
+    extension = 'parquet'
+
+    def __init__(self, output_dir: str = "", name: str = None) -> None:
+        super().__init__(output_dir, name)
+        # Imported up front rather than when the first issue is found, so a missing pyarrow is reported before comparing
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError('Parquet output requires pyarrow, install it with "pip install pyarrow".')
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+
+    def open_records(self) -> None:
+        pa = self.pa
+        self.schema = pa.schema([('issue_type', pa.string()), 
+                                 ('row_number', pa.int64()), 
+                                 ('key', pa.string()), 
+                                 ('column', pa.string()), 
+                                 ('original', pa.string()), 
+                                 ('uploaded', pa.string())])
+        self.parquet_writer = self.pq.ParquetWriter(self.log_file_path, self.schema)
+
+    def write_batch(self) -> None:
+        pa = self.pa
+        # Fields are looked up from the column indexes by pyarrow rather than one at a time
+        fields = pa.DictionaryArray.from_arrays(pa.array(self.column_indexes, type=pa.int32()), pa.array(self.original_fields, type=pa.string())).cast(pa.string())
+        columns = [pa.array(self.for_each_cell(self.issue_types), type=pa.string()), 
+                   pa.array(self.for_each_cell(self.row_numbers), type=pa.int64()), 
+                   pa.array(self.for_each_cell(self.keys), type=pa.string()), 
+                   fields, 
+                   pa.array(self.original_values, type=pa.string()), 
+                   pa.array(self.uploaded_values, type=pa.string())]
+        self.parquet_writer.write_table(pa.Table.from_arrays(columns, schema=self.schema))
+
+    def finish_records(self) -> None:
+        self.parquet_writer.close()
+
+ISSUE_WRITERS = {OUTPUT_FORMAT.TEXT: TextIssueWriter,
+                 OUTPUT_FORMAT.EXCEL: ExcelIssueWriter,
+                 OUTPUT_FORMAT.CSV: CsvIssueWriter,
+                 OUTPUT_FORMAT.JSONL: JsonLinesIssueWriter,
+                 OUTPUT_FORMAT.PARQUET: ParquetIssueWriter}
+
+def get_output_format(output_format: OUTPUT_FORMAT = None, use_excel: bool = False) -> OUTPUT_FORMAT:
+    """ The format to write issues in, given as an OUTPUT_FORMAT or its value. Falls back to the use_excel flag if no format is given. """
+    if output_format != None:
+        return OUTPUT_FORMAT(output_format)
+    return OUTPUT_FORMAT.EXCEL if use_excel else OUTPUT_FORMAT.TEXT
+
+def create_issue_writer(output_format: OUTPUT_FORMAT, output_dir: str = "", name: str = None, **excel_options) -> IssueLogWriter:
+    """
+    Args:
+        excel_options: max_rows_per_sheet and max_sheets_per_file of ExcelIssueWriter, ignored by the other formats.
+    """
+    output_format = OUTPUT_FORMAT(output_format)
+    if output_format == OUTPUT_FORMAT.EXCEL:
+        return ExcelIssueWriter(output_dir, name, **excel_options)
+    return ISSUE_WRITERS[output_format](output_dir, name)
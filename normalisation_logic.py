@@ -0,0 +1,132 @@
+"""
+Per column normalisation rules, applied while comparing so files never need a separate cleaning pass.
+
+Rules are a dictionary of column name to the rules for that column, '*' applies to every column. e.g.
+{
+    "*": {"trim": true, "blanks": ["#VALUE!"]},
+    "Country": {"casefold": true, "aliases": {"MY": "Malaysia"}},
+    "Amount": {"numeric_tolerance": 0.01},
+    "Posting Date": {"date": ["%d/%m/%Y", "%Y%m%d"]}
+}
+
+Available rules, applied in this order:
+- trim: Ignore leading and trailing whitespaces.
+- blanks: Values which are treated as an empty cell.
+- remove_trailing_decimal: Remove a trailing '.0' left behind by numbers which were stored as floats.
+- remove_characters: Characters to remove from the value.
+- casefold: Ignore upper and lower case.
+- aliases: Values which mean the same as another value, e.g. {"MY": "Malaysia"}.
+- date: Parse dates and compare them as YYYY-MM-DD. true for the DEFAULT_DATE_FORMATS, or a list of strptime formats.
+- numeric_tolerance: Numbers are equal if they are within this amount of each other.
+
+Presets add rules to the columns they apply to, e.g. {"presets": ["legacy_cleanup"]} cleans the same way as legacy_scripts/clean_document.py.
+Rules given for a column take priority over presets.
+
+Rules are compiled once per sheet into a function per column, columns without rules compare cells as they are.
+"""
+from datetime import datetime
+
+DEFAULT_DATE_FORMATS = ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d', '%d/%m/%Y', '%d.%m.%Y', '%d-%m-%Y', '%Y%m%d']
+# Parts of column names which mark them as holding dates in legacy_cleanup_rules
+DATE_COLUMN_NAME_PARTS = ['calendar', 'date', 'month', 'day', 'year']
+
+def legacy_cleanup_rules(fields: list[str]) -> dict:
+    """ Rules matching the cleaning done by legacy_scripts/clean_document.py for the given fields. """
+    rules = {"*": {"blanks": ["#VALUE!", "0:00:00"]}}
+    for field in fields:
+        if any(part in field.lower() for part in DATE_COLUMN_NAME_PARTS):
+            rules[field] = {"blanks": ["#VALUE!", "0:00:00", "nan"], "remove_trailing_decimal": True, "remove_characters": "."}
+    return rules
+
+PRESETS = {
+    "legacy_cleanup": legacy_cleanup_rules,
+}
+
+def merge_rules(*rule_sets: dict) -> dict:
+    """ Merges rule sets column by column, later rule sets take priority. """
+    merged = {}
+    for rule_set in rule_sets:
+        for column, column_rules in (rule_set or {}).items():
+            merged[column] = {**merged.get(column, {}), **column_rules}
+    return merged
+
+def _compile_normaliser(column_rules: dict):
+    """ Chains a column's rules into a single function which normalises a cell, or None if the column has no normalising rules. """
+    steps = []
+    if column_rules.get("trim"):
+        steps.append(str.strip)
+    if column_rules.get("blanks"):
+        blanks = frozenset(column_rules["blanks"])
+        steps.append(lambda value: u"" if value in blanks else value)
+    if column_rules.get("remove_trailing_decimal"):
+        steps.append(lambda value: value[:-2] if value.endswith('.0') else value)
+    if column_rules.get("remove_characters"):
+        removal_table = str.maketrans('', '', column_rules["remove_characters"])
+        steps.append(lambda value: value.translate(removal_table))
+    if column_rules.get("casefold"):
+        steps.append(str.casefold)
+    if column_rules.get("aliases"):
+        # Aliases are matched after the rules above, so normalise them the same way
+        normalise_alias = _chain(list(steps))
+        aliases = {normalise_alias(alias): normalise_alias(value) for alias, value in column_rules["aliases"].items()}
+        steps.append(lambda value: aliases.get(value, value))
+    if column_rules.get("date"):
+        date_formats = DEFAULT_DATE_FORMATS if column_rules["date"] == True else list(column_rules["date"])
+        steps.append(lambda value: _canonical_date(value, date_formats))
+    if len(steps) == 0:
+        return None
+    return _chain(steps)
+
+def _chain(steps: list):
+    if len(steps) == 1:
+        return steps[0]
+    def normalise(value: str) -> str:
+        for step in steps:
+            value = step(value)
+        return value
+    return normalise
+
+def _canonical_date(value: str, date_formats: list[str]) -> str:
+    for date_format in date_formats:
+        try:
+            return datetime.strptime(value, date_format).date().isoformat()
+        except ValueError:
+            continue
+    return value
+
+def _compile_cells_match(column_rules: dict):
+    """ Returns a function telling if two cells are equal under the column's rules, or None if the column has no rules. """
+    normalise = _compile_normaliser(column_rules)
+    tolerance = column_rules.get("numeric_tolerance")
+    if tolerance == None:
+        if normalise == None:
+            return None
+        return lambda cell_a, cell_b: normalise(cell_a) == normalise(cell_b)
+
+    normalise = normalise or (lambda value: value)
+    def cells_match(cell_a: str, cell_b: str) -> bool:
+        cell_a = normalise(cell_a)
+        cell_b = normalise(cell_b)
+        if cell_a == cell_b:
+            return True
+        try:
+            return abs(float(cell_a) - float(cell_b)) <= tolerance
+        except ValueError:
+            return False
+    return cells_match
+
+def compile_normalisation_rules(fields: list[str], rules: dict) -> list:
+    """
+    Compiles the rules for each field.
+
+    Returns:
+        A list with a function for each field which takes two cells and returns True if they are equal under that field's rules.
+        Fields without any rules have None, their cells can be compared as they are.
+    """
+    rules = rules or {}
+    rules = merge_rules(*[PRESETS[preset](fields) for preset in rules.get("presets", [])], {column: column_rules for column, column_rules in rules.items() if column != "presets"})
+    compiled = []
+    for field in fields:
+        column_rules = merge_rules({"*": rules.get("*", {})}, {"*": rules.get(field, {})})["*"]
+        compiled.append(_compile_cells_match(column_rules))
+    return compiled
@@ -0,0 +1,93 @@
+"""
+Pairs the sheets of an uploaded folder with the sheets of an original folder, and plans the order to compare them in.
+
+Every uploaded sheet is matched to its original sheet by a key taken from both file names, by default the text before the first '-'
+(e.g. "sales-2024.csv" is compared against "sales-master.xlsx"). A regex can be given instead, its first group (or whole match if
+it has no groups) is the key. Every pair is checked before any work starts, so a sheet without an original is reported straight away
+along with every other problem rather than stopping a run halfway through.
+
+Pairs are planned largest first (by the size of both files on disk) so a large file doesn't end up starting last and
+keeping the whole run waiting on it while every other worker sits idle.
+"""
+import os
+import re
+
+# File types which can be compared
+SHEET_EXTENSIONS = ('.csv', '.xlsx')
+# Separator of the key at the start of a file name when no pattern is given
+DEFAULT_PAIRING_SEPARATOR = '-'
+
+class PairingError(ValueError):
+    pass
+
+class FilePair:
+    __slots__ = ('uploaded_file_name', 'uploaded_file_path', 'original_file_path', 'size_bytes')
+
+    def __init__(self, uploaded_file_name: str, uploaded_file_path: str, original_file_path: str, size_bytes: int = 0) -> None:
+        """
+        Args:
+            size_bytes: Combined size of both files, used to plan the largest pairs first.
+        """
+        self.uploaded_file_name = uploaded_file_name
+        self.uploaded_file_path = uploaded_file_path
+        self.original_file_path = original_file_path
+        self.size_bytes = size_bytes
+
+    def __repr__(self) -> str:
+        return f'FilePair({self.uploaded_file_path!r}, {self.original_file_path!r}, {self.size_bytes})'
+
+def sheet_file_names(folder_path: str) -> list[str]:
+    return [item for item in os.listdir(folder_path) if item.endswith(SHEET_EXTENSIONS)]
+
+def pairing_key(file_name: str, pairing_pattern: re.Pattern = None) -> str:
+    """ The key which pairs a file with the file of the same key in the other folder, or None if the pattern doesn't match. """
+    if pairing_pattern == None:
+        return file_name.split(DEFAULT_PAIRING_SEPARATOR)[0]
+    match = pairing_pattern.search(file_name)
+    if match == None:
+        return None
+    return match.group(1) if pairing_pattern.groups else match.group(0)
+
+def plan_file_pairs(uploaded_folder_path: str, original_folder_path: str, pairing_pattern: str = None) -> list[FilePair]:
+    """
+    Pairs every sheet of the uploaded folder with the sheet of the original folder sharing its key, see the top of this file.
+
+    Args:
+        pairing_pattern: Regex taking the key out of each file name, defaults to the text before the first '-'.
+
+    Returns:
+        The FilePairs, largest first. Raises a PairingError listing every uploaded sheet which couldn't be paired,
+        and every key shared by more than one original sheet.
+    """
+    compiled_pattern = re.compile(pairing_pattern) if pairing_pattern else None
+    problems = []
+
+    original_file_paths_hash = {}
+    for item in sorted(sheet_file_names(original_folder_path)):
+        key = pairing_key(item, compiled_pattern)
+        if key == None:
+            continue
+        if key in original_file_paths_hash:
+            problems.append(f'"{item}" and "{os.path.basename(original_file_paths_hash[key])}" are both original files for "{key}".')
+            continue
+        original_file_paths_hash[key] = f'{original_folder_path}/{item}'
+
+    file_pairs = []
+    for uploaded_file_name in sorted(sheet_file_names(uploaded_folder_path)):
+        key = pairing_key(uploaded_file_name, compiled_pattern)
+        if key == None:
+            problems.append(f'"{uploaded_file_name}" does not match the pairing pattern "{pairing_pattern}".')
+            continue
+        if key not in original_file_paths_hash:
+            problems.append(f'"{uploaded_file_name}", cannot find any original file for "{key}".')
+            continue
+        uploaded_file_path = f'{uploaded_folder_path}/{uploaded_file_name}'
+        original_file_path = original_file_paths_hash[key]
+        file_pairs.append(FilePair(uploaded_file_name, uploaded_file_path, original_file_path, os.stat(uploaded_file_path).st_size + os.stat(original_file_path).st_size))
+
+    if len(problems):
+        raise PairingError(f'STOP: {len(problems)} file(s) could not be paired. ' + ' '.join(problems))
+
+    # Largest first, sorted is stable so pairs of the same size stay in name order
+    file_pairs.sort(key=lambda file_pair: file_pair.size_bytes, reverse=True)
+    return file_pairs
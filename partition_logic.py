@@ -0,0 +1,227 @@
+"""
+Compares a single large pair of sheets on every core.
+
+Both sheets are split into buckets by a hash of their identifier in one streaming pass, so all the rows sharing an identifier end
+up in the same pair of buckets. Each pair of buckets is compared in its own worker process with find_discrepancies, then the issues
+of every bucket are merged back into one ISSUES_MAIN in the same order a single comparison would have reported them.
+"""
+import os
+import csv
+import heapq
+import tempfile
+from array import array
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from common_logic import READER_BACKEND, SheetRows, sniff_csv
+from sheet_comparator_logic import ISSUES_MAIN, ISSUE_TYPE, NATURE_OF_ISSUES, RESULT_MODE, Progress, open_sheet, open_sheets, issues_name, check_fields, resolve_identifying_field_indexes, find_discrepancies_instrumented
+from instrumentation_logic import PHASE, Instrumentation, start_phase, finish_phase
+
+# Row numbers are held in memory until this many build up for a bucket, then appended to the bucket's row numbers file
+ROW_NUMBERS_BUFFER_LENGTH = 65536
+# Issues about uploaded rows which were never compared are reported after the issues about original rows
+UPLOADED_ROW_ISSUE_TYPES = (ISSUE_TYPE.EXTRA_ROW, ISSUE_TYPE.DUPLICATE_KEY)
+
+def _recorded_lines(f, lines: list):
+    """ Yields the lines of a file, keeping each line in lines so the raw text of every CSV record can be copied as it is. """
+    for line in f:
+        lines.append(line)
+        yield line
+
+def _raw_records(file_path: str, encoding: str) -> tuple:
+    """
+    Reads a comma separated file, returning its fields and a SheetRows of (row, raw text of the row) for the rest of its rows.
+    Copying the raw text into the buckets is much faster than writing each row back out with the csv module.
+    """
+    f = open(file_path, 'r', encoding=encoding, newline='')
+    try:
+        lines = []
+        csv_reader = csv.reader(_recorded_lines(f, lines))
+        fields = next(csv_reader)
+        lines.clear()
+    except BaseException:
+        f.close()
+        raise
+    def rest():
+        for row in csv_reader:
+            raw_row = ''.join(lines)
+            lines.clear()
+            yield row, raw_row if raw_row.endswith('\n') else raw_row + '\n'
+    return fields, SheetRows(rest(), f.close)
+
+def _sheet_records(file_path: str, reader_backend: READER_BACKEND = READER_BACKEND.AUTO, snapshot_cache = None, sheet_name: str = None) -> tuple:
+    """ Opens a sheet as its fields and a SheetRows of (row, raw text of the row, or None if the row has to be written out as CSV). """
+    if file_path.split('.')[-1] == 'csv':
+        encoding, delimiter, _ = sniff_csv(file_path)
+        # Buckets are always comma separated, so other delimiters are written back out with the csv module
+        if delimiter == ',':
+            return _raw_records(file_path, encoding)
+    fields, rows = open_sheet(file_path, reader_backend, snapshot_cache, sheet_name)
+    return fields, SheetRows(((row, None) for row in rows), rows.close)
+
+def partition_sheet(file_path: str, identifying_field_index: int, num_partitions: int, partition_dir: str, prefix: str, reader_backend: READER_BACKEND = READER_BACKEND.AUTO, snapshot_cache = None, sheet_name: str = None) -> tuple:
+    """
+    Splits the rows of a sheet into num_partitions CSV files by the hash of their identifier.
+
+    Returns:
+        (CSV file path, row numbers file path) of each bucket, and the number of rows split. 
+        The row numbers file holds the row number in the whole sheet of each row in the bucket.
+    """
+    fields, records = _sheet_records(file_path, reader_backend, snapshot_cache, sheet_name)
+    partition_paths = [(os.path.join(partition_dir, f'{prefix}_{i}.csv'), os.path.join(partition_dir, f'{prefix}_{i}.rows')) for i in range(num_partitions)]
+    bucket_files = [open(csv_path, 'w', encoding='utf-8', newline='') for csv_path, _ in partition_paths]
+    row_numbers_files = [open(row_numbers_path, 'wb') for _, row_numbers_path in partition_paths]
+    try:
+        csv_writers = [csv.writer(f) for f in bucket_files]
+        for csv_writer in csv_writers:
+            csv_writer.writerow(fields)
+        row_numbers = [array('Q') for _ in range(num_partitions)]
+        row_num = -1
+        for row_num, (row, raw_row) in enumerate(records):
+            partition = hash(row[identifying_field_index]) % num_partitions
+            if raw_row != None:
+                bucket_files[partition].write(raw_row)
+            else:
+                csv_writers[partition].writerow(row)
+            row_numbers[partition].append(row_num)
+            if len(row_numbers[partition]) >= ROW_NUMBERS_BUFFER_LENGTH:
+                row_numbers[partition].tofile(row_numbers_files[partition])
+                row_numbers[partition] = array('Q')
+        for partition in range(num_partitions):
+            row_numbers[partition].tofile(row_numbers_files[partition])
+    finally:
+        records.close()
+        for f in bucket_files + row_numbers_files:
+            f.close()
+    return partition_paths, row_num + 1
+
+def _load_row_numbers(row_numbers_path: str) -> array:
+    row_numbers = array('Q')
+    with open(row_numbers_path, 'rb') as f:
+        row_numbers.fromfile(f, os.path.getsize(row_numbers_path) // row_numbers.itemsize)
+    return row_numbers
+
+def _compare_partition(uploaded_partition: tuple, original_partition: tuple, instrument: bool, comparison_options: dict) -> tuple:
+    """ 
+    Compares a pair of buckets in a worker process, giving each issue its row number in the whole sheet rather than in the bucket.
+
+    Returns:
+        The ISSUES_MAIN and the PhaseRecords measured, see find_discrepancies_instrumented.
+    """
+    issues, phase_records = find_discrepancies_instrumented(instrument, uploaded_file_path=uploaded_partition[0], original_file_path=original_partition[0], **comparison_options)
+    uploaded_row_numbers = _load_row_numbers(uploaded_partition[1])
+    original_row_numbers = _load_row_numbers(original_partition[1])
+    for issue in issues.issue_list:
+        if issue.issue_type in UPLOADED_ROW_ISSUE_TYPES:
+            issue.row_number = uploaded_row_numbers[issue.row_number]
+        else:
+            issue.row_number = original_row_numbers[issue.row_number]
+    return issues, phase_records
+
+def find_discrepancies_partitioned(uploaded_file_path: str,
+                                   original_file_path: str,
+                                   progress_to_show_in_gui = None,
+                                   status_to_show_in_gui = None,
+                                   uploaded_file_identifying_field_index: int = 0,
+                                   original_file_identifying_field_index: int = 0,
+                                   num_partitions: int = None,
+                                   max_workers: int = None,
+                                   temp_dir: str = None,
+                                   result_mode: RESULT_MODE = RESULT_MODE.FULL,
+                                   max_issues: int = None,
+                                   issue_sink = None,
+                                   instrumentation: Instrumentation = None,
+                                   **comparison_options) -> ISSUES_MAIN:
+    """
+    Finds the difference between two sheets by comparing buckets of both sheets in parallel worker processes, see find_discrepancies.
+    Each bucket is compared with the engine given in comparison_options.
+
+    Args:
+        num_partitions: Number of buckets to split each sheet into, defaults to the number of cores.
+        max_workers: Number of worker processes to use, defaults to the number of cores.
+        temp_dir: Folder to write the buckets to, defaults to the system's temporary folder.
+        result_mode: Each bucket stops after max_issues of its own in the STOP_AFTER and FIRST_MISMATCH modes, 
+            the first max_issues of the merged issues are kept.
+        instrumentation: Records the time spent splitting the sheets, and the phases of comparing each pair of buckets.
+    """
+    num_partitions = max(1, num_partitions or os.cpu_count())
+
+    # Only the fields are read here, the rows are read while splitting the sheets
+    fields_uploaded_csv, uploaded_rows, fields_ori_csv, ori_rows = open_sheets(uploaded_file_path, 
+                                                                               original_file_path, 
+                                                                               comparison_options.get("reader_backend", READER_BACKEND.AUTO), 
+                                                                               comparison_options.get("snapshot_cache"),
+                                                                               uploaded_sheet_name=comparison_options.get("uploaded_sheet_name"),
+                                                                               original_sheet_name=comparison_options.get("original_sheet_name"))
+    uploaded_rows.close()
+    ori_rows.close()
+
+    # Initialise issues custom class to hold all the found issues (if any)
+    issues = ISSUES_MAIN()
+    issues.name = issues_name(original_file_path, comparison_options.get("original_sheet_name"))
+    issues.original_identifying_field_index = original_file_identifying_field_index
+    issues.original_fields = fields_ori_csv
+    issues.uploaded_fields = fields_uploaded_csv
+    issues.set_result_mode(result_mode, max_issues)
+    issues.issue_sink = issue_sink
+
+    # Every bucket has the same fields, so they only need checking once
+    if not check_fields(issues):
+        return issues
+    uploaded_file_identifying_field_index, original_file_identifying_field_index = resolve_identifying_field_indexes(issues, uploaded_file_identifying_field_index, original_file_identifying_field_index)
+    issues.update_uploaded_hashed_fields_idxs()
+
+    with tempfile.TemporaryDirectory(dir=temp_dir, prefix='sheet_comparator_') as partition_dir:
+        # Update status
+        if status_to_show_in_gui:
+            status_to_show_in_gui(f'Splitting sheets {issues.name} into {num_partitions} parts')
+        if progress_to_show_in_gui != None:
+            progress_to_show_in_gui(0)
+        phase = start_phase(instrumentation, PHASE.SPLIT, issues.name)
+        uploaded_partitions, uploaded_row_count = partition_sheet(uploaded_file_path, uploaded_file_identifying_field_index, num_partitions, partition_dir, 'uploaded', comparison_options.get("reader_backend", READER_BACKEND.AUTO), sheet_name=comparison_options.get("uploaded_sheet_name"))
+        original_partitions, ori_row_count = partition_sheet(original_file_path, original_file_identifying_field_index, num_partitions, partition_dir, 'original', comparison_options.get("reader_backend", READER_BACKEND.AUTO), comparison_options.get("snapshot_cache"), comparison_options.get("original_sheet_name"))
+        finish_phase(instrumentation, phase, rows=uploaded_row_count + ori_row_count)
+
+        # Update status
+        if status_to_show_in_gui:
+            status_to_show_in_gui(f'Comparing sheet {issues.name}')
+
+        comparison_options = {**comparison_options,
+                              "result_mode": result_mode,
+                              "max_issues": max_issues,
+                              "uploaded_file_identifying_field_index": uploaded_file_identifying_field_index,
+                              "original_file_identifying_field_index": original_file_identifying_field_index}
+        p = Progress(num_partitions, progress_to_show_in_gui)
+        partition_issues: list[ISSUES_MAIN] = []
+        with ProcessPoolExecutor(max_workers=min(num_partitions, max_workers or os.cpu_count())) as executor:
+            futures = {executor.submit(_compare_partition, uploaded_partition, original_partition, instrumentation != None, comparison_options): partition
+                       for partition, (uploaded_partition, original_partition) in enumerate(zip(uploaded_partitions, original_partitions))}
+            for future in as_completed(futures):
+                try:
+                    bucket_issues, phase_records = future.result()
+                except Exception as e:
+                    # Don't start any more comparisons, the run has failed
+                    for pending_future in futures:
+                        pending_future.cancel()
+                    raise RuntimeError(f'STOP: part {futures[future]} of "{issues.name}" could not be compared. {type(e).__name__}: {e}') from e
+                partition_issues.append(bucket_issues)
+                for phase_record in phase_records:
+                    instrumentation.add(phase_record)
+                p.update_progress()
+
+    if issues.keep_rows:
+        # Each bucket's issues are already in order, so merging them puts every issue back in the order of the whole sheet
+        for issue in heapq.merge(*[item.issue_list for item in partition_issues],
+                                 key=lambda issue: (issue.issue_type in UPLOADED_ROW_ISSUE_TYPES, issue.row_number)):
+            issues.add_issue(issue)
+            if issues.limit_reached:
+                break
+    else:
+        for item in partition_issues:
+            issues.add_counts(item)
+
+    # Mark issues found
+    if issues.issue_count: issues.nature_of_issues.append(NATURE_OF_ISSUES.DISCREPANCY)
+
+    if status_to_show_in_gui:
+        status_to_show_in_gui(f'Finished comparing {issues.name}')
+
+    return issues
@@ -0,0 +1,183 @@
+"""
+Compares folders of sheets and writes their issue logs as one pipeline.
+
+Every finished comparison goes straight to a small pool of writer threads and its issues are released as soon as its log is written,
+so comparing the next file pairs overlaps with writing the logs of the last ones. No more than max_in_flight results are held at once,
+counting those being compared and those waiting for or being written, new comparisons only start once earlier results are written.
+Memory then stays bounded however many files are in the folders, rather than holding every ISSUES_MAIN until the whole folder is compared.
+"""
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from common_logic import READER_BACKEND
+from instrumentation_logic import Instrumentation
+from issue_writer_logic import OUTPUT_FORMAT
+from pairing_logic import plan_file_pairs
+from sheet_comparator_logic import ISSUES_MAIN, COMPARISON_ENGINE, RESULT_MODE, Progress, find_discrepancies, find_discrepancies_instrumented, result_cache_key, write_issues
+
+# Number of writer threads, writing is mostly waiting on the disk so a couple is enough to keep up with the comparisons
+NUM_WRITERS = 2
+
+def _compare_in_thread(instrumentation: Instrumentation, **comparison_options) -> tuple:
+    """ Same result as find_discrepancies_instrumented, but records straight into the caller's Instrumentation. """
+    return find_discrepancies(instrumentation=instrumentation, **comparison_options), []
+
+def compare_and_write_csv_folders(uploaded_folder_path: str,
+                                  original_folder_path: str,
+                                  output_dir: str = "",
+                                  progress_to_show_in_gui = None,
+                                  status_to_show_in_gui = None,
+                                  output_to_excel: bool = False,
+                                  output_format: OUTPUT_FORMAT = None,
+                                  use_processes: bool = False,
+                                  max_workers: int = None,
+                                  max_in_flight: int = None,
+                                  result_cache = None,
+                                  uploaded_file_identifying_field_index: int = 0,
+                                  original_file_identifying_field_index: int = 0,
+                                  ignore_leading_and_trailing_whitespaces: bool = False,
+                                  comparison_engine: COMPARISON_ENGINE = COMPARISON_ENGINE.HASH,
+                                  memory_budget_mb: int = 256,
+                                  normalisation_rules: dict = None,
+                                  full_outer_diff: bool = True,
+                                  result_mode: RESULT_MODE = RESULT_MODE.FULL,
+                                  max_issues: int = None,
+                                  pairing_pattern: str = None,
+                                  reader_backend: READER_BACKEND = READER_BACKEND.AUTO,
+                                  snapshot_cache = None,
+                                  instrumentation: Instrumentation = None) -> tuple:
+    """
+    Compares every sheet in the uploaded folder against the original sheet sharing its prefix (text before the first '-') like compare_csv_folders,
+    writing the issue log of each file pair into a new folder in output_dir like write_multiple_issues as soon as the pair is compared.
+    Every pair is found before comparing any, and the largest pairs are compared first, see pairing_logic.
+
+    Args:
+        use_processes: Compare each file pair in a worker process instead of a thread, see compare_csv_folders.
+        max_workers: Number of file pairs to compare at once, defaults to the number of cores.
+        max_in_flight: Most results to hold at once, defaults to twice max_workers so the workers never wait on the writers.
+        result_cache: A cache_logic.ResultCache, file pairs which are unchanged since their result was cached go straight to being written.
+        snapshot_cache: A cache_logic.SnapshotCache, original Excel sheets shared by several uploaded sheets are only parsed once.
+        pairing_pattern: Regex taking the key which pairs the sheets out of each file name instead of the prefix, see plan_file_pairs.
+
+    Returns:
+        A list of ISSUES_MAIN, one per uploaded file in the order they were written, and the folder the issue logs were written to
+        or None if no file pair had issues. Each ISSUES_MAIN still counts its issues, but no longer holds them once they're written.
+    """
+    if status_to_show_in_gui:
+        status_to_show_in_gui('Processing files.')
+
+    # Pair every sheet up front, largest first so the biggest pairs don't hold up the end of the run
+    file_pairs = plan_file_pairs(uploaded_folder_path, original_folder_path, pairing_pattern)
+
+    comparison_options = {"uploaded_file_identifying_field_index": uploaded_file_identifying_field_index,
+                          "original_file_identifying_field_index": original_file_identifying_field_index,
+                          "ignore_leading_and_trailing_whitespaces": ignore_leading_and_trailing_whitespaces,
+                          "comparison_engine": COMPARISON_ENGINE(comparison_engine),
+                          "memory_budget_mb": memory_budget_mb,
+                          "normalisation_rules": normalisation_rules,
+                          "full_outer_diff": full_outer_diff,
+                          "result_mode": result_mode,
+                          "max_issues": max_issues,
+                          "reader_backend": reader_backend,
+                          "snapshot_cache": snapshot_cache}
+    p = Progress(len(file_pairs), progress_to_show_in_gui)
+    num_workers = max(1, min(len(file_pairs), max_workers or os.cpu_count()))
+    max_in_flight = max(1, max_in_flight or num_workers*2)
+    folder_path_for_job = f'{output_dir}/issues_{time.strftime("%Y_%m_%d_%H_%M_%S", time.gmtime())}'
+    wrote_any_issues = False
+    # Logs are named after their original sheet, uploaded sheets sharing an original are numbered so two writers never share a log
+    used_log_names = set()
+
+    def write(issues: ISSUES_MAIN) -> str:
+        # The folder is only created once there's something to put in it
+        if len(issues.issue_list):
+            os.makedirs(folder_path_for_job, exist_ok=True)
+        log_file_path = write_issues(issues, output_dir=folder_path_for_job, use_excel=output_to_excel, instrumentation=instrumentation, output_format=output_format)
+        # Release the issues now they're written, the counts are kept for the caller
+        issues.issue_list = []
+        return log_file_path
+
+    def submit_write(issues: ISSUES_MAIN, uploaded_file_name: str) -> None:
+        name = issues.name
+        duplicate_num = 1
+        while issues.name in used_log_names:
+            duplicate_num += 1
+            issues.name = f'{name}_{duplicate_num}'
+        used_log_names.add(issues.name)
+        write_futures[write_executor.submit(write, issues)] = (issues, uploaded_file_name)
+
+    if use_processes:
+        # Only imported when processes are used, starting up is much faster without it
+        from concurrent.futures import ProcessPoolExecutor
+        compare_executor = ProcessPoolExecutor(max_workers=num_workers)
+        compare = find_discrepancies_instrumented
+        instrument = instrumentation != None
+    else:
+        compare_executor = ThreadPoolExecutor(max_workers=num_workers)
+        compare = _compare_in_thread
+        instrument = instrumentation
+
+    issues_list: list[ISSUES_MAIN] = []
+    # Futures of the results being compared, mapped to the name of their uploaded file
+    compare_futures = {}
+    # Futures of the results being written, mapped to the ISSUES_MAIN and the name of its uploaded file
+    write_futures = {}
+    cache_keys = {}
+    pending_file_pairs = iter(file_pairs)
+    with compare_executor, ThreadPoolExecutor(max_workers=NUM_WRITERS) as write_executor:
+        try:
+            while True:
+                # Start comparing more file pairs while there's room, cached results skip straight to being written
+                while len(compare_futures) + len(write_futures) < max_in_flight:
+                    file_pair = next(pending_file_pairs, None)
+                    if file_pair == None:
+                        break
+                    if result_cache != None:
+                        cache_keys[file_pair.uploaded_file_name] = result_cache_key(result_cache, file_pair.uploaded_file_path, file_pair.original_file_path, comparison_options)
+                        cached_issues = result_cache.get(cache_keys[file_pair.uploaded_file_name])
+                        if cached_issues != None:
+                            submit_write(cached_issues, file_pair.uploaded_file_name)
+                            continue
+                    compare_futures[compare_executor.submit(compare,
+                                                            instrument,
+                                                            uploaded_file_path=file_pair.uploaded_file_path,
+                                                            original_file_path=file_pair.original_file_path,
+                                                            **comparison_options)] = file_pair.uploaded_file_name
+                if len(compare_futures) + len(write_futures) == 0:
+                    break
+
+                done, _ = wait([*compare_futures, *write_futures], return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in compare_futures:
+                        uploaded_file_name = compare_futures.pop(future)
+                        try:
+                            issues, phase_records = future.result()
+                        except Exception as e:
+                            raise RuntimeError(f'STOP: "{uploaded_file_name}" could not be compared. {type(e).__name__}: {e}') from e
+                        for phase_record in phase_records:
+                            instrumentation.add(phase_record)
+                        if result_cache != None:
+                            result_cache.put(cache_keys[uploaded_file_name], issues)
+                        submit_write(issues, uploaded_file_name)
+                    else:
+                        issues, uploaded_file_name = write_futures.pop(future)
+                        try:
+                            log_file_path = future.result()
+                        except Exception as e:
+                            raise RuntimeError(f'STOP: the issues of "{uploaded_file_name}" could not be written. {type(e).__name__}: {e}') from e
+                        wrote_any_issues = wrote_any_issues or log_file_path != None
+                        issues_list.append(issues)
+                        p.update_progress()
+        except BaseException:
+            # Don't start any more comparisons, the run has failed
+            for future in compare_futures:
+                future.cancel()
+            raise
+
+    if not wrote_any_issues:
+        if status_to_show_in_gui != None:
+            status_to_show_in_gui(f'Done! No issues found ᕙ(⇀‸↼‶)ᕗ')
+        return issues_list, None
+    if status_to_show_in_gui != None:
+        status_to_show_in_gui(f'Done! Check {folder_path_for_job}.')
+    return issues_list, folder_path_for_job
@@ -0,0 +1,44 @@
+"""
+Carries progress from the comparison to the GUI without the comparison ever touching Tk.
+
+Engines and worker threads post to a ProgressBus, which only keeps the latest event of each kind. The GUI drains the bus on its
+own thread with Tk's after() timer, so however often the workers post the widgets are updated at most once a frame.
+"""
+from enum import Enum
+
+# How often the GUI drains the bus, about 30 frames a second
+GUI_FRAME_MS = 33
+
+class PROGRESS_EVENT(Enum):
+    PROGRESS = "progress" # Percentage for the progress bar
+    STATUS = "status" # Text for the status label
+    FINISHED = "finished" # The comparison has finished, successfully or not
+
+class ProgressBus:
+    def __init__(self) -> None:
+        # Latest value of each kind of event, posting overwrites the previous value so events are coalesced as they are posted.
+        # Setting and popping a single key of a dict are atomic, so no lock is needed between the workers and the GUI.
+        self.pending_events = {}
+
+    def post_progress(self, progress_value: float) -> None:
+        self.pending_events[PROGRESS_EVENT.PROGRESS] = progress_value
+
+    def post_status(self, status: str) -> None:
+        self.pending_events[PROGRESS_EVENT.STATUS] = status
+
+    def post_finished(self) -> None:
+        self.pending_events[PROGRESS_EVENT.FINISHED] = True
+
+    def drain(self) -> dict:
+        """
+        Takes the events posted since the last drain.
+
+        Returns:
+            The latest value of each kind of event which was posted, events posted while draining are kept for the next drain.
+        """
+        events = {}
+        for event in PROGRESS_EVENT:
+            value = self.pending_events.pop(event, None)
+            if value != None:
+                events[event] = value
+        return events
@@ -1,5 +1,5 @@
 import pandas as pd
-import Levenshtein
+import numpy as np
 import os
 from enum import Enum
 
@@ -20,6 +20,101 @@ def merge_dfs(df1: pd.DataFrame, df2: pd.DataFrame, df1_identifier_column: str,
     resulting_df = pd.merge(df1, df2, how='left', left_on=df1_identifier_column, right_on=df1_identifier_column, suffixes=('', '_removeMe')) 
     return resulting_df
 
+class JoinPlan:
+    """
+    Where each column of a combined sheet comes from, worked out from the column names alone before any rows are touched.
+    Sheets are numbered 0 for the primary sheet, then from 1 for each joined sheet in order.
+
+    Attributes:
+        join_keys: (sheet number, column) of the left identifier column of each join.
+        output_columns: Final column name mapped to the (sheet number, column) it's taken from, or None if no sheet has it.
+    """
+    def __init__(self, join_keys: list[tuple], output_columns: dict) -> None:
+        self.join_keys = join_keys
+        self.output_columns = output_columns
+
+    def __repr__(self) -> str:
+        return f'JoinPlan({self.join_keys!r}, {self.output_columns!r})'
+
+def plan_joins(primary_df: pd.DataFrame, joins: list[tuple], column_mapping: dict) -> JoinPlan:
+    """
+    Plans a chain of left joins the same way chaining merge_dfs and then renaming, dropping and reordering the columns would, see combine_dataframes.
+    Each column belongs to the first sheet which has it, a joined sheet's identifier column never adds a column of its own.
+    """
+    column_sheets = {column: 0 for column in primary_df.columns}
+    join_keys = []
+    for sheet_num, (df, left_identifier_column, right_identifier_column) in enumerate(joins, start=1):
+        if left_identifier_column not in column_sheets:
+            raise ValueError(f'STOP: join {sheet_num} is on "{left_identifier_column}", which is not a column of the primary sheet or any sheet joined before it.')
+        if right_identifier_column not in df.columns:
+            raise ValueError(f'STOP: join {sheet_num} is on "{right_identifier_column}", which is not a column of its sheet.')
+        join_keys.append((column_sheets[left_identifier_column], left_identifier_column))
+        for column in df.columns:
+            if column != right_identifier_column and column not in column_sheets:
+                column_sheets[column] = sheet_num
+
+    output_columns = {}
+    for final_column, source_column in column_mapping.items():
+        # A column which is already named as it should be is kept when there's nothing to rename to it
+        column = source_column if source_column in column_sheets else final_column
+        output_columns[final_column] = (column_sheets[column], column) if column in column_sheets else None
+    return JoinPlan(join_keys, output_columns)
+
+def _take(series: pd.Series, positions: np.ndarray) -> pd.Series:
+    """ Values of a column at each position, blank (NaN) where the position is -1. """
+    values = series.array.take(positions, allow_fill=True)
+    # Keep the dtype, else pandas would infer one and turn the None of object columns into NaN where merge_dfs keeps them
+    return pd.Series(values, dtype=values.dtype)
+
+def _lookup_keys(keys) -> np.ndarray:
+    """ Keys as an object array with every blank (None, NaN or NA) as NaN, get_indexer only matches NaN to NaN where a merge matches any blank to any other. """
+    keys = np.asarray(keys, dtype=object)
+    return np.where(pd.isna(keys), np.nan, keys)
+
+def combine_dataframes(primary_df: pd.DataFrame, joins: list[tuple], column_mapping: dict) -> pd.DataFrame:
+    """
+    Left joins sheets onto a primary sheet and keeps only the columns in column_mapping, in its order.
+    Gives the same result as chaining merge_dfs for each join then renaming, dropping and reordering the columns, without copying the
+    growing sheet at every join. Each join only matches row positions, then every final column is copied once from the sheet it comes
+    from, so memory and time scale with the final sheet rather than with the number of joins.
+
+    Args:
+        joins: (sheet, left identifier column, right identifier column) of each sheet to join, in order. The left identifier column may come from
+            the primary sheet or any sheet joined before it. Like a merge, a key matching more than one row repeats the row for each match.
+        column_mapping: Final column name mapped to the column of the joined sheets it's taken from.
+    """
+    plan = plan_joins(primary_df, joins, column_mapping)
+    dataframes = [primary_df] + [df for df, _, _ in joins]
+
+    # Position in each sheet of every row of the combined sheet, -1 where a join found no match
+    row_positions = [np.arange(len(primary_df))]
+    for (df, _, right_identifier_column), (key_sheet_num, left_identifier_column) in zip(joins, plan.join_keys):
+        left_keys = _take(dataframes[key_sheet_num][left_identifier_column], row_positions[key_sheet_num]).array
+        right_keys = df[right_identifier_column]
+        if right_keys.is_unique:
+            if left_keys.dtype == object or right_keys.dtype == object:
+                left_keys, right_keys = _lookup_keys(left_keys), _lookup_keys(right_keys)
+            # Each lookup index is only built once per join
+            row_positions.append(pd.Index(right_keys).get_indexer(left_keys))
+            continue
+        # Keys repeated in the joined sheet, match the positions with a merge so repeated matches come out in the same order merge_dfs gives
+        matches = pd.merge(pd.DataFrame({"key": left_keys, "row": np.arange(len(left_keys))}),
+                           pd.DataFrame({"key": right_keys.array, "position": np.arange(len(df))}),
+                           how='left', on='key', sort=False)
+        rows = matches["row"].to_numpy()
+        row_positions = [positions[rows] for positions in row_positions]
+        row_positions.append(matches["position"].fillna(-1).to_numpy(dtype=np.int64))
+
+    num_rows = len(row_positions[0])
+    columns = {}
+    for final_column, source in plan.output_columns.items():
+        if source == None:
+            columns[final_column] = np.full(num_rows, np.nan)
+            continue
+        sheet_num, column = source
+        columns[final_column] = _take(dataframes[sheet_num][column], row_positions[sheet_num])
+    return pd.DataFrame(columns, columns=list(plan.output_columns))
+
 def find_nearest_string(target: str, list_of_strings: list[str]) -> str:
     """
     Finds the closest string in a list of strings with a combination of the Levenshtein distance and string size consistency.
@@ -32,6 +127,8 @@ def find_nearest_string(target: str, list_of_strings: list[str]) -> str:
     if target in list_of_strings:
         return target
 
+    # Only needed for fuzzy matching, so it isn't imported until a name doesn't match exactly
+    import Levenshtein
     max_len_of_str = max(len(item) for item in list_of_strings)
 
     score = []
@@ -76,15 +173,14 @@ if __name__ == "__main__":
     # for dataframe in dataframes:
     #     print(dataframe.filename)
 
-    # Using the primary dataframe, start to merge with the others 
-    # Return the merged dataframe
-    master_df = merge_dfs(df1=primary_dataframe.df, df2=dataframes[4].df, df1_identifier_column='Customer', df2_identifier_column='Customer')
-    master_df = merge_dfs(df1=master_df, df2=dataframes[2].df, df1_identifier_column='Address', df2_identifier_column='Address number')
-    master_df = merge_dfs(df1=master_df, df2=dataframes[0].df, df1_identifier_column='Address', df2_identifier_column='Address number')
-    master_df = merge_dfs(df1=master_df, df2=dataframes[1].df, df1_identifier_column='Address', df2_identifier_column='Address number')
-    master_df = merge_dfs(df1=master_df, df2=dataframes[3].df, df1_identifier_column='Customer', df2_identifier_column='Customer')
+    # Using the primary dataframe, join the others onto it
+    joins = [(dataframes[4].df, 'Customer', 'Customer'),
+             (dataframes[2].df, 'Address', 'Address number'),
+             (dataframes[0].df, 'Address', 'Address number'),
+             (dataframes[1].df, 'Address', 'Address number'),
+             (dataframes[3].df, 'Customer', 'Customer')]
     
-    # Rename the columns
+    # Final columns, mapped to the column they're taken from
     column_mapping = {
         "Customer": "Customer",
         "Company Code": "Company Code",
@@ -110,15 +206,7 @@ if __name__ == "__main__":
         "Buyer’s Address - Country": "Country",
         "Buyer’s Contact Number": "Telephone number"
     }
-    final_columns = [column for column in column_mapping]
-    # Rename
-    for column in column_mapping:
-        master_df = master_df.rename(columns={column_mapping[column]: column})
-    # Remove any not used columns 
-    for column in list(master_df.columns):
-        if column not in final_columns: 
-            master_df = master_df.drop(column, axis=1)
-    # Order columns correctly 
-    master_df = master_df.reindex(columns=final_columns)
+    # Only the final columns are copied, in one pass once every join is matched
+    master_df = combine_dataframes(primary_dataframe.df, joins, column_mapping)
     # Output
     master_df.to_excel('result.xlsx', index=False)
\ No newline at end of file
@@ -0,0 +1,477 @@
+"""
+Runs comparisons without the GUI, e.g. from cron.
+
+A manifest lists the file or folder pairs to compare and their options, as JSON:
+{
+    "output_dir": "issue_logs",
+    "output_format": "csv",
+    "use_result_cache": true,
+    "use_snapshot_cache": true,
+    "defaults": {"ignore_leading_and_trailing_whitespaces": true},
+    "jobs": [
+        {"name": "customers", "uploaded": "exports/customers.csv", "original": "source/customers.xlsx", "comparison_engine": "external_sort"},
+        {"name": "daily", "uploaded": "exports/daily", "original": "source/daily"}
+    ]
+}
+Relative paths are relative to the manifest's folder. A job's options override the defaults, which override the manifest's own settings,
+see JOB_COMPARISON_OPTIONS for the options. output_format is one of OUTPUT_FORMAT's values (text by default), output_to_excel: true
+is the same as "excel". use_snapshot_cache keeps the parsed rows of original Excel sheets so they're only parsed again once they change.
+Folder jobs may set a pairing_pattern regex to pair their sheets by, see pairing_logic.
+Jobs comparing two workbooks compare their active sheets, or the uploaded_sheet_name and original_sheet_name. With compare_all_sheets
+every sheet is compared, paired by name or by a sheet_mapping of original sheet names to uploaded sheet names, and written into one
+report folder, see workbook_logic. Workbook jobs don't use the result cache.
+Single file pairs are compared in parallel worker processes, folder pairs compare their own file pairs in parallel one folder at a time.
+
+A JSON summary of each job is printed to stdout as a line as soon as it finishes, followed by a summary of the whole run.
+Status messages go to stderr.
+
+Run like so:
+python sheet_comparator_cli.py run manifest.json
+python sheet_comparator_cli.py compare uploaded.csv original.csv --output-dir issue_logs
+python sheet_comparator_cli.py clear-cache
+"""
+import os
+import re
+import sys
+import json
+import time
+import argparse
+from enum import IntEnum
+from instrumentation_logic import Instrumentation, JsonLinesWriter
+from common_logic import READER_BACKEND
+from issue_writer_logic import OUTPUT_FORMAT
+from pipeline_logic import compare_and_write_csv_folders
+from workbook_logic import compare_and_write_workbooks
+from sheet_comparator_logic import ISSUES_MAIN, COMPARISON_ENGINE, RESULT_MODE, find_discrepancies, find_and_write_discrepancies, find_discrepancies_instrumented, result_cache_key, write_issues
+
+class EXIT_CODE(IntEnum):
+    NO_ISSUES = 0 # Every job ran and found no issues
+    ISSUES_FOUND = 1 # Every job ran and at least one found issues
+    USAGE_ERROR = 2 # The arguments or the manifest are invalid, nothing was compared
+    JOB_FAILED = 3 # At least one job could not be run, takes precedence over ISSUES_FOUND
+
+# Options of find_discrepancies which a job may set, folder jobs can't split a pair into partitions, use row digests, index the uploaded sheet by offset or pick sheets
+JOB_COMPARISON_OPTIONS = ('uploaded_file_identifying_field_index',
+                          'original_file_identifying_field_index',
+                          'ignore_leading_and_trailing_whitespaces',
+                          'comparison_engine',
+                          'memory_budget_mb',
+                          'use_row_digests',
+                          'use_offset_index',
+                          'normalisation_rules',
+                          'full_outer_diff',
+                          'num_partitions',
+                          'result_mode',
+                          'max_issues',
+                          'reader_backend',
+                          'uploaded_sheet_name',
+                          'original_sheet_name')
+FILE_ONLY_OPTIONS = ('use_row_digests', 'use_offset_index', 'num_partitions', 'uploaded_sheet_name', 'original_sheet_name')
+# Options workbook jobs can't use, their sheets are picked by pairing and each sheet pair already has its own worker process
+SINGLE_SHEET_OPTIONS = ('num_partitions', 'uploaded_sheet_name', 'original_sheet_name')
+# Settings of a job which aren't passed on to the comparison
+JOB_SETTINGS = ('name', 'uploaded', 'original', 'output_dir', 'output_to_excel', 'output_format', 'use_result_cache', 'use_snapshot_cache', 'pairing_pattern', 'compare_all_sheets', 'sheet_mapping')
+
+class ManifestError(ValueError):
+    pass
+
+def load_manifest(manifest_path: str) -> list[dict]:
+    """
+    Reads and checks a manifest.
+
+    Returns:
+        Every job with its paths resolved and the manifest's settings and defaults filled in.
+    """
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        raise ManifestError(f'Cannot read manifest {manifest_path}. {type(e).__name__}: {e}') from e
+    if not isinstance(manifest, dict) or not isinstance(manifest.get("jobs"), list) or len(manifest["jobs"]) == 0:
+        raise ManifestError(f'Manifest {manifest_path} must be an object with a non-empty list of "jobs".')
+    return resolve_jobs(manifest, os.path.dirname(os.path.abspath(manifest_path)))
+
+def resolve_jobs(manifest: dict, base_dir: str) -> list[dict]:
+    """ Fills in each job of a manifest's dict with the manifest's settings and defaults, see load_manifest. """
+    manifest_settings = {setting: manifest[setting] for setting in ('output_dir', 'output_to_excel', 'output_format', 'use_result_cache', 'use_snapshot_cache') if setting in manifest}
+    defaults = manifest.get("defaults", {})
+    jobs = []
+    used_names = set()
+    for job_num, job in enumerate(manifest["jobs"]):
+        if not isinstance(job, dict):
+            raise ManifestError(f'Job {job_num} must be an object.')
+        job = {"output_dir": ".", "output_to_excel": False, "output_format": None, "use_result_cache": False, "use_snapshot_cache": False, **manifest_settings, **defaults, **job}
+        unknown_options = [option for option in job if option not in JOB_SETTINGS and option not in JOB_COMPARISON_OPTIONS]
+        if len(unknown_options):
+            raise ManifestError(f'Job {job_num} has unknown options {unknown_options}.')
+        for setting in ('uploaded', 'original'):
+            if not isinstance(job.get(setting), str):
+                raise ManifestError(f'Job {job_num} must have the path of the "{setting}" sheet or folder.')
+            job[setting] = os.path.join(base_dir, os.path.expanduser(job[setting]))
+        job["output_dir"] = os.path.join(base_dir, os.path.expanduser(job["output_dir"]))
+        # Issue logs are named after their job, so every job gets a unique name
+        name = str(job.get("name", os.path.splitext(os.path.basename(job["original"].rstrip('/\\')))[0]))
+        job["name"] = name
+        duplicate_num = 1
+        while job["name"] in used_names:
+            duplicate_num += 1
+            job["name"] = f'{name}_{duplicate_num}'
+        used_names.add(job["name"])
+        if "comparison_engine" in job:
+            try:
+                COMPARISON_ENGINE(job["comparison_engine"])
+            except ValueError:
+                raise ManifestError(f'Job {job_num} has an unknown comparison_engine "{job["comparison_engine"]}", pick one of {[engine.value for engine in COMPARISON_ENGINE]}.')
+        if "reader_backend" in job:
+            try:
+                READER_BACKEND(job["reader_backend"])
+            except ValueError:
+                raise ManifestError(f'Job {job_num} has an unknown reader_backend "{job["reader_backend"]}", pick one of {[reader_backend.value for reader_backend in READER_BACKEND]}.')
+        if job["output_format"] != None:
+            try:
+                OUTPUT_FORMAT(job["output_format"])
+            except ValueError:
+                raise ManifestError(f'Job {job_num} has an unknown output_format "{job["output_format"]}", pick one of {[output_format.value for output_format in OUTPUT_FORMAT]}.')
+        if "sheet_mapping" in job and (not isinstance(job["sheet_mapping"], dict) or not all(isinstance(name, str) for item in job["sheet_mapping"].items() for name in item)):
+            raise ManifestError(f'Job {job_num} has an invalid sheet_mapping, it must map original sheet names to uploaded sheet names.')
+        if job.get("pairing_pattern"):
+            try:
+                re.compile(job["pairing_pattern"])
+            except re.error as e:
+                raise ManifestError(f'Job {job_num} has an invalid pairing_pattern "{job["pairing_pattern"]}". {e}')
+        if "result_mode" in job:
+            try:
+                ISSUES_MAIN().set_result_mode(job["result_mode"], job.get("max_issues"))
+            except ValueError as e:
+                raise ManifestError(f'Job {job_num} has an invalid result_mode, pick one of {[result_mode.value for result_mode in RESULT_MODE]}. {e}')
+        jobs.append(job)
+    return jobs
+
+def comparison_options(job: dict) -> dict:
+    options = {option: job[option] for option in JOB_COMPARISON_OPTIONS if option in job}
+    if job.get("use_snapshot_cache"):
+        from cache_logic import SnapshotCache
+        options["snapshot_cache"] = SnapshotCache()
+    return options
+
+def summarise(job: dict, issues_list: list[ISSUES_MAIN], output_path: str, seconds: float) -> dict:
+    """ Machine readable summary of a job which ran. """
+    issue_counts = {}
+    mismatch_counts_by_field = {}
+    for issues in issues_list:
+        for issue_type, count in issues.issue_counts.items():
+            issue_counts[issue_type.name] = issue_counts.get(issue_type.name, 0) + count
+        for field, count in issues.mismatch_counts_by_field().items():
+            mismatch_counts_by_field[field] = mismatch_counts_by_field.get(field, 0) + count
+    return {"job": job["name"],
+            "uploaded": job["uploaded"],
+            "original": job["original"],
+            "status": "issues" if any(issues.has_issues() for issues in issues_list) else "ok",
+            "pairs": len(issues_list),
+            "pairs_with_issues": sum(1 for issues in issues_list if issues.has_issues()),
+            "issues": sum(issue_counts.values()),
+            "issue_counts": issue_counts,
+            "mismatch_counts_by_field": mismatch_counts_by_field,
+            "stopped_early": any(issues.limit_reached for issues in issues_list),
+            "nature_of_issues": sorted({nature.name for issues in issues_list for nature in issues.nature_of_issues}),
+            "output": output_path,
+            "seconds": round(seconds, 3)}
+
+def summarise_failure(job: dict, error: Exception, seconds: float) -> dict:
+    return {"job": job["name"],
+            "uploaded": job["uploaded"],
+            "original": job["original"],
+            "status": "error",
+            "error": f'{type(error).__name__}: {error}',
+            "seconds": round(seconds, 3)}
+
+def write_job_issues(job: dict, issues: ISSUES_MAIN, instrumentation: Instrumentation) -> str:
+    """ Writes the issue log of a file job whose issues were kept, returning the path written to or None if there were no issues. """
+    # Nothing to write when the issues were only counted
+    if len(issues.issue_list) == 0:
+        return None
+    os.makedirs(job["output_dir"], exist_ok=True)
+    issues.name = job["name"]
+    return write_issues(issues, job["output_dir"], job["output_to_excel"], instrumentation=instrumentation, output_format=job["output_format"])
+
+def compare_and_write_job(job: dict, instrument: bool) -> tuple:
+    """
+    Compares a file job while writing its issue log, so the issues are never all held in memory. Runs in a worker process.
+
+    Returns:
+        The ISSUES_MAIN, the path of the issue log or None if there were no issues, and the PhaseRecords measured.
+    """
+    instrumentation = Instrumentation() if instrument else None
+    os.makedirs(job["output_dir"], exist_ok=True)
+    issues, output_path = find_and_write_discrepancies(job["uploaded"], job["original"], job["output_dir"], job["output_to_excel"], log_name=job["name"], output_format=job["output_format"], instrumentation=instrumentation, **comparison_options(job))
+    return issues, output_path, instrumentation.records if instrument else []
+
+def run_jobs(jobs: list[dict], max_workers: int = None, instrumentation: Instrumentation = None, report = None, status = None) -> list[dict]:
+    """
+    Compares every job and writes its issue logs.
+    Jobs which don't use the result cache write their issues as they're found, cached jobs need every issue to cache them.
+
+    Args:
+        max_workers: Number of worker processes, defaults to the number of cores.
+        report: Called with the summary of each job as soon as it finishes.
+        status: Called with status messages.
+
+    Returns:
+        The summary of each job, in the order they finished. A job which fails is summarised as an error and the other jobs carry on.
+    """
+    summaries = []
+    def finish_job(job: dict, start: float, issues_list: list[ISSUES_MAIN] = None, error: Exception = None, is_written: bool = False, output_path: str = None) -> None:
+        """ Writes the issues of a file job unless they were already written as they were found (is_written), then reports the job. """
+        if error == None:
+            try:
+                if not is_written:
+                    output_path = write_job_issues(job, issues_list[0], instrumentation)
+                summary = summarise(job, issues_list, output_path, time.perf_counter() - start)
+            except Exception as e:
+                summary = summarise_failure(job, e, time.perf_counter() - start)
+        else:
+            summary = summarise_failure(job, error, time.perf_counter() - start)
+        summaries.append(summary)
+        if report:
+            report(summary)
+
+    result_cache = None
+    if any(job["use_result_cache"] for job in jobs):
+        from cache_logic import ResultCache
+        result_cache = ResultCache()
+
+    file_jobs = []
+    folder_jobs = []
+    workbook_jobs = []
+    for job in jobs:
+        start = time.perf_counter()
+        if job.get("compare_all_sheets") and os.path.isfile(job["uploaded"]) and os.path.isfile(job["original"]):
+            if not (job["uploaded"].endswith('.xlsx') and job["original"].endswith('.xlsx')):
+                finish_job(job, start, error=ValueError(f'compare_all_sheets needs both {job["uploaded"]} and {job["original"]} to be Excel workbooks.'))
+                continue
+            unsupported_options = [option for option in SINGLE_SHEET_OPTIONS if option in job]
+            if len(unsupported_options):
+                finish_job(job, start, error=ValueError(f'{unsupported_options} can\'t be used to compare every sheet of a workbook.'))
+                continue
+            workbook_jobs.append(job)
+        elif os.path.isfile(job["uploaded"]) and os.path.isfile(job["original"]):
+            # Results are only read from and written to the cache here, never from the worker processes
+            if job["use_result_cache"]:
+                job["cache_key"] = result_cache_key(result_cache, job["uploaded"], job["original"], comparison_options(job))
+                cached_issues = result_cache.get(job["cache_key"])
+                if cached_issues != None:
+                    finish_job(job, start, [cached_issues])
+                    continue
+            file_jobs.append(job)
+        elif os.path.isdir(job["uploaded"]) and os.path.isdir(job["original"]):
+            unsupported_options = [option for option in FILE_ONLY_OPTIONS if option in job]
+            if len(unsupported_options):
+                finish_job(job, start, error=ValueError(f'{unsupported_options} can only be used to compare a pair of files.'))
+                continue
+            folder_jobs.append(job)
+        else:
+            finish_job(job, start, error=FileNotFoundError(f'{job["uploaded"]} and {job["original"]} must both be existing files or both be existing folders.'))
+
+    # File pairs share one pool of worker processes. Pairs split into partitions and folder pairs start their own pools,
+    # and a lone pair is compared here rather than paying for starting a pool
+    pooled_jobs = [job for job in file_jobs if job.get("num_partitions", 1) <= 1]
+    if len(pooled_jobs) < 2 or max_workers == 1:
+        pooled_jobs = []
+    unpooled_jobs = [job for job in file_jobs if job not in pooled_jobs] + folder_jobs + workbook_jobs
+
+    if len(pooled_jobs):
+        if status:
+            status(f'Comparing {len(pooled_jobs)} file pairs')
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+        with ProcessPoolExecutor(max_workers=min(len(pooled_jobs), max_workers or os.cpu_count())) as executor:
+            futures = {}
+            for job in pooled_jobs:
+                if job["use_result_cache"]:
+                    future = executor.submit(find_discrepancies_instrumented,
+                                             instrumentation != None,
+                                             uploaded_file_path=job["uploaded"],
+                                             original_file_path=job["original"],
+                                             **comparison_options(job))
+                else:
+                    future = executor.submit(compare_and_write_job, job, instrumentation != None)
+                futures[future] = (job, time.perf_counter())
+            for future in as_completed(futures):
+                job, start = futures[future]
+                try:
+                    if job["use_result_cache"]:
+                        issues, phase_records = future.result()
+                        is_written = False
+                        output_path = None
+                    else:
+                        issues, output_path, phase_records = future.result()
+                        is_written = True
+                except Exception as e:
+                    finish_job(job, start, error=e)
+                    continue
+                for phase_record in phase_records:
+                    instrumentation.add(phase_record)
+                if job["use_result_cache"]:
+                    result_cache.put(job["cache_key"], issues)
+                finish_job(job, start, [issues], is_written=is_written, output_path=output_path)
+
+    for job in unpooled_jobs:
+        start = time.perf_counter()
+        if status:
+            status(f'Comparing {job["name"]}')
+        try:
+            if job in folder_jobs:
+                # Each file pair's issues are written as soon as it's compared
+                os.makedirs(job["output_dir"], exist_ok=True)
+                issues_list, output_path = compare_and_write_csv_folders(job["uploaded"],
+                                                                         job["original"],
+                                                                         job["output_dir"],
+                                                                         output_to_excel=job["output_to_excel"],
+                                                                         output_format=job["output_format"],
+                                                                         use_processes=True,
+                                                                         max_workers=max_workers,
+                                                                         result_cache=result_cache if job["use_result_cache"] else None,
+                                                                         pairing_pattern=job.get("pairing_pattern"),
+                                                                         instrumentation=instrumentation,
+                                                                         **comparison_options(job))
+                finish_job(job, start, issues_list, is_written=True, output_path=output_path)
+            elif job in workbook_jobs:
+                # Each sheet pair's issues are written into the report folder as they're found
+                os.makedirs(job["output_dir"], exist_ok=True)
+                issues_list, output_path = compare_and_write_workbooks(job["uploaded"],
+                                                                       job["original"],
+                                                                       job["output_dir"],
+                                                                       sheet_mapping=job.get("sheet_mapping"),
+                                                                       output_to_excel=job["output_to_excel"],
+                                                                       output_format=job["output_format"],
+                                                                       max_workers=max_workers,
+                                                                       instrumentation=instrumentation,
+                                                                       **comparison_options(job))
+                finish_job(job, start, issues_list, is_written=True, output_path=output_path)
+            elif job["use_result_cache"]:
+                issues = find_discrepancies(job["uploaded"], job["original"], instrumentation=instrumentation, **comparison_options(job))
+                result_cache.put(job["cache_key"], issues)
+                finish_job(job, start, [issues])
+            else:
+                os.makedirs(job["output_dir"], exist_ok=True)
+                issues, output_path = find_and_write_discrepancies(job["uploaded"], job["original"], job["output_dir"], job["output_to_excel"], log_name=job["name"], output_format=job["output_format"], instrumentation=instrumentation, **comparison_options(job))
+                finish_job(job, start, [issues], is_written=True, output_path=output_path)
+        except Exception as e:
+            finish_job(job, start, error=e)
+
+    return summaries
+
+def exit_code_for(summaries: list[dict]) -> EXIT_CODE:
+    if any(summary["status"] == "error" for summary in summaries):
+        return EXIT_CODE.JOB_FAILED
+    if any(summary["status"] == "issues" for summary in summaries):
+        return EXIT_CODE.ISSUES_FOUND
+    return EXIT_CODE.NO_ISSUES
+
+def print_json_line(record: dict) -> None:
+    print(json.dumps(record), flush=True)
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='Compares sheets without the GUI. Exit codes: ' + ', '.join(f'{code.value} {code.name}' for code in EXIT_CODE))
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='Compares every job in a JSON manifest.')
+    run_parser.add_argument('manifest')
+
+    compare_parser = commands.add_parser('compare', help='Compares a single pair of sheets or folders.')
+    compare_parser.add_argument('uploaded')
+    compare_parser.add_argument('original')
+    compare_parser.add_argument('--output-dir', default='.')
+    compare_parser.add_argument('--excel', action='store_true', help='Write the issue log as Excel instead of text.')
+    compare_parser.add_argument('--format', choices=[output_format.value for output_format in OUTPUT_FORMAT], 
+                                help='Format of the issue log, csv, jsonl and parquet hold one record per cell which differs. Takes precedence over --excel.')
+    compare_parser.add_argument('--engine', choices=[engine.value for engine in COMPARISON_ENGINE], default=COMPARISON_ENGINE.HASH.value)
+    compare_parser.add_argument('--reader', choices=[reader_backend.value for reader_backend in READER_BACKEND], default=READER_BACKEND.AUTO.value,
+                                help='Parser for CSV files, auto picks the fastest installed. Encoding and delimiter are sniffed from each file.')
+    compare_parser.add_argument('--uploaded-identifier', type=int, default=0, help='Index of the identifying column of the uploaded sheet.')
+    compare_parser.add_argument('--original-identifier', type=int, default=0, help='Index of the identifying column of the original sheet.')
+    compare_parser.add_argument('--ignore-whitespace', action='store_true', help='Ignore leading and trailing whitespaces.')
+    compare_parser.add_argument('--all-sheets', action='store_true', help='Compare every sheet of two workbooks, paired by name, into one report folder.')
+    compare_parser.add_argument('--sheet-map', action='append', default=[], metavar='ORIGINAL=UPLOADED',
+                                help='With --all-sheets, pair the original sheet ORIGINAL with the uploaded sheet UPLOADED. Can be repeated.')
+    compare_parser.add_argument('--pairing-pattern', help="Regex taking the key which pairs the sheets of two folders out of their file names, defaults to the text before the first '-'.")
+    compare_parser.add_argument('--partitions', type=int, help='Split a pair of files into this many parts compared in parallel.')
+    compare_parser.add_argument('--no-extra-rows', action='store_true', help="Don't report uploaded rows which aren't in the original sheet.")
+    compare_parser.add_argument('--use-result-cache', action='store_true')
+    compare_parser.add_argument('--use-snapshot-cache', action='store_true', help='Keep the parsed rows of original Excel sheets so later runs skip parsing them.')
+    compare_parser.add_argument('--result-mode', choices=[result_mode.value for result_mode in RESULT_MODE], default=RESULT_MODE.FULL.value,
+                                help='count_only only counts the issues, stop_after stops once --max-issues are found, first_mismatch stops at the first issue.')
+    compare_parser.add_argument('--max-issues', type=int, help='Number of issues to stop after with --result-mode stop_after.')
+
+    commands.add_parser('clear-cache', help='Clears the caches of comparison results and parsed sheets.')
+
+    for command_parser in (run_parser, compare_parser):
+        command_parser.add_argument('--max-workers', type=int, help='Number of worker processes, defaults to the number of cores.')
+        command_parser.add_argument('--phase-log', help='Append the timings of every phase to this JSON lines file.')
+        command_parser.add_argument('--quiet', action='store_true', help='Only print the JSON summaries.')
+    return parser
+
+def jobs_from_compare_arguments(args: argparse.Namespace) -> list[dict]:
+    job = {"uploaded": args.uploaded,
+           "original": args.original,
+           "output_dir": args.output_dir,
+           "output_to_excel": args.excel,
+           "output_format": args.format,
+           "use_result_cache": args.use_result_cache,
+           "use_snapshot_cache": args.use_snapshot_cache,
+           "comparison_engine": args.engine,
+           "reader_backend": args.reader,
+           "uploaded_file_identifying_field_index": args.uploaded_identifier,
+           "original_file_identifying_field_index": args.original_identifier,
+           "ignore_leading_and_trailing_whitespaces": args.ignore_whitespace,
+           "full_outer_diff": not args.no_extra_rows,
+           "result_mode": args.result_mode,
+           "pairing_pattern": args.pairing_pattern,
+           "compare_all_sheets": args.all_sheets}
+    if len(args.sheet_map):
+        if not all('=' in sheet_map for sheet_map in args.sheet_map):
+            raise ManifestError(f'--sheet-map must be given as ORIGINAL=UPLOADED, not {args.sheet_map}.')
+        job["sheet_mapping"] = dict(sheet_map.split('=', 1) for sheet_map in args.sheet_map)
+    if args.max_issues != None:
+        job["max_issues"] = args.max_issues
+    if args.partitions != None:
+        job["num_partitions"] = args.partitions
+    return resolve_jobs({"jobs": [job]}, os.getcwd())
+
+def main(argv: list[str] = None) -> int:
+    try:
+        args = build_parser().parse_args(argv)
+    except SystemExit as e:
+        return EXIT_CODE.USAGE_ERROR if e.code else EXIT_CODE.NO_ISSUES
+
+    if args.command == 'clear-cache':
+        from cache_logic import ResultCache, SnapshotCache
+        ResultCache().clear()
+        SnapshotCache().clear()
+        print('Cleared the result and snapshot caches.', file=sys.stderr)
+        return EXIT_CODE.NO_ISSUES
+
+    try:
+        jobs = load_manifest(args.manifest) if args.command == 'run' else jobs_from_compare_arguments(args)
+    except ManifestError as e:
+        print(f'ERROR: {e}', file=sys.stderr)
+        return EXIT_CODE.USAGE_ERROR
+
+    instrumentation = None
+    if args.phase_log:
+        instrumentation = Instrumentation()
+        instrumentation.subscribe(JsonLinesWriter(args.phase_log))
+
+    status = None if args.quiet else lambda message: print(message, file=sys.stderr, flush=True)
+    start = time.perf_counter()
+    summaries = run_jobs(jobs, args.max_workers, instrumentation, report=print_json_line, status=status)
+    exit_code = exit_code_for(summaries)
+    print_json_line({"summary": True,
+                     "jobs": len(summaries),
+                     "jobs_with_issues": sum(1 for summary in summaries if summary["status"] == "issues"),
+                     "jobs_failed": sum(1 for summary in summaries if summary["status"] == "error"),
+                     "seconds": round(time.perf_counter() - start, 3),
+                     "exit_code": int(exit_code)})
+    return exit_code
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,11 +6,19 @@ import threading
 import json
 from appdirs import user_data_dir
 import os
-from sheet_comparator_logic import find_discrepancies, write_issues, compare_csv_folders, compare_csv_folders_single_threaded, write_multiple_issues, write_multiple_issues_single_threaded
+import multiprocessing
+from cache_logic import ResultCache, SnapshotCache
+from instrumentation_logic import Instrumentation, JsonLinesWriter
+from issue_writer_logic import OUTPUT_FORMAT, get_output_format
+from progress_logic import GUI_FRAME_MS, PROGRESS_EVENT, ProgressBus
+from pipeline_logic import compare_and_write_csv_folders
+from workbook_logic import compare_and_write_workbooks
+from sheet_comparator_logic import COMPARISON_ENGINE, find_and_write_discrepancies, compare_csv_folders_single_threaded, write_multiple_issues_single_threaded
 
 TESTING = False
 DEFAULT_CONFIG =  { 
                     "output_to_excel": True,
+                    "output_format": None, # see OUTPUT_FORMAT, older settings only have output_to_excel
                     "ori": "ori_test", 
                     "upl": "upl_test",
                     "ori_identifier_idx": 1, 
@@ -18,6 +26,22 @@ DEFAULT_CONFIG =  {
                     "output_folder": os.getcwd(),
                     "ignore_leading_and_trailing_whitespaces": False,
                     "multithreaded": False,
+                    "multiprocessing": False,
+                    "max_workers": 0,
+                    "comparison_engine": COMPARISON_ENGINE.HASH.value,
+                    "memory_budget_mb": 256,
+                    "use_result_cache": False,
+                    "result_cache_size_mb": 512,
+                    "use_snapshot_cache": False, # Keep the parsed rows of original Excel sheets so they're only parsed again once they change, see cache_logic.py
+                    "snapshot_cache_size_mb": 2048,
+                    "legacy_cleanup": False,
+                    "full_outer_diff": True,
+                    "phase_log_file": "", # JSON lines file to log the time and memory of each phase of a comparison to, see instrumentation_logic.py
+                    "normalisation_rules": {}, # see normalisation_logic.py
+                    "pairing_pattern": "", # Regex pairing the sheets of two folders by their file names, see pairing_logic.py
+                    "reader_backend": "auto", # CSV parser, one of "auto", "stdlib", "pandas" or "pyarrow", see common_logic.py
+                    "compare_all_sheets": False,
+                    "sheet_mapping": {}, # Uploaded sheet name for each original sheet whose uploaded sheet is named differently, see workbook_logic.py
                     }
 
 def save_settings(config_file_path: str, settings: dict):
@@ -37,39 +61,92 @@ def load_settings(defaults: dict, config_file_path: str):
         combined_settings = {**defaults, **user_settings} # Merge defaults and user settings, prioritise user settings 
         return combined_settings
 
+# Progress is posted to the bus from the comparison thread, only drain_progress_bus touches the widgets
 def update_progress_bar(progress_value: int) -> None:
-    progress_var.set(progress_value)  # Update progress bar value
-    root.update_idletasks() # Update the GUI to reflect progress bar change
+    progress_bus.post_progress(progress_value)
 
 def update_progress_status(status: str) -> None:
-    output_label.config(text=f'{" "*500}')
-    output_label.config(text=status)
-    root.update_idletasks() # Update the GUI to reflect progress bar change
+    progress_bus.post_status(status)
+
+def drain_progress_bus() -> None:
+    """ Shows the latest progress posted to the bus, runs on Tk's main loop once a frame. """
+    events = progress_bus.drain()
+    if PROGRESS_EVENT.PROGRESS in events:
+        progress_var.set(events[PROGRESS_EVENT.PROGRESS])
+    if PROGRESS_EVENT.STATUS in events:
+        output_label.config(text=events[PROGRESS_EVENT.STATUS])
+    if PROGRESS_EVENT.FINISHED in events:
+        compare_button.config(state=tk.NORMAL)
+    root.after(GUI_FRAME_MS, drain_progress_bus)
+
+def get_result_cache():
+    """ Returns the cache for folder comparison results if the user has turned it on. """
+    if not use_result_cache_value.get():
+        return None
+    return ResultCache(cache_dir=config_dir, max_size_mb=config["result_cache_size_mb"])
+
+def get_snapshot_cache():
+    """ Returns the cache of parsed original Excel sheets if it's turned on in the config. """
+    if not config["use_snapshot_cache"]:
+        return None
+    return SnapshotCache(cache_dir=config_dir, max_size_mb=config["snapshot_cache_size_mb"])
+
+def clear_result_cache():
+    ResultCache(cache_dir=config_dir, max_size_mb=config["result_cache_size_mb"]).clear()
+    SnapshotCache(cache_dir=config_dir, max_size_mb=config["snapshot_cache_size_mb"]).clear()
+    update_progress_status('Cleared cached results and sheets.')
+
+def get_normalisation_rules() -> dict:
+    """ Returns the normalisation rules from the config, with the legacy cleanup preset added if the user has turned it on. """
+    rules = dict(config["normalisation_rules"])
+    if legacy_cleanup_value.get():
+        rules["presets"] = [*rules.get("presets", []), "legacy_cleanup"]
+    return rules
+
+def get_instrumentation():
+    """ Returns an Instrumentation which logs each phase to the configured file, or None if no file is configured. """
+    if not config["phase_log_file"]:
+        return None
+    instrumentation = Instrumentation()
+    instrumentation.subscribe(JsonLinesWriter(config["phase_log_file"]))
+    return instrumentation
 
 def compare_sheets_aux(item1_path: str, 
                       item2_path: str, 
                       compare_button: tk.Button, 
-                      excel_output: bool,
+                      output_format: str,
                       index1_identifier: int,
                       index2_identifier: int,
                       output_dir: str) -> None: 
     
-    # Disable the compare button to prevent spamming
-    compare_button.config(state=tk.DISABLED)
-    progress_var.set(0)
+    update_progress_bar(0)
     
+    instrumentation = get_instrumentation()
     try:
         # Run bulk logic if its a folder path being provided 
         if ( os.path.isdir(item1_path) and os.path.isdir(item2_path) ):
-            if multithreaded_value.get():
-                res = compare_csv_folders(uploaded_folder_path=item2_path,
+            if multithreaded_value.get() or multiprocessing_value.get():
+                # Each file pair's issues are written as soon as it's compared, rather than holding the whole folder's issues
+                res, folder_path = compare_and_write_csv_folders(uploaded_folder_path=item2_path,
                                     original_folder_path=item1_path,
+                                    output_dir=output_dir,
+                                    output_format=output_format,
                                     progress_to_show_in_gui=update_progress_bar,
                                     status_to_show_in_gui=update_progress_status,
                                     uploaded_file_identifying_field_index=index2_identifier,
                                     original_file_identifying_field_index=index1_identifier,
-                                    ignore_leading_and_trailing_whitespaces=ignore_leading_and_trailing_whitespaces_value.get())
-                write_multiple_issues(res, update_progress_bar, update_progress_status, output_dir, excel_output)
+                                    ignore_leading_and_trailing_whitespaces=ignore_leading_and_trailing_whitespaces_value.get(),
+                                    use_processes=multiprocessing_value.get(),
+                                    max_workers=config["max_workers"] or None,
+                                    comparison_engine=comparison_engine_value.get(),
+                                    memory_budget_mb=config["memory_budget_mb"],
+                                    result_cache=get_result_cache(),
+                                    instrumentation=instrumentation,
+                                    normalisation_rules=get_normalisation_rules(),
+                                    full_outer_diff=full_outer_diff_value.get(),
+                                    pairing_pattern=config["pairing_pattern"] or None,
+                                    reader_backend=config["reader_backend"],
+                                    snapshot_cache=get_snapshot_cache())
             else:
                 res = compare_csv_folders_single_threaded(uploaded_folder_path=item2_path,
                                     original_folder_path=item1_path,
@@ -77,27 +154,70 @@ def compare_sheets_aux(item1_path: str,
                                     status_to_show_in_gui=update_progress_status,
                                     uploaded_file_identifying_field_index=index2_identifier,
                                     original_file_identifying_field_index=index1_identifier,
-                                    ignore_leading_and_trailing_whitespaces=ignore_leading_and_trailing_whitespaces_value.get())
-                write_multiple_issues_single_threaded(res, update_progress_bar, update_progress_status, output_dir, excel_output)
+                                    ignore_leading_and_trailing_whitespaces=ignore_leading_and_trailing_whitespaces_value.get(),
+                                    comparison_engine=comparison_engine_value.get(),
+                                    memory_budget_mb=config["memory_budget_mb"],
+                                    result_cache=get_result_cache(),
+                                    instrumentation=instrumentation,
+                                    normalisation_rules=get_normalisation_rules(),
+                                    full_outer_diff=full_outer_diff_value.get(),
+                                    pairing_pattern=config["pairing_pattern"] or None,
+                                    reader_backend=config["reader_backend"],
+                                    snapshot_cache=get_snapshot_cache())
+                write_multiple_issues_single_threaded(res, update_progress_bar, update_progress_status, output_dir, instrumentation=instrumentation, output_format=output_format)
+
+        # Run every sheet of a pair of workbooks, each sheet pair in its own worker process
+        if ( os.path.isfile(item1_path) and os.path.isfile(item2_path) and compare_all_sheets_value.get() 
+            and item1_path.endswith('.xlsx') and item2_path.endswith('.xlsx') ):
+            res, folder_path = compare_and_write_workbooks(uploaded_workbook_path=item2_path,
+                                    original_workbook_path=item1_path,
+                                    output_dir=output_dir,
+                                    sheet_mapping=config["sheet_mapping"],
+                                    output_format=output_format,
+                                    progress_to_show_in_gui=update_progress_bar,
+                                    status_to_show_in_gui=update_progress_status,
+                                    max_workers=config["max_workers"] or None,
+                                    uploaded_file_identifying_field_index=index2_identifier,
+                                    original_file_identifying_field_index=index1_identifier,
+                                    ignore_leading_and_trailing_whitespaces=ignore_leading_and_trailing_whitespaces_value.get(),
+                                    comparison_engine=comparison_engine_value.get(),
+                                    memory_budget_mb=config["memory_budget_mb"],
+                                    normalisation_rules=get_normalisation_rules(),
+                                    full_outer_diff=full_outer_diff_value.get(),
+                                    reader_backend=config["reader_backend"],
+                                    snapshot_cache=get_snapshot_cache(),
+                                    instrumentation=instrumentation)
 
         # Run single file logic if its a file path being provided
-        if ( os.path.isfile(item1_path) and os.path.isfile(item2_path) ):
-            res = find_discrepancies(uploaded_file_path=item2_path,
+        elif ( os.path.isfile(item1_path) and os.path.isfile(item2_path) ):
+            # Issues are written as they're found, so a sheet with millions of issues doesn't have to fit in memory
+            res, log_file_path = find_and_write_discrepancies(uploaded_file_path=item2_path,
                                     original_file_path=item1_path,
+                                    output_dir=output_dir,
+                                    output_format=output_format,
                                     progress_to_show_in_gui=update_progress_bar,
                                     status_to_show_in_gui=update_progress_status,
                                     uploaded_file_identifying_field_index=index2_identifier,
                                     original_file_identifying_field_index=index1_identifier,
-                                    ignore_leading_and_trailing_whitespaces=ignore_leading_and_trailing_whitespaces_value.get())
-            write_issues(res, output_dir, excel_output, update_progress_bar, update_progress_status)
+                                    ignore_leading_and_trailing_whitespaces=ignore_leading_and_trailing_whitespaces_value.get(),
+                                    comparison_engine=comparison_engine_value.get(),
+                                    memory_budget_mb=config["memory_budget_mb"],
+                                    normalisation_rules=get_normalisation_rules(),
+                                    full_outer_diff=full_outer_diff_value.get(),
+                                    # Multiprocessing splits a single pair of sheets into parts which are compared on every core
+                                    num_partitions=(config["max_workers"] or os.cpu_count()) if multiprocessing_value.get() else 1,
+                                    reader_backend=config["reader_backend"],
+                                    snapshot_cache=get_snapshot_cache(),
+                                    instrumentation=instrumentation)
             
-        progress_var.set(100)
+        update_progress_bar(100)
     except Exception as e:
         error_type = type(e).__name__
         update_progress_status(f'ERROR: {error_type}: {e}')
-        progress_var.set(0)
+        update_progress_bar(0)
 
-    compare_button.config(state=tk.NORMAL)
+    # Re-enables the compare button
+    progress_bus.post_finished()
     return
 
 def get_file(file_path_var: tk.StringVar):
@@ -127,7 +247,7 @@ def compare_button_click():
     file2_path = file2_var.get()
     index1_identifier = index1_var.get() - 1
     index2_identifier = index2_var.get() - 1
-    excel_output = use_excel.get()
+    output_format = output_format_value.get()
     output_dir = output_dir_var.get()
 
     if file1_path == ""  or file2_path == "":
@@ -142,10 +262,12 @@ def compare_button_click():
         output_label.config(text='Cannot find folder for output.')
         return
 
+    # Disable the compare button to prevent spamming, it is enabled again once the comparison thread finishes
+    compare_button.config(state=tk.DISABLED)
     comparison_thread = threading.Thread(target=compare_sheets_aux, args=(file1_path, 
                                                                 file2_path, 
                                                                 compare_button, 
-                                                                excel_output, 
+                                                                output_format, 
                                                                 index1_identifier,
                                                                 index2_identifier,
                                                                 output_dir))
@@ -157,6 +279,9 @@ def validate_is_number(P):
     return P.isdigit() or P == ""
 
 if __name__ == "__main__":
+    # Required for worker processes to start from a compiled executable
+    multiprocessing.freeze_support()
+
     app_name = 'Sheet Comparator'
     # Get the platform-specific configuration directory
     config_dir = user_data_dir(appname=app_name, appauthor='seanntxj', roaming=False)  
@@ -167,10 +292,16 @@ if __name__ == "__main__":
     # Window and widgets
     root = tk.Tk()
     root.title("Sheet Comparator")
-    root.geometry('870x190')
-    use_excel = tk.BooleanVar(value=config["output_to_excel"])  # Boolean variable, initially True (checked)
+    root.geometry('1280x190')
+    output_format_value = tk.StringVar(value=get_output_format(config["output_format"], config["output_to_excel"]).value)
     ignore_leading_and_trailing_whitespaces_value = tk.BooleanVar(value=config["ignore_leading_and_trailing_whitespaces"])
     multithreaded_value = tk.BooleanVar(value=config["multithreaded"])
+    multiprocessing_value = tk.BooleanVar(value=config["multiprocessing"])
+    comparison_engine_value = tk.StringVar(value=config["comparison_engine"])
+    use_result_cache_value = tk.BooleanVar(value=config["use_result_cache"])
+    legacy_cleanup_value = tk.BooleanVar(value=config["legacy_cleanup"])
+    full_outer_diff_value = tk.BooleanVar(value=config["full_outer_diff"])
+    compare_all_sheets_value = tk.BooleanVar(value=config["compare_all_sheets"])
 
     file_selector_frame = tk.Frame(root)
     file_selector_frame.pack(fill=tk.X, pady=10)
@@ -261,33 +392,92 @@ if __name__ == "__main__":
     bottom_options_frame = tk.Frame(bottom_frame)
     bottom_options_frame.pack(side=tk.LEFT)
 
-    excel_checkbox = tk.Checkbutton(
-        bottom_options_frame, text="Output to Excel", variable=use_excel
+    # Text and Excel logs are for reading, CSV, JSON lines and Parquet hold one record per differing cell for other tools
+    output_format_label = tk.Label(bottom_options_frame, text="Output:")
+    output_format_label.pack(padx=(25, 0), side=tk.LEFT)
+
+    output_format_menu = ttk.Combobox(
+        bottom_options_frame, textvariable=output_format_value, values=[output_format.value for output_format in OUTPUT_FORMAT], state="readonly", width=8
     )
-    excel_checkbox.pack(padx=25, side=tk.LEFT)
+    output_format_menu.pack(padx=10, side=tk.LEFT)
 
     ignore_leading_and_trailing_whitespaces_checkbox = tk.Checkbutton(
         bottom_options_frame, text="Ignore whitespaces", variable=ignore_leading_and_trailing_whitespaces_value
     )
     ignore_leading_and_trailing_whitespaces_checkbox.pack(padx=25, side=tk.LEFT)
 
+    legacy_cleanup_checkbox = tk.Checkbutton(
+        bottom_options_frame, text="Legacy cleanup", variable=legacy_cleanup_value
+    )
+    legacy_cleanup_checkbox.pack(padx=25, side=tk.LEFT)
+
+    full_outer_diff_checkbox = tk.Checkbutton(
+        bottom_options_frame, text="Extra rows", variable=full_outer_diff_value
+    )
+    full_outer_diff_checkbox.pack(padx=25, side=tk.LEFT)
+
+    compare_all_sheets_checkbox = tk.Checkbutton(
+        bottom_options_frame, text="All sheets", variable=compare_all_sheets_value
+    )
+    compare_all_sheets_checkbox.pack(padx=25, side=tk.LEFT)
+
     multithreaded_checkbox = tk.Checkbutton(
         bottom_options_frame, text="Multithreading", variable=multithreaded_value
     )
     multithreaded_checkbox.pack(padx=25, side=tk.LEFT)
 
+    multiprocessing_checkbox = tk.Checkbutton(
+        bottom_options_frame, text="Multiprocessing", variable=multiprocessing_value
+    )
+    multiprocessing_checkbox.pack(padx=25, side=tk.LEFT)
+
+    comparison_engine_label = tk.Label(bottom_options_frame, text="Engine:")
+    comparison_engine_label.pack(side=tk.LEFT)
+
+    comparison_engine_menu = ttk.Combobox(
+        bottom_options_frame, textvariable=comparison_engine_value, values=[engine.value for engine in COMPARISON_ENGINE], state="readonly", width=14
+    )
+    comparison_engine_menu.pack(padx=10, side=tk.LEFT)
+
+    use_result_cache_checkbox = tk.Checkbutton(
+        bottom_options_frame, text="Reuse results", variable=use_result_cache_value
+    )
+    use_result_cache_checkbox.pack(padx=10, side=tk.LEFT)
+
+    clear_result_cache_button = tk.Button(bottom_options_frame, text="Clear cache", command=clear_result_cache)
+    clear_result_cache_button.pack(side=tk.LEFT)
+
     compare_button = tk.Button(bottom_frame, text="Compare", command=compare_button_click)
     compare_button.pack(side=tk.RIGHT, padx=25)
 
+    progress_bus = ProgressBus()
+    root.after(GUI_FRAME_MS, drain_progress_bus)
     root.mainloop()
 
     save_settings(config_file_path, { 
-       "output_to_excel": use_excel.get(),
+       "output_to_excel": output_format_value.get() == OUTPUT_FORMAT.EXCEL.value,
+       "output_format": output_format_value.get(),
        "ori": file1_var.get(), 
        "upl": file2_var.get(),
        "ori_identifier_idx": index1_var.get(),
        "upl_identifier_idx": index2_var.get(),
        "output_folder": output_dir_var.get(),
        "ignore_leading_and_trailing_whitespaces": ignore_leading_and_trailing_whitespaces_value.get(),
-       "multithreaded": multithreaded_value.get()
+       "multithreaded": multithreaded_value.get(),
+       "multiprocessing": multiprocessing_value.get(),
+       "max_workers": config["max_workers"],
+       "comparison_engine": comparison_engine_value.get(),
+       "memory_budget_mb": config["memory_budget_mb"],
+       "use_result_cache": use_result_cache_value.get(),
+       "result_cache_size_mb": config["result_cache_size_mb"],
+       "use_snapshot_cache": config["use_snapshot_cache"],
+       "snapshot_cache_size_mb": config["snapshot_cache_size_mb"],
+       "legacy_cleanup": legacy_cleanup_value.get(),
+       "full_outer_diff": full_outer_diff_value.get(),
+       "phase_log_file": config["phase_log_file"],
+       "normalisation_rules": config["normalisation_rules"],
+       "pairing_pattern": config["pairing_pattern"],
+       "reader_backend": config["reader_backend"],
+       "compare_all_sheets": compare_all_sheets_value.get(),
+       "sheet_mapping": config["sheet_mapping"],
     })
\ No newline at end of file
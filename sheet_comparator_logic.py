@@ -2,33 +2,45 @@
 Takes in two line arguments:
 1 - original csv file to be compared against
 2 - secondary csv file which should match the first ASIDE from order
+Optionally followed by the identifier column index of the uploaded and original files, and the comparison engine ('hash', 'external_sort' or 'columnar').
+Folder comparisons reuse cached results for unchanged file pairs, run with '--clear-cache' as the only argument to clear the cache.
 Compares both for discrepancies. If any are found they are noted into a file 'issues.txt' with their location in Excel format. 
+For running many comparisons from a manifest, see sheet_comparator_cli.py.
 
 Assumptions:
 - All fields should be the same
 - The unique identifier of each row is the first column 
 """
-import csv 
 import sys
 import os.path
 import time
+import inspect
+import itertools
 from enum import Enum
-from common_logic import xlsx_to_csv
-from openpyxl import Workbook, styles, load_workbook
+from operator import itemgetter
+from array import array
+from common_logic import READER_BACKEND, MappedCSV, map_csv, read_csv, xlsx_to_csv
+from normalisation_logic import compile_normalisation_rules, merge_rules
+from instrumentation_logic import PHASE, Instrumentation, start_phase, finish_phase
+from issue_writer_logic import EXCEL_MAX_ROWS, OUTPUT_FORMAT, get_output_format, create_issue_writer
+from pairing_logic import FilePair, plan_file_pairs
 import threading
 from queue import Queue, Empty
 
+# Engines only check whether to update the progress bar once every this many rows, rather than on every row
+PROGRESS_CHECK_INTERVAL_ROWS = 4096
+
 class Progress:
     def __init__(self, total_work, progress_bar):
         self.total_work = total_work
         self.completed_work = 0
-        self.lock = threading.Lock()
+        # Taking the next count is atomic, so threads can share the counter without a lock
+        self.completed_work_counter = itertools.count(1)
         self.progress_bar = progress_bar
     def update_progress(self):      
-        with self.lock:
-            if self.progress_bar:
-                self.completed_work += 1 
-                self.progress_bar(self.completed_work/self.total_work*100)
+        self.completed_work = next(self.completed_work_counter)
+        if self.progress_bar:
+            self.progress_bar(self.completed_work/self.total_work*100)
         return
 class NATURE_OF_ISSUES(Enum): 
     OK = "No issues found."
@@ -36,12 +48,100 @@ class NATURE_OF_ISSUES(Enum):
     FIELDS_MISMATCH = "Columns fields don't match, please check the issue log."
     FIELDS_LENGTH_MISMATCH = "The number of columns in each csv file don't match. Please check for any trailing commas with notepad."
     
+class ISSUE_TYPE(Enum):
+    MISMATCH = "Values differ between the sheets."
+    MISSING_ROW = "Row is missing from the uploaded sheet."
+    MISSING_COLUMNS = "Columns are missing from the uploaded sheet."
+    EXTRA_ROW = "Row only exists in the uploaded sheet."
+    DUPLICATE_KEY = "Identifier is repeated in the uploaded sheet, this row was replaced by a later row."
+
+class RESULT_MODE(Enum):
+    FULL = "full" # Every issue with its rows
+    COUNT_ONLY = "count_only" # Only the number of issues of each type and mismatches in each column, no rows are kept
+    STOP_AFTER = "stop_after" # Every issue with its rows until max_issues are found, then the comparison stops
+    FIRST_MISMATCH = "first_mismatch" # Stops at the first issue, for a quick answer to whether the sheets match
+
 class ISSUE_ITEM:
-    def __init__(self, original_row: list, uploaded_row: list, mismatched_columns_indexes: list) -> None:
-        self.original_row = original_row
-        self.uploaded_row = uploaded_row
-        self.mismatched_columns_indexes = mismatched_columns_indexes
-    
+    """
+    A single issue, kept compact as there can be millions of them.
+    Rows are held by reference rather than copied, and the uploaded row is only rearranged into the original sheet's column order
+    (or filled in with 'MISSING' for a row which only exists in one sheet) when it is read.
+    """
+    __slots__ = ('_original_row', 'mismatched_columns_indexes', 'issue_type', 'row_number', '_uploaded_row', '_uploaded_columns', '_identifier')
+
+    def __init__(self, 
+                 original_row: list, 
+                 uploaded_row: list, 
+                 mismatched_columns_indexes: list, 
+                 issue_type: ISSUE_TYPE = ISSUE_TYPE.MISMATCH, 
+                 uploaded_columns: tuple = None,
+                 identifier: str = None,
+                 row_number: int = None) -> None:
+        """
+        Args:
+            original_row: The original row, or None for a row which only exists in the uploaded sheet.
+            uploaded_row: The uploaded row as it was read, or None for a missing row.
+            uploaded_columns: Index in uploaded_row of each of the original sheet's columns, shared between every issue of a sheet. None if uploaded_row is already in order.
+            identifier: Value of the identifier of a row which only exists in one sheet.
+            row_number: Position of the row among the data rows of its sheet, starting from 0. The uploaded sheet's for EXTRA_ROW and DUPLICATE_KEY issues, otherwise the original sheet's.
+        """
+        self._original_row = original_row
+        self.mismatched_columns_indexes = array('i', mismatched_columns_indexes)
+        self.issue_type = issue_type
+        self.row_number = row_number
+        self._uploaded_row = uploaded_row
+        self._uploaded_columns = uploaded_columns
+        self._identifier = identifier
+
+    def _row_to_indicate_missing_row(self, row_length: int) -> list:
+        row_to_indicate_missing_row = ['MISSING'] * row_length
+        for column_of_identifier in self.mismatched_columns_indexes:
+            row_to_indicate_missing_row[column_of_identifier] = self._identifier
+        return row_to_indicate_missing_row
+
+    @property
+    def original_row(self) -> list:
+        if self._original_row == None:
+            return self._row_to_indicate_missing_row(len(self._uploaded_columns))
+        return self._original_row
+
+    @property
+    def uploaded_row(self) -> list:
+        if self.issue_type == ISSUE_TYPE.MISSING_ROW:
+            return self._row_to_indicate_missing_row(len(self._original_row))
+        if self._uploaded_columns == None:
+            return self._uploaded_row
+        return [self._uploaded_row[upl_field_idx] for upl_field_idx in self._uploaded_columns]
+
+    def key(self, identifying_field_index: int = 0) -> str:
+        """ Value of the row's identifier, None for missing columns. """
+        if self.issue_type == ISSUE_TYPE.MISSING_COLUMNS:
+            return None
+        if self._identifier != None:
+            return self._identifier
+        return self._original_row[identifying_field_index]
+
+    def discrepant_cells(self) -> tuple:
+        """
+        The cells which differ as the indexes of their columns in the original sheet, their original values and their uploaded values, 
+        with None for the values of a row or column which is missing. Every cell of a row which was missing, extra or replaced differs.
+        Returned as three sequences rather than a tuple per cell, as there can be tens of millions of cells.
+        """
+        column_indexes = self.mismatched_columns_indexes
+        if self.issue_type == ISSUE_TYPE.MISSING_COLUMNS:
+            return column_indexes, [None] * len(column_indexes), [None] * len(column_indexes)
+        original_row = self._original_row
+        if self.issue_type == ISSUE_TYPE.MISMATCH:
+            uploaded_row = self._uploaded_row
+            uploaded_columns = self._uploaded_columns
+            original_values = [original_row[column_index] for column_index in column_indexes]
+            if uploaded_columns == None:
+                return column_indexes, original_values, [uploaded_row[column_index] for column_index in column_indexes]
+            return column_indexes, original_values, [uploaded_row[uploaded_columns[column_index]] for column_index in column_indexes]
+        uploaded_row = None if self._uploaded_row == None else self.uploaded_row
+        row_length = len(original_row) if original_row != None else len(uploaded_row)
+        return range(row_length), original_row or [None] * row_length, uploaded_row or [None] * row_length
+
 class ISSUES_MAIN:
     def __init__(self) -> None:
         self.nature_of_issues: list[NATURE_OF_ISSUES] = [] 
@@ -50,52 +150,343 @@ class ISSUES_MAIN:
         self.original_fields: list[str] = []
         self.uploaded_fields: list[str] =[] 
         self.uploaded_hashed_fields_idxs: dict = {} #original field: uploaded field index 
+        self.uploaded_columns_in_original_order: tuple = () 
+        self.original_identifying_field_index = 0
+        # Counted for every result mode, even when the issues themselves aren't kept
+        self.issue_count = 0
+        self.issue_counts: dict = {} # ISSUE_TYPE: number of issues of that type
+        self.mismatch_counts: dict = {} # Index of an original column: number of mismatches in it
+        self.keep_rows = True
+        self.max_issues = None
+        self.limit_reached = False # Engines stop comparing once this is set
+        self.issue_sink = None # Receives each issue as it's found instead of issue_list, see issue_writer_logic
 
     def has_issues(self) -> bool:
         return len(self.nature_of_issues) > 0 
+
+    def set_result_mode(self, result_mode: RESULT_MODE = RESULT_MODE.FULL, max_issues: int = None) -> None:
+        """
+        Args:
+            max_issues: Number of issues to stop after in the STOP_AFTER mode.
+        """
+        result_mode = RESULT_MODE(result_mode)
+        self.keep_rows = result_mode != RESULT_MODE.COUNT_ONLY
+        self.max_issues = None
+        if result_mode == RESULT_MODE.FIRST_MISMATCH:
+            self.max_issues = 1
+        if result_mode == RESULT_MODE.STOP_AFTER:
+            if max_issues == None or max_issues < 1:
+                raise ValueError(f'The {result_mode.value} result mode needs max_issues to be at least 1, not {max_issues}.')
+            self.max_issues = max_issues
+
+    def count_issue(self, issue_type: ISSUE_TYPE, mismatched_columns_indexes = (), count: int = 1) -> bool:
+        """
+        Counts issues of a type, unless the comparison has already found as many issues as it was limited to.
+
+        Returns:
+            True if the issue's ISSUE_ITEM should be kept.
+        """
+        if self.limit_reached:
+            return False
+        self.issue_count += count
+        self.issue_counts[issue_type] = self.issue_counts.get(issue_type, 0) + count
+        for column_index in mismatched_columns_indexes:
+            self.mismatch_counts[column_index] = self.mismatch_counts.get(column_index, 0) + 1
+        if self.max_issues != None and self.issue_count >= self.max_issues:
+            self.limit_reached = True
+        return self.keep_rows
+
+    def store_issue(self, issue_item: ISSUE_ITEM) -> None:
+        """ Passes an issue on to the issue sink if there is one, otherwise keeps it in issue_list. """
+        if self.issue_sink != None:
+            self.issue_sink.write_issue(self, issue_item)
+        else:
+            self.issue_list.append(issue_item)
+
+    def add_issue(self, issue_item: ISSUE_ITEM) -> None:
+        """ Adds an issue found by another comparison, e.g. one part of a partitioned comparison. """
+        if self.count_issue(issue_item.issue_type, issue_item.mismatched_columns_indexes if issue_item.issue_type == ISSUE_TYPE.MISMATCH else ()):
+            self.store_issue(issue_item)
+
+    def add_counts(self, issues: 'ISSUES_MAIN') -> None:
+        """ Adds the counts of another comparison which didn't keep its issues. """
+        self.issue_count += issues.issue_count
+        for issue_type, count in issues.issue_counts.items():
+            self.issue_counts[issue_type] = self.issue_counts.get(issue_type, 0) + count
+        for column_index, count in issues.mismatch_counts.items():
+            self.mismatch_counts[column_index] = self.mismatch_counts.get(column_index, 0) + count
+
+    def mismatch_counts_by_field(self) -> dict:
+        """ Number of mismatches in each of the original sheet's columns which had any, keyed by field name. """
+        return {self.original_fields[column_index]: count for column_index, count in sorted(self.mismatch_counts.items())}
     
     def update_uploaded_hashed_fields_idxs(self) -> dict:
         for ori_field in self.original_fields:
             for upl_field_idx, upl_field in enumerate(self.uploaded_fields):
                 if upl_field == ori_field:
                     self.uploaded_hashed_fields_idxs[ori_field] = upl_field_idx
+        # The same mapping is shared by every issue rather than copying each uploaded row into the original's order
+        self.uploaded_columns_in_original_order = tuple(self.uploaded_hashed_fields_idxs[ori_field] for ori_field in self.original_fields)
         return self.uploaded_hashed_fields_idxs
     
-    def insert_issue_missing_uploaded_row(self, original_row: list, value_of_identifier: str, column_of_identifier: int = 0):
-        row_to_indicate_missing_row = []
-        for i in range(len(original_row)):
-            if i != column_of_identifier:
-                row_to_indicate_missing_row.append('MISSING')
-            else: 
-                row_to_indicate_missing_row.append(value_of_identifier)
-        issue_item = ISSUE_ITEM(original_row, row_to_indicate_missing_row, [column_of_identifier])
-        self.issue_list.append(issue_item)
+    def insert_issue_missing_uploaded_row(self, original_row: list, value_of_identifier: str, column_of_identifier: int = 0, row_number: int = None):
+        if not self.count_issue(ISSUE_TYPE.MISSING_ROW):
+            return None
+        issue_item = ISSUE_ITEM(original_row, None, [column_of_identifier], ISSUE_TYPE.MISSING_ROW, identifier=value_of_identifier, row_number=row_number)
+        self.store_issue(issue_item)
         return issue_item
 
-    def insert_issue(self, original_row: list, uploaded_row: list, columns_where_discrepancy_is_found: list[int]):
-        mapped_uploaded_row = [] 
-        for ori_field in self.original_fields:
-            upl_field_idx = self.uploaded_hashed_fields_idxs[ori_field]
-            value_from_upl_sheet = uploaded_row[upl_field_idx]
-            mapped_uploaded_row.append(value_from_upl_sheet)
-        issue_item = ISSUE_ITEM(original_row, mapped_uploaded_row, columns_where_discrepancy_is_found)
-        self.issue_list.append(issue_item)
+    def insert_issue(self, original_row: list, uploaded_row: list, columns_where_discrepancy_is_found: list[int], row_number: int = None):
+        if not self.count_issue(ISSUE_TYPE.MISMATCH, columns_where_discrepancy_is_found):
+            return None
+        issue_item = ISSUE_ITEM(original_row, uploaded_row, columns_where_discrepancy_is_found, uploaded_columns=self.uploaded_columns_in_original_order, row_number=row_number)
+        self.store_issue(issue_item)
+        return issue_item
+
+    def insert_issue_extra_uploaded_row(self, uploaded_row: list, value_of_identifier: str, column_of_identifier: int = 0, row_number: int = None):
+        """ Logs a row which only exists in the uploaded sheet, column_of_identifier is the identifier's column in the original sheet. """
+        if not self.count_issue(ISSUE_TYPE.EXTRA_ROW):
+            return None
+        issue_item = ISSUE_ITEM(None, uploaded_row, [column_of_identifier], ISSUE_TYPE.EXTRA_ROW, uploaded_columns=self.uploaded_columns_in_original_order, identifier=value_of_identifier, row_number=row_number)
+        self.store_issue(issue_item)
+        return issue_item
+
+    def insert_issue_duplicate_key(self, original_row: list, uploaded_row: list, value_of_identifier: str, column_of_identifier: int = 0, row_number: int = None):
+        """ Logs an uploaded row which was replaced by a later row with the same identifier, original_row is None if the original sheet doesn't have the identifier. """
+        if not self.count_issue(ISSUE_TYPE.DUPLICATE_KEY):
+            return None
+        issue_item = ISSUE_ITEM(original_row, uploaded_row, [column_of_identifier], ISSUE_TYPE.DUPLICATE_KEY, uploaded_columns=self.uploaded_columns_in_original_order, identifier=value_of_identifier, row_number=row_number)
+        self.store_issue(issue_item)
         return issue_item
 
     def insert_missing_column(self, original_columns, uploaded_columns, columns_missing_from_uploaded: list[str]):
+        # Always kept whatever the result mode, it's the only issue logged when the fields don't match
+        self.count_issue(ISSUE_TYPE.MISSING_COLUMNS)
         issue_item = ISSUE_ITEM(original_row=original_columns, 
                                  uploaded_row=uploaded_columns, 
-                                 mismatched_columns_indexes=columns_missing_from_uploaded)
-        self.issue_list.append(issue_item)
+                                 mismatched_columns_indexes=columns_missing_from_uploaded,
+                                 issue_type=ISSUE_TYPE.MISSING_COLUMNS)
+        self.store_issue(issue_item)
         return issue_item
 
+class COMPARISON_ENGINE(Enum):
+    HASH = "hash" # Caches the uploaded sheet in memory, fastest when it fits
+    EXTERNAL_SORT = "external_sort" # Sorts both sheets into temporary files on disk, for sheets larger than memory
+    COLUMNAR = "columnar" # Compares whole columns at once with NumPy, fastest on wide sheets
+
+def open_sheet(file_path: str, reader_backend: READER_BACKEND = READER_BACKEND.AUTO, snapshot_cache = None, sheet_name: str = None) -> tuple:
+    """
+    Opens a CSV or Excel sheet for reading.
+
+    Args:
+        reader_backend: Parser for CSV files, see common_logic.read_csv.
+        snapshot_cache: A cache_logic.SnapshotCache, Excel sheets which were parsed before are loaded from their snapshot instead.
+        sheet_name: Sheet of an Excel file to open, defaults to its active sheet. CSV files only have the one sheet.
+
+    Returns: 
+        The fields of the sheet and a common_logic.SheetRows over the remaining rows, close it once done.
+    """
+    # If Excel file given, convert to CSV first
+    if file_path.split('.')[-1] == 'csv': 
+        return read_csv(file_path, reader_backend)
+    if snapshot_cache != None:
+        return snapshot_cache.open_sheet(file_path, xlsx_to_csv, sheet_name)
+    return xlsx_to_csv(file_path, sheet_name)
+
+def open_sheets(uploaded_file_path: str, 
+                original_file_path: str, 
+                reader_backend: READER_BACKEND = READER_BACKEND.AUTO, 
+                snapshot_cache = None, 
+                map_uploaded: bool = False,
+                uploaded_sheet_name: str = None,
+                original_sheet_name: str = None) -> tuple:
+    """
+    Opens both sheets with open_sheet, the uploaded sheet is closed again if the original sheet can't be opened.
+    Only the original sheet is loaded from the snapshot_cache, it's the one which is compared against again and again.
+
+    Args:
+        map_uploaded: Open an uploaded CSV file as a common_logic.MappedCSV when it can be mapped.
+        uploaded_sheet_name, original_sheet_name: Sheets of Excel files to open, see open_sheet.
+
+    Returns:
+        The fields and rows of the uploaded sheet, then the fields and rows of the original sheet.
+    """
+    uploaded_mapped_csv = map_csv(uploaded_file_path) if map_uploaded else None
+    if uploaded_mapped_csv != None:
+        fields_uploaded, uploaded_rows = uploaded_mapped_csv.fields, uploaded_mapped_csv
+    else:
+        fields_uploaded, uploaded_rows = open_sheet(uploaded_file_path, reader_backend, sheet_name=uploaded_sheet_name)
+    try:
+        fields_ori, ori_rows = open_sheet(original_file_path, reader_backend, snapshot_cache, original_sheet_name)
+    except BaseException:
+        uploaded_rows.close()
+        raise
+    return fields_uploaded, uploaded_rows, fields_ori, ori_rows
+
+def issues_name(original_file_path: str, original_sheet_name: str = None) -> str:
+    """ Name of the issues of a comparison, which names its issue log. The original file's name, followed by the sheet's name if one was picked. """
+    name = original_file_path.split('/')[-1].split('.')[0]
+    return name if original_sheet_name == None else f'{name}-{original_sheet_name}'
+
+def check_fields(issues: ISSUES_MAIN) -> bool:
+    """
+    Checks if every field in the original sheet exists in the uploaded sheet, logging an issue if not.
+
+    Returns:
+        True if the fields match and the comparison can proceed.
+    """
+    mismatched_fields = []
+    for i in range(len(issues.original_fields)):
+        if issues.original_fields[i] not in issues.uploaded_fields:
+            issues.nature_of_issues.append(NATURE_OF_ISSUES.FIELDS_MISMATCH)
+            mismatched_fields.append(i)
+    if NATURE_OF_ISSUES.FIELDS_MISMATCH in issues.nature_of_issues: 
+        issues.insert_missing_column(issues.original_fields, issues.uploaded_fields, mismatched_fields)
+        return False
+    return True
+
+def resolve_identifying_field_indexes(issues: ISSUES_MAIN, uploaded_file_identifying_field_index: int, original_file_identifying_field_index: int) -> tuple:
+    """
+    Turns the identifier column indexes into positions from the first column once the fields are known, negative indexes count back
+    from the last column like they always have (-1 is the last column). Done by every engine so issues always point at a real column.
+
+    Returns:
+        The uploaded and original identifier column indexes. Raises a ValueError if either sheet has no such column.
+    """
+    resolved_indexes = []
+    for index, fields, sheet in ((uploaded_file_identifying_field_index, issues.uploaded_fields, 'uploaded'),
+                                 (original_file_identifying_field_index, issues.original_fields, 'original')):
+        # A sheet without a header has no rows to compare either
+        if len(fields) == 0:
+            resolved_indexes.append(index)
+            continue
+        if not -len(fields) <= index < len(fields):
+            raise ValueError(f'STOP: the identifier column {index} is not in the {sheet} sheet, it only has {len(fields)} column(s).')
+        resolved_indexes.append(index % len(fields))
+    issues.original_identifying_field_index = resolved_indexes[1]
+    return tuple(resolved_indexes)
+
+def compile_compared_columns(issues: ISSUES_MAIN, normalisation_rules: dict = None, ignore_leading_and_trailing_whitespaces: bool = False) -> list[tuple]:
+    """
+    Works out how to compare each column of the original sheet, done once before comparing any rows. 
+    Ignoring whitespaces is treated as a trim rule on every column.
+
+    Returns:
+        (original column index, uploaded column index, function telling if two cells match or None to compare cells as they are) for every field in the original sheet.
+    """
+    if ignore_leading_and_trailing_whitespaces:
+        normalisation_rules = merge_rules({"*": {"trim": True}}, normalisation_rules)
+    uploaded_hashed_fields_index = issues.update_uploaded_hashed_fields_idxs()
+    compiled_rules = compile_normalisation_rules(issues.original_fields, normalisation_rules)
+    return [(col_num, uploaded_hashed_fields_index[field], compiled_rules[col_num]) for col_num, field in enumerate(issues.original_fields)]
+
+def find_mismatched_columns(row_from_ori_csv: list, row_from_uploaded_csv: list, compared_columns: list[tuple]) -> list[int]:
+    """
+    Compares a row from the original sheet to its corresponding row from the uploaded sheet.
+
+    Args:
+        compared_columns: From compile_compared_columns.
+
+    Returns:
+        The original column indexes where the two rows differ.
+    """
+    mismatched_fields = []
+    for col_num, upl_col_num, cells_match in compared_columns:
+        cell_from_ori_csv = row_from_ori_csv[col_num]
+        cell_from_upl_csv = row_from_uploaded_csv[upl_col_num]
+        # Identical cells always match, the column's rules only need to run when they differ
+        if cell_from_ori_csv != cell_from_upl_csv and (cells_match == None or not cells_match(cell_from_ori_csv, cell_from_upl_csv)):
+            mismatched_fields.append(col_num)
+    return mismatched_fields
+
+def cells_getter(column_indexes: list[int]):
+    """ Returns a function which picks the given columns out of a row as a tuple. """
+    if len(column_indexes) == 1:
+        column_index = column_indexes[0]
+        return lambda row: (row[column_index],)
+    return itemgetter(*column_indexes)
+
+def row_digest(cells: tuple, ignore_leading_and_trailing_whitespaces: bool = False) -> int:
+    """
+    Digest of a row's cells, rows with different digests are certain to differ and rows with equal digests can be treated as equal.
+    Python's tuple hash is used as it is computed in C and each string caches its own hash, the odds of two different rows colliding are around 1 in 2^64.
+    """
+    if ignore_leading_and_trailing_whitespaces:
+        cells = tuple(map(str.strip, cells))
+    return hash(cells)
+
+def log_unmatched_uploaded_rows(issues: ISSUES_MAIN,
+                                extra_rows: list[tuple],
+                                duplicate_rows: list[tuple],
+                                original_rows_by_identifier: dict,
+                                uploaded_file_identifying_field_index: int = 0,
+                                original_file_identifying_field_index: int = 0) -> None:
+    """
+    Logs the uploaded rows which were never compared against an original row, in the order of the uploaded sheet. 
+    Used by every engine so they all report these rows the same way.
+
+    Args:
+        extra_rows: (uploaded row number, row) of rows whose identifier isn't in the original sheet.
+        duplicate_rows: (uploaded row number, row) of rows replaced by a later row with the same identifier.
+        original_rows_by_identifier: The first original row of each repeated identifier which is in the original sheet.
+    """
+    if not issues.keep_rows:
+        # Only counted, the rows may not have been read
+        if len(extra_rows):
+            issues.count_issue(ISSUE_TYPE.EXTRA_ROW, count=len(extra_rows))
+        if len(duplicate_rows):
+            issues.count_issue(ISSUE_TYPE.DUPLICATE_KEY, count=len(duplicate_rows))
+        return
+    extra_row_numbers = {row_num for row_num, _ in extra_rows}
+    for row_num, row in sorted(extra_rows + duplicate_rows, key=itemgetter(0)):
+        if issues.limit_reached:
+            return
+        is_extra_row = row_num in extra_row_numbers
+        original_row = None if is_extra_row else original_rows_by_identifier.get(row[uploaded_file_identifying_field_index])
+        log_unmatched_uploaded_row(issues, row_num, row, is_extra_row, original_row, uploaded_file_identifying_field_index, original_file_identifying_field_index)
+
+def log_unmatched_uploaded_row(issues: ISSUES_MAIN,
+                               row_num: int,
+                               row: list,
+                               is_extra_row: bool,
+                               original_row: list = None,
+                               uploaded_file_identifying_field_index: int = 0,
+                               original_file_identifying_field_index: int = 0) -> None:
+    """
+    Logs one uploaded row which was never compared, see log_unmatched_uploaded_rows.
+
+    Args:
+        is_extra_row: True if the row's identifier isn't in the original sheet, False if it was replaced by a later row with the same identifier.
+        original_row: The first original row with the identifier of a replaced row, if the original sheet has it.
+    """
+    identifier = row[uploaded_file_identifying_field_index]
+    if is_extra_row:
+        issues.insert_issue_extra_uploaded_row(row, identifier, original_file_identifying_field_index, row_num)
+    else:
+        issues.insert_issue_duplicate_key(original_row, row, identifier, original_file_identifying_field_index, row_num)
+
 def find_discrepancies(uploaded_file_path: str, 
                        original_file_path: str, 
                        progress_to_show_in_gui = None,
                        status_to_show_in_gui = None,
                        uploaded_file_identifying_field_index: int = 0,
                        original_file_identifying_field_index: int = 0,
-                       ignore_leading_and_trailing_whitespaces: bool = False) -> ISSUES_MAIN:
+                       ignore_leading_and_trailing_whitespaces: bool = False,
+                       comparison_engine: COMPARISON_ENGINE = COMPARISON_ENGINE.HASH,
+                       memory_budget_mb: int = 256,
+                       use_row_digests: bool = False,
+                       use_offset_index: bool = False,
+                       normalisation_rules: dict = None,
+                       full_outer_diff: bool = True,
+                       num_partitions: int = 1,
+                       result_mode: RESULT_MODE = RESULT_MODE.FULL,
+                       max_issues: int = None,
+                       issue_sink = None,
+                       reader_backend: READER_BACKEND = READER_BACKEND.AUTO,
+                       snapshot_cache = None,
+                       uploaded_sheet_name: str = None,
+                       original_sheet_name: str = None,
+                       instrumentation: Instrumentation = None) -> ISSUES_MAIN:
     """
     Finds the difference between two CSV files. 
 
@@ -103,117 +494,218 @@ def find_discrepancies(uploaded_file_path: str,
         uploaded_file_path: The path that points to the CSV file which should match the original. 
         original_file_path: The path that points to the CSV file which is meant to be compared against (or in other words, this CSV file is the source of truth).
         progress_to_show_in_gui: A function from the GUI Python file which accepts the current percentage progress of the script as an integer.
+        comparison_engine: HASH caches the uploaded sheet in memory, EXTERNAL_SORT sorts both sheets on disk to compare sheets larger than memory, COLUMNAR compares whole columns at once with NumPy.
+        memory_budget_mb: Approximate memory the EXTERNAL_SORT engine may use, split between sorting the two sheets.
+        use_row_digests: HASH engine only, compares a digest of each pair of rows first and only compares cell by cell when the digests differ.
+        use_offset_index: HASH engine only, memory-maps an uploaded CSV file and only keeps where each row starts rather than the row itself,
+            rows are parsed again when they're compared or reported. Uses a fraction of the memory for a second parse of the uploaded rows,
+            with use_row_digests only the rows which differ are parsed again. Files which can't be mapped are read into memory as usual.
+        normalisation_rules: Rules for each column which decide if two cells are equal, see normalisation_logic.
+        full_outer_diff: Also report uploaded rows whose identifier isn't in the original sheet, and uploaded rows replaced by a later row with the same identifier.
+        num_partitions: Split both sheets into this many parts by their identifier and compare the parts in parallel worker processes with the chosen engine.
+        result_mode: FULL keeps every issue. COUNT_ONLY only counts the issues of each type and the mismatches in each column, see ISSUES_MAIN.issue_counts.
+            STOP_AFTER stops comparing once max_issues are found, FIRST_MISMATCH stops at the first issue.
+            The hash and columnar engines keep the first issues in the original sheet's order, the external sort engine keeps the first in its identifiers' order.
+        max_issues: Number of issues to stop after in the STOP_AFTER mode.
+        issue_sink: Receives each issue as soon as it's found instead of the returned issue_list, e.g. a writer from issue_writer_logic.
+        reader_backend: Parser for CSV files, AUTO picks the fastest installed, see common_logic.read_csv. Doesn't change the result.
+        snapshot_cache: A cache_logic.SnapshotCache, an original Excel sheet which was parsed before is loaded from its snapshot instead of being parsed again.
+        uploaded_sheet_name, original_sheet_name: Sheets to compare when the files are Excel workbooks, defaults to their active sheets. See workbook_logic to compare every sheet.
+        instrumentation: Records the time, rows, issues and memory of each phase of the comparison, see instrumentation_logic.
 
     Returns: 
         A list containing strings of the discrepancies found.
     """
+    if num_partitions > 1:
+        from partition_logic import find_discrepancies_partitioned
+        return find_discrepancies_partitioned(uploaded_file_path=uploaded_file_path,
+                                              original_file_path=original_file_path,
+                                              progress_to_show_in_gui=progress_to_show_in_gui,
+                                              status_to_show_in_gui=status_to_show_in_gui,
+                                              uploaded_file_identifying_field_index=uploaded_file_identifying_field_index,
+                                              original_file_identifying_field_index=original_file_identifying_field_index,
+                                              num_partitions=num_partitions,
+                                              ignore_leading_and_trailing_whitespaces=ignore_leading_and_trailing_whitespaces,
+                                              comparison_engine=COMPARISON_ENGINE(comparison_engine),
+                                              memory_budget_mb=memory_budget_mb,
+                                              use_row_digests=use_row_digests,
+                                              use_offset_index=use_offset_index,
+                                              normalisation_rules=normalisation_rules,
+                                              full_outer_diff=full_outer_diff,
+                                              result_mode=result_mode,
+                                              max_issues=max_issues,
+                                              issue_sink=issue_sink,
+                                              reader_backend=reader_backend,
+                                              snapshot_cache=snapshot_cache,
+                                              uploaded_sheet_name=uploaded_sheet_name,
+                                              original_sheet_name=original_sheet_name,
+                                              instrumentation=instrumentation)
+    if COMPARISON_ENGINE(comparison_engine) == COMPARISON_ENGINE.EXTERNAL_SORT:
+        from external_sort_logic import find_discrepancies_external_sort
+        return find_discrepancies_external_sort(uploaded_file_path=uploaded_file_path,
+                                                original_file_path=original_file_path,
+                                                progress_to_show_in_gui=progress_to_show_in_gui,
+                                                status_to_show_in_gui=status_to_show_in_gui,
+                                                uploaded_file_identifying_field_index=uploaded_file_identifying_field_index,
+                                                original_file_identifying_field_index=original_file_identifying_field_index,
+                                                ignore_leading_and_trailing_whitespaces=ignore_leading_and_trailing_whitespaces,
+                                                memory_budget_mb=memory_budget_mb,
+                                                normalisation_rules=normalisation_rules,
+                                                full_outer_diff=full_outer_diff,
+                                                result_mode=result_mode,
+                                                max_issues=max_issues,
+                                                issue_sink=issue_sink,
+                                                reader_backend=reader_backend,
+                                                snapshot_cache=snapshot_cache,
+                                                uploaded_sheet_name=uploaded_sheet_name,
+                                                original_sheet_name=original_sheet_name,
+                                                instrumentation=instrumentation)
+    if COMPARISON_ENGINE(comparison_engine) == COMPARISON_ENGINE.COLUMNAR:
+        from columnar_logic import find_discrepancies_columnar
+        return find_discrepancies_columnar(uploaded_file_path=uploaded_file_path,
+                                           original_file_path=original_file_path,
+                                           progress_to_show_in_gui=progress_to_show_in_gui,
+                                           status_to_show_in_gui=status_to_show_in_gui,
+                                           uploaded_file_identifying_field_index=uploaded_file_identifying_field_index,
+                                           original_file_identifying_field_index=original_file_identifying_field_index,
+                                           ignore_leading_and_trailing_whitespaces=ignore_leading_and_trailing_whitespaces,
+                                           normalisation_rules=normalisation_rules,
+                                           full_outer_diff=full_outer_diff,
+                                           result_mode=result_mode,
+                                           max_issues=max_issues,
+                                           issue_sink=issue_sink,
+                                           reader_backend=reader_backend,
+                                           snapshot_cache=snapshot_cache,
+                                           uploaded_sheet_name=uploaded_sheet_name,
+                                           original_sheet_name=original_sheet_name,
+                                           instrumentation=instrumentation)
+
     # Update status
     previous_update = 0 # For GUI 
 
-    # If Excel file given, convert to CSV first
-    if uploaded_file_path.split('.')[-1] == 'csv': 
-        # Read uploaded csv file
-        f_uploaded = open(uploaded_file_path, 'r')
-        uploaded_csv_reader = csv.reader(f_uploaded)
-        # Field names 
-        fields_uploaded_csv = next(uploaded_csv_reader)
-    else:
-        fields_uploaded_csv, uploaded_csv_reader = xlsx_to_csv(uploaded_file_path)
-    if original_file_path.split('.')[-1] == 'csv': 
-        # Read original csv file
-        f_ori = open(original_file_path, 'r')
-        ori_csv_reader = csv.reader(f_ori)
-        # Field names 
-        fields_ori_csv = next(ori_csv_reader)
-    else:
-        fields_ori_csv, ori_csv_reader = xlsx_to_csv(original_file_path)
-
     # Initialise issues custom class to hold all the found issues (if any)
     issues = ISSUES_MAIN()
-    issues.name = original_file_path.split('/')[-1].split('.')[0]
-    # Save the fields for later use 
-    issues.original_fields = fields_ori_csv
-    issues.uploaded_fields = fields_uploaded_csv
+    issues.name = issues_name(original_file_path, original_sheet_name)
+    issues.original_identifying_field_index = original_file_identifying_field_index
+    issues.set_result_mode(result_mode, max_issues)
+    issues.issue_sink = issue_sink
 
-    # Checking if every field in the original csv exists in the uploaded csv - If failed will not proceed with rest of check, return issue log immediately
-    mismatched_fields = []
-    for i in range(len(fields_ori_csv)):
-        if fields_ori_csv[i] not in fields_uploaded_csv:
-            issues.nature_of_issues.append(NATURE_OF_ISSUES.FIELDS_MISMATCH)
-            mismatched_fields.append(i)
-    if NATURE_OF_ISSUES.FIELDS_MISMATCH in issues.nature_of_issues: 
-        issues.insert_missing_column(fields_ori_csv, fields_uploaded_csv, mismatched_fields)
-        # TODO Toggle for checking regardless of fields being mismatched
-        return issues
-    
-    # Update status
-    if status_to_show_in_gui:
-        status_to_show_in_gui(f'Caching uploaded sheet {issues.name}')
-    if progress_to_show_in_gui != None:
-        progress_to_show_in_gui(0)
+    phase = start_phase(instrumentation, PHASE.OPEN, issues.name)
+    fields_uploaded_csv, uploaded_csv_reader, fields_ori_csv, ori_csv_reader = open_sheets(uploaded_file_path, original_file_path, reader_backend, snapshot_cache, use_offset_index, uploaded_sheet_name, original_sheet_name)
+    # Rows of a mapped uploaded sheet aren't kept, they're parsed again from the file by their row number when needed
+    uploaded_mapped_csv = uploaded_csv_reader if isinstance(uploaded_csv_reader, MappedCSV) else None
+    def uploaded_row(row: list, upl_row_num: int) -> list:
+        return row if row != None else uploaded_mapped_csv.row(upl_row_num)
 
-    # Hash the uploaded csv file based on its key value
-    uploaded_hashed_csv = {}
-    for row in uploaded_csv_reader:
-        uploaded_hashed_csv[row[uploaded_file_identifying_field_index]] = row
+    # Both sheets are closed however the comparison ends, even if it stops early or fails partway through
+    try:
+        # Save the fields for later use 
+        issues.original_fields = fields_ori_csv
+        issues.uploaded_fields = fields_uploaded_csv
 
-    # Update status
-    if progress_to_show_in_gui != None:
-        progress_to_show_in_gui(25)
+        # Checking if every field in the original csv exists in the uploaded csv - If failed will not proceed with rest of check, return issue log immediately
+        fields_match = check_fields(issues)
+        finish_phase(instrumentation, phase, issues=len(issues.issue_list))
+        if not fields_match: 
+            # TODO Toggle for checking regardless of fields being mismatched
+            return issues
+        uploaded_file_identifying_field_index, original_file_identifying_field_index = resolve_identifying_field_indexes(issues, uploaded_file_identifying_field_index, original_file_identifying_field_index)
 
-    # Hash the indexes of the uploaded csv fields
-    uploaded_hashed_fields_index = issues.update_uploaded_hashed_fields_idxs()
+        # Update status
+        if status_to_show_in_gui:
+            status_to_show_in_gui(f'Caching uploaded sheet {issues.name}')
+        if progress_to_show_in_gui != None:
+            progress_to_show_in_gui(0)
 
-    # Close the uploaded csv file, it's no longer needed as its now been hashed into memory
-    try:
-        f_uploaded.close()
-    except UnboundLocalError: 
-        pass
+        # Hash the indexes of the uploaded csv fields and compile how each column is compared
+        phase = start_phase(instrumentation, PHASE.MAP_FIELDS, issues.name)
+        compared_columns = compile_compared_columns(issues, normalisation_rules, ignore_leading_and_trailing_whitespaces)
+        # Digests are taken over the cells in the original sheet's column order, so matching rows have matching digests
+        get_ori_cells = cells_getter([col_num for col_num, _, _ in compared_columns])
+        get_uploaded_cells = cells_getter([upl_col_num for _, upl_col_num, _ in compared_columns])
+        finish_phase(instrumentation, phase)
 
-    # Update status
-    if status_to_show_in_gui:
-        status_to_show_in_gui(f'Comparing sheet {issues.name}')
-
-    # For each row in the original csv file
-    # Check if it exists in the uploaded csv file
-    # If it exists, compare that row of values to the original 
-    # Each ROW 
-    for row_num, row_from_ori_csv in enumerate( ori_csv_reader ):
-        # Row from original sheet cannot be found in the uploaded sheet
-        if row_from_ori_csv[original_file_identifying_field_index] not in uploaded_hashed_csv:
-            issues.insert_issue_missing_uploaded_row(row_from_ori_csv, row_from_ori_csv[original_file_identifying_field_index], original_file_identifying_field_index)
-            continue
+        # Hash the uploaded csv file based on its key value, keeping the digest and row number of each row next to it
+        phase = start_phase(instrumentation, PHASE.HASH_UPLOADED, issues.name)
+        uploaded_hashed_csv = {}
+        uploaded_duplicate_rows = [] # (row number, row) of rows replaced by a later row with the same identifier
+        upl_row_num = -1
+        for upl_row_num, row in enumerate(uploaded_csv_reader):
+            digest = row_digest(get_uploaded_cells(row), ignore_leading_and_trailing_whitespaces) if use_row_digests else None
+            identifier = row[uploaded_file_identifying_field_index]
+            if full_outer_diff and identifier in uploaded_hashed_csv:
+                _, replaced_row, replaced_row_num = uploaded_hashed_csv[identifier]
+                uploaded_duplicate_rows.append((replaced_row_num, uploaded_row(replaced_row, replaced_row_num)))
+            uploaded_hashed_csv[identifier] = (digest, row if uploaded_mapped_csv == None else None, upl_row_num)
+        # First original row of each repeated identifier, filled in while comparing
+        original_rows_by_duplicate_identifier = dict.fromkeys(row[uploaded_file_identifying_field_index] for _, row in uploaded_duplicate_rows)
+        consumed_identifiers = set()
 
-        # Corresponding row from the uploaded sheet 
-        row_from_uploaded_csv = uploaded_hashed_csv[row_from_ori_csv[original_file_identifying_field_index]]
-
-        # Each COLUMN (CELL)
-        mismatched_fields = []
-        for col_num in range(len(fields_ori_csv)):
-            cell_from_ori_csv = row_from_ori_csv[col_num]
-            cell_from_upl_csv = row_from_uploaded_csv[uploaded_hashed_fields_index[fields_ori_csv[col_num]]]
-            if ignore_leading_and_trailing_whitespaces:
-                cell_from_ori_csv = cell_from_ori_csv.strip() 
-                cell_from_upl_csv = cell_from_upl_csv.strip()
-            if cell_from_ori_csv != cell_from_upl_csv:
-                mismatched_fields.append(col_num)
-        if len(mismatched_fields) > 0: 
-            issues.insert_issue(row_from_ori_csv,row_from_uploaded_csv,mismatched_fields)
-        
-        # GUI progress bars
-        progress_in_percentage = min( int(row_num / len(uploaded_hashed_csv)*75) + 25, 100)
-        if progress_to_show_in_gui != None and previous_update != progress_in_percentage:
-            progress_to_show_in_gui(progress_in_percentage)
-            previous_update = progress_in_percentage
-    
-    # Mark issues found 
-    if len(issues.issue_list): issues.nature_of_issues.append(NATURE_OF_ISSUES.DISCREPANCY)  
+        # Update status
+        if progress_to_show_in_gui != None:
+            progress_to_show_in_gui(25)
 
-    # Close the original csv file, we've read through everything 
-    try:
-        f_ori.close()
-    except UnboundLocalError: 
-        pass
+        # Close the uploaded csv file, it's no longer needed as its now been hashed into memory. A mapped file stays open to parse its rows again
+        if uploaded_mapped_csv == None:
+            uploaded_csv_reader.close()
+        finish_phase(instrumentation, phase, rows=upl_row_num + 1)
+
+        # Update status
+        if status_to_show_in_gui:
+            status_to_show_in_gui(f'Comparing sheet {issues.name}')
+
+        phase = start_phase(instrumentation, PHASE.COMPARE, issues.name)
+        row_num = -1
+
+        # For each row in the original csv file
+        # Check if it exists in the uploaded csv file
+        # If it exists, compare that row of values to the original 
+        # Each ROW 
+        for row_num, row_from_ori_csv in enumerate( ori_csv_reader ):
+            # Row from original sheet cannot be found in the uploaded sheet
+            if row_from_ori_csv[original_file_identifying_field_index] not in uploaded_hashed_csv:
+                issues.insert_issue_missing_uploaded_row(row_from_ori_csv, row_from_ori_csv[original_file_identifying_field_index], original_file_identifying_field_index, row_num)
+                if issues.limit_reached:
+                    break
+                continue
+
+            # Corresponding row from the uploaded sheet 
+            identifier = row_from_ori_csv[original_file_identifying_field_index]
+            uploaded_digest, row_from_uploaded_csv, matched_upl_row_num = uploaded_hashed_csv[identifier]
+            if full_outer_diff:
+                consumed_identifiers.add(identifier)
+                if identifier in original_rows_by_duplicate_identifier and original_rows_by_duplicate_identifier[identifier] == None:
+                    original_rows_by_duplicate_identifier[identifier] = row_from_ori_csv
+
+            # Each COLUMN (CELL), only needed when the digests show the rows differ
+            if not use_row_digests or uploaded_digest != row_digest(get_ori_cells(row_from_ori_csv), ignore_leading_and_trailing_whitespaces):
+                row_from_uploaded_csv = uploaded_row(row_from_uploaded_csv, matched_upl_row_num)
+                mismatched_fields = find_mismatched_columns(row_from_ori_csv, row_from_uploaded_csv, compared_columns)
+                if len(mismatched_fields) > 0: 
+                    issues.insert_issue(row_from_ori_csv,row_from_uploaded_csv,mismatched_fields,row_num)
+                    if issues.limit_reached:
+                        break
+
+            # GUI progress bars, only checked every so many rows to keep the loop fast
+            if progress_to_show_in_gui != None and row_num % PROGRESS_CHECK_INTERVAL_ROWS == 0:
+                progress_in_percentage = min( int(row_num / max(len(uploaded_hashed_csv), 1)*75) + 25, 100)
+                if previous_update != progress_in_percentage:
+                    progress_to_show_in_gui(progress_in_percentage)
+                    previous_update = progress_in_percentage
+
+        # Uploaded rows which were never compared
+        if full_outer_diff and not issues.limit_reached:
+            # Counting the rows doesn't need them parsed again
+            extra_rows = [(upl_row_num, uploaded_row(row, upl_row_num) if issues.keep_rows else row) for identifier, (_, row, upl_row_num) in uploaded_hashed_csv.items() if identifier not in consumed_identifiers]
+            log_unmatched_uploaded_rows(issues, extra_rows, uploaded_duplicate_rows, original_rows_by_duplicate_identifier, uploaded_file_identifying_field_index, original_file_identifying_field_index)
+
+        # Mark issues found 
+        if issues.issue_count: issues.nature_of_issues.append(NATURE_OF_ISSUES.DISCREPANCY)  
+
+        finish_phase(instrumentation, phase, rows=row_num + 1, issues=issues.issue_count)
+    finally:
+        uploaded_csv_reader.close()
+        ori_csv_reader.close()
 
     # Update status
     if status_to_show_in_gui:
@@ -221,99 +713,76 @@ def find_discrepancies(uploaded_file_path: str,
 
     return issues
 
-def write_issues(issues: ISSUES_MAIN, output_dir: str = "", use_excel: bool = False, progress_bar = None, progress_status = None) -> None: 
-    # Writing logic for a text file
-    def write_to_text():
-        f = open(log_file_path, 'a+', encoding='utf-8')
-        for row in issues.issue_list:
-            original_row = 'ORI |'
-            for x, item in enumerate(row.original_row): 
-                if x in row.mismatched_columns_indexes:
-                    original_row += f' <|{item}|>'
-                else:
-                    original_row += f' {item}'
-            uploaded_row = 'UPL |'
-            for x, item in enumerate(row.uploaded_row): 
-                if x in row.mismatched_columns_indexes:
-                    uploaded_row += f' <|{item}|>'
-                else:
-                    uploaded_row += f' {item}'
-            f.write(f'{original_row}\n')
-            f.write(f'{uploaded_row}\n')
-            f.write(f'\n')
-        f.close()
-        return
-
-    # Writing logic for excel
-    def write_to_excel():
-        if not os.path.isfile(log_file_path):
-            wb = Workbook()
-            wb.save(log_file_path)
-        sheet = wb.active # Create a pointer to the current sheet
-
-        # Insert the fields based on the original file
-        for column_no, field in enumerate(issues.original_fields):
-            sheet.cell(row=1, column=column_no+2).value = field
+def write_issues(issues: ISSUES_MAIN, 
+                 output_dir: str = "", 
+                 use_excel: bool = False, 
+                 progress_bar = None, 
+                 progress_status = None,
+                 max_rows_per_sheet: int = EXCEL_MAX_ROWS,
+                 max_sheets_per_file: int = 16,
+                 instrumentation: Instrumentation = None,
+                 output_format: OUTPUT_FORMAT = None) -> str: 
+    """
+    Writes the issues found to a text file, or to an Excel file if use_excel is set. 
+    Excel output is split over multiple sheets once a sheet reaches max_rows_per_sheet, and over multiple files once a file has max_sheets_per_file sheets.
+    See find_and_write_discrepancies to write the issues while comparing instead.
 
-        # Insert the issues 
-        current_row = 2
-        for issue in issues.issue_list:
-            current_column = 1
-
-            # Place the identifier in the first column 
-            sheet.cell(row=current_row, column=current_column).value = 'ORI'
-            
-            # For every following column, put in the values from the original sheet
-            current_column = 2
-            for value in issue.original_row: 
-                sheet.cell(row=current_row, column=current_column).value = value
-                current_column += 1 
-
-            # Highlight the columns that have discrepancies
-            for mismatched_column_index in issue.mismatched_columns_indexes:
-                # Ensure to offset the column as the first column is always the identifier
-                sheet.cell(row=current_row, column=mismatched_column_index+2).fill = styles.PatternFill(fill_type="solid", fgColor="26B688")
-            
-            # Place identifier for the second column 
-            current_column = 1
-            current_row += 1
-            sheet.cell(row=current_row, column=current_column).value = 'UPL'
-
-            # For every following column, put values from the uploaded sheet
-            current_column = 2
-            for value in issue.uploaded_row: 
-                sheet.cell(row=current_row, column=current_column).value = value
-                current_column += 1    
-            
-            # Highlight the columns that have discrepancies
-            for mismatched_column_index in issue.mismatched_columns_indexes:
-                # Ensure to offset the column as the first column is always the identifier
-                sheet.cell(row=current_row, column=mismatched_column_index+2).fill = styles.PatternFill(fill_type="solid", fgColor="FF8080")
-
-            current_row += 1
-
-        wb.save(log_file_path)
-        return
+    Args:
+        output_format: Format to write the issues in instead of use_excel, e.g. OUTPUT_FORMAT.CSV for one row per cell which differs.
 
+    Returns:
+        The path of the issue log (the first file if Excel output was split), or None if there were no issues to write.
+    """
     # Exit prematurely if there's no issues to write
     if len(issues.issue_list) == 0: 
-        return
+        return None
 
     # Get the exact path and file to log 
-    log_file_path = f'{output_dir}/issues_{issues.name}_{time.strftime("%Y_%m_%d_%H_%M_%S", time.gmtime())}'
-    if use_excel: 
-        log_file_path += '.xlsx'
-        write_to_excel()
-    else:
-        log_file_path += '.txt'
-        write_to_text()
+    phase = start_phase(instrumentation, PHASE.WRITE_ISSUES, issues.name)
+    writer = create_issue_writer(get_output_format(output_format, use_excel), output_dir, max_rows_per_sheet=max_rows_per_sheet, max_sheets_per_file=max_sheets_per_file)
+    with writer:
+        for issue in issues.issue_list:
+            writer.write_issue(issues, issue)
+    log_file_path = writer.log_file_path
+    # Each issue is written as an original and an uploaded row
+    finish_phase(instrumentation, phase, rows=len(issues.issue_list)*2, issues=len(issues.issue_list))
     
     if progress_status:
         progress_status(f'Wrote issues to {log_file_path}')
 
-    return
+    return log_file_path
 
-def write_multiple_issues(issue_main_list: list[ISSUES_MAIN], progress_bar = None, progress_status = None, output_dir: str = "", output_to_excel: bool = True) -> None:
+def find_and_write_discrepancies(uploaded_file_path: str,
+                                 original_file_path: str,
+                                 output_dir: str = "",
+                                 use_excel: bool = False,
+                                 log_name: str = None,
+                                 status_to_show_in_gui = None,
+                                 output_format: OUTPUT_FORMAT = None,
+                                 **comparison_options) -> tuple:
+    """
+    Compares two sheets like find_discrepancies, but writes each issue to the issue log as soon as it's found instead of keeping
+    every issue in memory, so memory stays flat however many issues there are.
+    The external sort engine writes its issues in the order of the identifiers rather than the order of the original sheet.
+
+    Args:
+        log_name: Name of the issue log instead of the original sheet's name, see IssueLogWriter.
+        output_format: Format to write the issues in instead of use_excel, see write_issues.
+
+    Returns:
+        The ISSUES_MAIN, which counts the issues but doesn't hold them, and the path of the issue log or None if there were no issues.
+    """
+    writer = create_issue_writer(get_output_format(output_format, use_excel), output_dir, log_name)
+    with writer:
+        issues = find_discrepancies(uploaded_file_path, original_file_path, status_to_show_in_gui=status_to_show_in_gui, issue_sink=writer, **comparison_options)
+    # The writer is finished with, and holds an open file which can't be sent back from a worker process
+    issues.issue_sink = None
+    if status_to_show_in_gui and writer.log_file_path != None:
+        status_to_show_in_gui(f'Wrote issues to {writer.log_file_path}')
+    return issues, writer.log_file_path
+
+def write_multiple_issues(issue_main_list: list[ISSUES_MAIN], progress_bar = None, progress_status = None, output_dir: str = "", output_to_excel: bool = True, instrumentation: Instrumentation = None, output_format: OUTPUT_FORMAT = None) -> str:
+    """ Writes the issue log of every sheet into a new folder in output_dir, returning the folder's path or None if no sheet had issues. """
     folder_name = str(f'issues_{time.strftime("%Y_%m_%d_%H_%M_%S", time.gmtime())}')
 
     if progress_status != None: 
@@ -324,9 +793,10 @@ def write_multiple_issues(issue_main_list: list[ISSUES_MAIN], progress_bar = Non
     # Check if there are any valid issues to log
     has_issues_in_general = any(item.has_issues() for item in issue_main_list)
     # If no valid issues to log, exit the function and tell user 
-    if progress_status != None and has_issues_in_general == False: 
-        progress_status(f'Done! No issues found ᕙ(⇀‸↼‶)ᕗ')
-        return
+    if has_issues_in_general == False: 
+        if progress_status != None:
+            progress_status(f'Done! No issues found ᕙ(⇀‸↼‶)ᕗ')
+        return None
     
     # Create a folder for the current log job
     folder_path_for_job = f'{output_dir}/{folder_name}'
@@ -348,7 +818,7 @@ def write_multiple_issues(issue_main_list: list[ISSUES_MAIN], progress_bar = Non
         while True:
             try:
                 issue = task_queue.get(False)  # Try to get an item without blocking
-                write_issues(issue, output_dir=folder_path_for_job, use_excel=output_to_excel)
+                write_issues(issue, output_dir=folder_path_for_job, use_excel=output_to_excel, instrumentation=instrumentation, output_format=output_format)
                 p.update_progress()
                 task_queue.task_done()
             except Empty: 
@@ -367,9 +837,9 @@ def write_multiple_issues(issue_main_list: list[ISSUES_MAIN], progress_bar = Non
     if progress_status != None: 
         progress_status(f'Done! Check issues_{folder_name}.')
 
-    return
+    return folder_path_for_job
 
-def write_multiple_issues_single_threaded(issue_main_list: list[ISSUES_MAIN], progress_bar = None, progress_status = None, output_dir: str = "", output_to_excel: bool = True) -> None:
+def write_multiple_issues_single_threaded(issue_main_list: list[ISSUES_MAIN], progress_bar = None, progress_status = None, output_dir: str = "", output_to_excel: bool = True, instrumentation: Instrumentation = None, output_format: OUTPUT_FORMAT = None) -> None:
     has_issues_in_general = any(item.has_issues() for item in issue_main_list)
     if has_issues_in_general:
         folder_path_for_job = str(f'{output_dir}/issues_{time.strftime("%Y_%m_%d_%H_%M_%S", time.gmtime())}')
@@ -380,34 +850,119 @@ def write_multiple_issues_single_threaded(issue_main_list: list[ISSUES_MAIN], pr
                 if progress_bar != None and progress_status != None:
                     progress_bar(i/len(issue_main_list)*100)
                     progress_status(f'Creating issue log for {issue.name}')
-                write_issues(issue, output_dir=folder_path_for_job, use_excel=output_to_excel)
+                write_issues(issue, output_dir=folder_path_for_job, use_excel=output_to_excel, instrumentation=instrumentation, output_format=output_format)
         if progress_status != None: 
             progress_status(f'Done! Check {folder_path_for_job}.')
     if progress_status != None and has_issues_in_general == False: 
         progress_status(f'Done! No issues found ᕙ(⇀‸↼‶)ᕗ')
     return 
 
+# Options of find_discrepancies which change its result, these make up part of the result cache key
+RESULT_AFFECTING_OPTIONS = ('uploaded_file_identifying_field_index', 
+                            'original_file_identifying_field_index', 
+                            'ignore_leading_and_trailing_whitespaces',
+                            'normalisation_rules',
+                            'full_outer_diff',
+                            'result_mode',
+                            'max_issues',
+                            'uploaded_sheet_name',
+                            'original_sheet_name')
+# Options which only change the result when it's cut short at max_issues, as engines and partitioned runs don't all find issues in the same order
+TRUNCATED_RESULT_AFFECTING_OPTIONS = ('comparison_engine',
+                                      'num_partitions')
+
+def result_cache_key(result_cache, uploaded_file_path: str, original_file_path: str, comparison_options: dict) -> str:
+    """ Key of a comparison in the result cache, options which are left out are treated as their default values. """
+    defaults = inspect.signature(find_discrepancies).parameters
+    options = {option: comparison_options.get(option, defaults[option].default) for option in RESULT_AFFECTING_OPTIONS}
+    if RESULT_MODE(options['result_mode']) in (RESULT_MODE.STOP_AFTER, RESULT_MODE.FIRST_MISMATCH):
+        options.update({option: comparison_options.get(option, defaults[option].default) for option in TRUNCATED_RESULT_AFFECTING_OPTIONS})
+    # Options may be given as an Enum or its value, either way they should share a key
+    options = {option: value.value if isinstance(value, Enum) else value for option, value in options.items()}
+    return result_cache.key_for(uploaded_file_path, original_file_path, options)
+
+def find_discrepancies_cached(result_cache, uploaded_file_path: str, original_file_path: str, **comparison_options) -> ISSUES_MAIN:
+    """
+    Runs find_discrepancies, reusing the cached result instead if neither file nor any of the options have changed since it was cached.
+
+    Args:
+        result_cache: A cache_logic.ResultCache, or None to always compare.
+    """
+    if result_cache == None:
+        return find_discrepancies(uploaded_file_path=uploaded_file_path, original_file_path=original_file_path, **comparison_options)
+    cache_key = result_cache_key(result_cache, uploaded_file_path, original_file_path, comparison_options)
+    issues = result_cache.get(cache_key)
+    if issues == None:
+        issues = find_discrepancies(uploaded_file_path=uploaded_file_path, original_file_path=original_file_path, **comparison_options)
+        result_cache.put(cache_key, issues)
+    return issues
+
 def compare_csv_folders(uploaded_folder_path: str, 
                        original_folder_path: str, 
                        progress_to_show_in_gui = None,
                        status_to_show_in_gui = None,
                        uploaded_file_identifying_field_index: int = 0,
                        original_file_identifying_field_index: int = 0,
-                       ignore_leading_and_trailing_whitespaces: bool = False) -> list[ISSUES_MAIN]:
-    
+                       ignore_leading_and_trailing_whitespaces: bool = False,
+                       use_processes: bool = False,
+                       max_workers: int = None,
+                       comparison_engine: COMPARISON_ENGINE = COMPARISON_ENGINE.HASH,
+                       memory_budget_mb: int = 256,
+                       result_cache = None,
+                       normalisation_rules: dict = None,
+                       full_outer_diff: bool = True,
+                       result_mode: RESULT_MODE = RESULT_MODE.FULL,
+                       max_issues: int = None,
+                       pairing_pattern: str = None,
+                       reader_backend: READER_BACKEND = READER_BACKEND.AUTO,
+                       snapshot_cache = None,
+                       instrumentation: Instrumentation = None) -> list[ISSUES_MAIN]:
+    """
+    Compares every sheet in the uploaded folder against the original sheet sharing its prefix (text before the first '-').
+    Every pair is found before comparing any, and the largest pairs are compared first, see pairing_logic.
+
+    Args:
+        pairing_pattern: Regex taking the key which pairs the sheets out of each file name instead of the prefix, see plan_file_pairs.
+        use_processes: Compare each file pair in a separate worker process instead of a thread. Comparing is pure Python, so threads are bound by the GIL and only processes will use every core.
+        max_workers: Number of worker threads or processes to use, defaults to the number of cores.
+        result_cache: A cache_logic.ResultCache, file pairs which are unchanged since their result was cached are not compared again.
+        snapshot_cache: A cache_logic.SnapshotCache, original Excel sheets shared by several uploaded sheets are only parsed once.
+        instrumentation: Records the phases of comparing every file pair, see instrumentation_logic.
+
+    Returns:
+        A list of ISSUES_MAIN, one per uploaded file, in the order they finished.
+    """
     if status_to_show_in_gui: 
         status_to_show_in_gui('Processing files.')
     
-    # Find all valid sheets
-    uploaded_file_names = [item for item in os.listdir(uploaded_folder_path) if item.endswith('.csv') or item.endswith('.xlsx')]   
-    original_file_names = [item for item in os.listdir(original_folder_path) if item.endswith('.csv') or item.endswith('.xlsx')]
-    # Hash the identifier to the original sheet file path
-    original_file_paths_hash = {} 
-    for item in original_file_names:
-        original_file_paths_hash[item.split('-')[0]] =  f'{original_folder_path}/{item}'
+    # Pair every sheet up front, largest first so the biggest pairs don't hold up the end of the run
+    file_pairs = plan_file_pairs(uploaded_folder_path, original_folder_path, pairing_pattern)
+
+    p = Progress(len(file_pairs), progress_to_show_in_gui)
+    num_workers = min(len(file_pairs), max_workers or os.cpu_count()) # Use maximum available cores unless told otherwise
+
+    if use_processes:
+        issues_list = _compare_file_pairs_in_processes(file_pairs, 
+                                                       p, 
+                                                       num_workers,
+                                                       result_cache,
+                                                       uploaded_file_identifying_field_index=uploaded_file_identifying_field_index,
+                                                       original_file_identifying_field_index=original_file_identifying_field_index,
+                                                       ignore_leading_and_trailing_whitespaces=ignore_leading_and_trailing_whitespaces,
+                                                       comparison_engine=COMPARISON_ENGINE(comparison_engine),
+                                                       memory_budget_mb=memory_budget_mb,
+                                                       normalisation_rules=normalisation_rules,
+                                                       full_outer_diff=full_outer_diff,
+                                                       result_mode=result_mode,
+                                                       max_issues=max_issues,
+                                                       reader_backend=reader_backend,
+                                                       snapshot_cache=snapshot_cache,
+                                                       instrumentation=instrumentation)
+        if status_to_show_in_gui: 
+            status_to_show_in_gui('Finished processing files.')
+        return issues_list
 
     q = Queue()
-    p = Progress(len(uploaded_file_names), progress_to_show_in_gui)
     issue_list_append_lock = threading.Lock()
     issues_list: list[ISSUES_MAIN] = []
     def add_to_issues_list(issues: ISSUES_MAIN):
@@ -415,23 +970,28 @@ def compare_csv_folders(uploaded_folder_path: str,
             issues_list.append(issues)
         return
     
-    for uploaded_file_name in uploaded_file_names:
-        q.put(uploaded_file_name)
+    for file_pair in file_pairs:
+        q.put(file_pair)
     
     def worker(task_queue: Queue, p:Progress):  
         while True:
             try: 
-                uploaded_file_name = task_queue.get(False) 
-                uploaded_file_path = f'{uploaded_folder_path}/{uploaded_file_name}'
-                try:
-                    original_file_path = f'{original_file_paths_hash[uploaded_file_name.split("-")[0]]}'
-                except KeyError: 
-                    raise KeyError(f'STOP: "{uploaded_file_name}", cannot find any original file that starts with "{ori_file_name.split("-")[0]}".')
-                result = find_discrepancies(uploaded_file_path=uploaded_file_path,
-                            original_file_path=original_file_path,
+                file_pair = task_queue.get(False) 
+                result = find_discrepancies_cached(result_cache,
+                            uploaded_file_path=file_pair.uploaded_file_path,
+                            original_file_path=file_pair.original_file_path,
                             uploaded_file_identifying_field_index=uploaded_file_identifying_field_index,
                             original_file_identifying_field_index=original_file_identifying_field_index,
-                            ignore_leading_and_trailing_whitespaces=ignore_leading_and_trailing_whitespaces)
+                            ignore_leading_and_trailing_whitespaces=ignore_leading_and_trailing_whitespaces,
+                            comparison_engine=comparison_engine,
+                            memory_budget_mb=memory_budget_mb,
+                            normalisation_rules=normalisation_rules,
+                            full_outer_diff=full_outer_diff,
+                            result_mode=result_mode,
+                            max_issues=max_issues,
+                            reader_backend=reader_backend,
+                            snapshot_cache=snapshot_cache,
+                            instrumentation=instrumentation)
                 add_to_issues_list(result)
                 p.update_progress() 
                 task_queue.task_done()
@@ -439,8 +999,7 @@ def compare_csv_folders(uploaded_folder_path: str,
                 break
     
     # Create and start threads
-    num_threads = min(len(uploaded_file_names), os.cpu_count())  # Use maximum available cores
-    threads = [threading.Thread(target=worker, args=(q,p)) for _ in range(num_threads)]
+    threads = [threading.Thread(target=worker, args=(q,p)) for _ in range(num_workers)]
     for thread in threads:
         thread.start()
 
@@ -453,56 +1012,147 @@ def compare_csv_folders(uploaded_folder_path: str,
 
     return issues_list
 
+def _compare_file_pairs_in_processes(file_pairs: list[FilePair],
+                                     p: Progress,
+                                     num_workers: int,
+                                     result_cache,
+                                     **comparison_options) -> list[ISSUES_MAIN]:
+    """
+    Sends each uploaded/original file pair to a pool of worker processes running find_discrepancies, in the order they're given.
+    GUI callbacks cannot be sent to another process, so progress is reported here as each pair completes.
+    Pairs with a cached result are never sent to the pool, new results are cached here as they arrive.
+    The phases measured in each worker are added to the instrumentation here too.
+    """
+    instrumentation = comparison_options.pop("instrumentation", None)
+    issues_list: list[ISSUES_MAIN] = []
+    cache_keys = {}
+    if result_cache != None:
+        uncached_file_pairs = []
+        for file_pair in file_pairs:
+            cache_keys[file_pair.uploaded_file_name] = result_cache_key(result_cache, file_pair.uploaded_file_path, file_pair.original_file_path, comparison_options)
+            cached_issues = result_cache.get(cache_keys[file_pair.uploaded_file_name])
+            if cached_issues == None:
+                uncached_file_pairs.append(file_pair)
+                continue
+            issues_list.append(cached_issues)
+            p.update_progress()
+        file_pairs = uncached_file_pairs
+    if len(file_pairs) == 0:
+        return issues_list
+
+    # Only imported when processes are used, starting up is much faster without it
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    with ProcessPoolExecutor(max_workers=min(num_workers, len(file_pairs))) as executor:
+        futures = {executor.submit(find_discrepancies_instrumented, 
+                                   instrumentation != None,
+                                   uploaded_file_path=file_pair.uploaded_file_path, 
+                                   original_file_path=file_pair.original_file_path, 
+                                   **comparison_options): file_pair.uploaded_file_name 
+                   for file_pair in file_pairs}
+        for future in as_completed(futures):
+            try:
+                issues, phase_records = future.result()
+            except Exception as e:
+                # Don't start any more comparisons, the run has failed 
+                for pending_future in futures:
+                    pending_future.cancel()
+                raise RuntimeError(f'STOP: "{futures[future]}" could not be compared. {type(e).__name__}: {e}') from e
+            for phase_record in phase_records:
+                instrumentation.add(phase_record)
+            if result_cache != None:
+                result_cache.put(cache_keys[futures[future]], issues)
+            issues_list.append(issues)
+            p.update_progress()
+
+    return issues_list
+
+def find_discrepancies_instrumented(instrument: bool, **comparison_options) -> tuple:
+    """
+    Runs find_discrepancies in a worker process, where the caller's Instrumentation and its hooks can't be reached.
+
+    Returns:
+        The ISSUES_MAIN and the PhaseRecords measured, to be added to the caller's Instrumentation.
+    """
+    instrumentation = Instrumentation() if instrument else None
+    issues = find_discrepancies(instrumentation=instrumentation, **comparison_options)
+    return issues, instrumentation.records if instrument else []
+
 def compare_csv_folders_single_threaded(uploaded_folder_path: str, 
                        original_folder_path: str, 
                        progress_to_show_in_gui = None,
                        status_to_show_in_gui = None,
                        uploaded_file_identifying_field_index: int = 0,
                        original_file_identifying_field_index: int = 0,
-                       ignore_leading_and_trailing_whitespaces: bool = False) -> list[ISSUES_MAIN]:
+                       ignore_leading_and_trailing_whitespaces: bool = False,
+                       comparison_engine: COMPARISON_ENGINE = COMPARISON_ENGINE.HASH,
+                       memory_budget_mb: int = 256,
+                       result_cache = None,
+                       normalisation_rules: dict = None,
+                       full_outer_diff: bool = True,
+                       result_mode: RESULT_MODE = RESULT_MODE.FULL,
+                       max_issues: int = None,
+                       pairing_pattern: str = None,
+                       reader_backend: READER_BACKEND = READER_BACKEND.AUTO,
+                       snapshot_cache = None,
+                       instrumentation: Instrumentation = None) -> list[ISSUES_MAIN]:
     
-    uploaded_file_names = [item for item in os.listdir(uploaded_folder_path) if item.endswith('.csv') or item.endswith('.xlsx')]   
-    original_file_names = [item for item in os.listdir(original_folder_path) if item.endswith('.csv') or item.endswith('.xlsx')]
-    original_file_paths_hash = {} 
-    
-    for item in original_file_names:
-        original_file_paths_hash[item.split('-')[0]] =  f'{original_folder_path}/{item}'
+    # Every pair is found before comparing any, so a sheet without an original is reported straight away
+    file_pairs = plan_file_pairs(uploaded_folder_path, original_folder_path, pairing_pattern)
 
     issues_list: list[ISSUES_MAIN] = []
     
-    for i, uploaded_file_name in enumerate(uploaded_file_names):
-        uploaded_file_path = f'{uploaded_folder_path}/{uploaded_file_name}'
-        try:
-            original_file_path = f'{original_file_paths_hash[uploaded_file_name.split("-")[0]]}'
-        except KeyError: 
-            raise KeyError(f'STOP: "{uploaded_file_name}", cannot find any original file that starts with "{ori_file_name.split("-")[0]}".')
-
-        issues_list.append(find_discrepancies(uploaded_file_path=uploaded_file_path,
-                           original_file_path=original_file_path,
+    for file_pair in file_pairs:
+        issues_list.append(find_discrepancies_cached(result_cache,
+                           uploaded_file_path=file_pair.uploaded_file_path,
+                           original_file_path=file_pair.original_file_path,
                            status_to_show_in_gui=status_to_show_in_gui,
                            progress_to_show_in_gui=progress_to_show_in_gui,
                            uploaded_file_identifying_field_index=uploaded_file_identifying_field_index,
                            original_file_identifying_field_index=original_file_identifying_field_index,
-                           ignore_leading_and_trailing_whitespaces=ignore_leading_and_trailing_whitespaces))
-        status_to_show_in_gui(f'Completed processing of {uploaded_file_name}')
+                           ignore_leading_and_trailing_whitespaces=ignore_leading_and_trailing_whitespaces,
+                           comparison_engine=comparison_engine,
+                           memory_budget_mb=memory_budget_mb,
+                           normalisation_rules=normalisation_rules,
+                           full_outer_diff=full_outer_diff,
+                           result_mode=result_mode,
+                           max_issues=max_issues,
+                           reader_backend=reader_backend,
+                           snapshot_cache=snapshot_cache,
+                           instrumentation=instrumentation))
+        if status_to_show_in_gui:
+            status_to_show_in_gui(f'Completed processing of {file_pair.uploaded_file_name}')
 
     return issues_list
 
 if __name__ == "__main__": 
+    # Kept as it always was for older scripts, it exits 0 unless the run fails. The headless CLI (sheet_comparator_cli.py) has exit codes for found issues and the result cache
+    # Run as a script this file is __main__, the other engines import sheet_comparator_logic so its Enums have to be the ones used here
+    from sheet_comparator_logic import COMPARISON_ENGINE, find_discrepancies, write_issues, compare_csv_folders, write_multiple_issues
+
     def demo():
+        # Clear the cache of folder comparison results and exit
+        if sys.argv[1] == '--clear-cache':
+            from cache_logic import ResultCache
+            ResultCache().clear()
+            print('Cleared the result cache.')
+            return
+
         try: 
             uploaded_file_identifying_field_index = int(sys.argv[3])
             original_file_identifying_field_index = int(sys.argv[4])
         except:
             uploaded_file_identifying_field_index = 0
             original_file_identifying_field_index = 0
+        # Optional fifth argument picks the engine, e.g. 'external_sort' for sheets larger than memory
+        comparison_engine = COMPARISON_ENGINE(sys.argv[5]) if len(sys.argv) > 5 else COMPARISON_ENGINE.HASH
 
         # Give error and quit script if files cannot be found
         if (os.path.isfile(ori_file_name) and os.path.isfile(uploaded_file_name)):
             issues = find_discrepancies(uploaded_file_name,
                                         ori_file_name, 
                                         uploaded_file_identifying_field_index=uploaded_file_identifying_field_index,
-                                        original_file_identifying_field_index=original_file_identifying_field_index)
+                                        original_file_identifying_field_index=original_file_identifying_field_index,
+                                        comparison_engine=comparison_engine)
             write_issues(issues, 'test_data')
             return
 
@@ -510,7 +1160,8 @@ if __name__ == "__main__":
             res = compare_csv_folders(uploaded_folder_path=uploaded_file_name,
                                             original_folder_path=ori_file_name,
                                             uploaded_file_identifying_field_index=uploaded_file_identifying_field_index,
-                                            original_file_identifying_field_index=original_file_identifying_field_index)
+                                            original_file_identifying_field_index=original_file_identifying_field_index,
+                                            comparison_engine=comparison_engine)
             write_multiple_issues(issue_main_list=res, output_dir='test_data')
             return
 
@@ -519,5 +1170,5 @@ if __name__ == "__main__":
     # Run without GUI or use in notebook 
     name_of_script = sys.argv[0]
     ori_file_name = sys.argv[1]
-    uploaded_file_name = sys.argv[2]
+    uploaded_file_name = sys.argv[2] if len(sys.argv) > 2 else ""
     demo()
@@ -0,0 +1,42 @@
+"""
+Checks that a negative identifier column index still means counting back from the last column, in every engine.
+Run from the repo's folder with: python -m pytest tests
+"""
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sheet_comparator_logic import ISSUE_TYPE, find_discrepancies
+
+ENGINES = [("hash", 1), ("external_sort", 1), ("columnar", 1), ("hash", 2)]
+
+@pytest.fixture
+def sheets_keyed_by_last_column(tmp_path) -> tuple:
+    original_file_path = tmp_path / 'original.csv'
+    uploaded_file_path = tmp_path / 'uploaded.csv'
+    original_file_path.write_text('A,B,ID\na1,b1,k1\na2,b2,k2\n')
+    # k2 is missing and k3 is extra
+    uploaded_file_path.write_text('A,B,ID\na1,b1,k1\na3,b3,k3\n')
+    return str(uploaded_file_path), str(original_file_path)
+
+@pytest.mark.parametrize("comparison_engine, num_partitions", ENGINES)
+def test_last_column_identifier(sheets_keyed_by_last_column, comparison_engine, num_partitions):
+    uploaded_file_path, original_file_path = sheets_keyed_by_last_column
+    issues = find_discrepancies(uploaded_file_path,
+                                original_file_path,
+                                uploaded_file_identifying_field_index=-1,
+                                original_file_identifying_field_index=-1,
+                                comparison_engine=comparison_engine,
+                                num_partitions=num_partitions)
+    issue_types = sorted(issue.issue_type.name for issue in issues.issue_list)
+    assert issue_types == [ISSUE_TYPE.EXTRA_ROW.name, ISSUE_TYPE.MISSING_ROW.name]
+    for issue in issues.issue_list:
+        # The identifier's column is reported as the last column rather than -1
+        assert list(issue.mismatched_columns_indexes) == [2]
+    assert issues.original_identifying_field_index == 2
+
+def test_identifier_outside_sheet(sheets_keyed_by_last_column):
+    uploaded_file_path, original_file_path = sheets_keyed_by_last_column
+    with pytest.raises(ValueError, match='STOP'):
+        find_discrepancies(uploaded_file_path, original_file_path, uploaded_file_identifying_field_index=3)
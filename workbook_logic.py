@@ -0,0 +1,230 @@
+"""
+Compares every sheet of an uploaded workbook against the sheets of an original workbook.
+
+Sheets are paired by name, or by a sheet_mapping of original sheet names to uploaded sheet names for tabs which were renamed.
+Like pairing_logic, every pair is checked before any work starts so a missing tab is reported straight away, and the largest
+pairs are compared first. Parsing a sheet out of a workbook is most of the work of comparing it, so each sheet pair is compared
+in its own worker process and the sheets are parsed on every core at once. Each sheet pair gets its own ISSUES_MAIN, and their
+issue logs are written as they're found into one report folder along with a summary of every sheet.
+"""
+import os
+import time
+import zipfile
+import posixpath
+from xml.etree import ElementTree
+from instrumentation_logic import Instrumentation
+from issue_writer_logic import OUTPUT_FORMAT
+from pairing_logic import PairingError
+from sheet_comparator_logic import ISSUES_MAIN, NATURE_OF_ISSUES, Progress, find_and_write_discrepancies
+
+# Name of the summary of every sheet pair in a report folder
+SUMMARY_FILE_NAME = 'summary.txt'
+# Parts of a workbook which list its sheets and where each sheet's XML is
+WORKBOOK_PART = 'xl/workbook.xml'
+WORKBOOK_RELS_PART = 'xl/_rels/workbook.xml.rels'
+SPREADSHEETML_NAMESPACE = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+RELATIONSHIPS_NAMESPACE = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+PACKAGE_RELATIONSHIPS_NAMESPACE = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+
+class SheetPair:
+    __slots__ = ('uploaded_sheet_name', 'original_sheet_name', 'tab_number', 'size_bytes')
+
+    def __init__(self, uploaded_sheet_name: str, original_sheet_name: str, tab_number: int = 0, size_bytes: int = 0) -> None:
+        """
+        Args:
+            tab_number: Position of the original sheet among the original workbook's tabs, sheets are reported in this order.
+            size_bytes: Combined size of both sheets within their workbooks, used to plan the largest pairs first.
+        """
+        self.uploaded_sheet_name = uploaded_sheet_name
+        self.original_sheet_name = original_sheet_name
+        self.tab_number = tab_number
+        self.size_bytes = size_bytes
+
+    def __repr__(self) -> str:
+        return f'SheetPair({self.uploaded_sheet_name!r}, {self.original_sheet_name!r}, {self.tab_number}, {self.size_bytes})'
+
+def sheet_sizes(excel_file_path: str) -> dict:
+    """
+    Size of each sheet of a workbook by name, in the order of its tabs. Taken from the size of each sheet's XML inside the file
+    so no rows are parsed, the dimensions a sheet records can't be relied on as not every program writes them.
+    The sheets are listed in xl/workbook.xml and its relationships say which part of the file holds each one.
+    """
+    with zipfile.ZipFile(excel_file_path) as archive:
+        # Relationship id: path of the part within the file, targets are relative to xl/ unless they start with /
+        sheet_paths = {}
+        for relationship in ElementTree.fromstring(archive.read(WORKBOOK_RELS_PART)).iter(f'{PACKAGE_RELATIONSHIPS_NAMESPACE}Relationship'):
+            # Chartsheets have no rows, openpyxl leaves them out of a workbook's worksheets too
+            if relationship.get('Type', '').endswith('/worksheet'):
+                target = relationship.get('Target', '')
+                sheet_paths[relationship.get('Id')] = target.lstrip('/') if target.startswith('/') else posixpath.normpath(posixpath.join(posixpath.dirname(WORKBOOK_PART), target))
+        sizes = {}
+        for sheet in ElementTree.fromstring(archive.read(WORKBOOK_PART)).iter(f'{SPREADSHEETML_NAMESPACE}sheet'):
+            sheet_path = sheet_paths.get(sheet.get(f'{RELATIONSHIPS_NAMESPACE}id'))
+            if sheet_path != None:
+                sizes[sheet.get('name')] = archive.getinfo(sheet_path).file_size
+        return sizes
+
+def plan_sheet_pairs(uploaded_workbook_path: str, original_workbook_path: str, sheet_mapping: dict = None) -> list[SheetPair]:
+    """
+    Pairs every sheet of the original workbook with the uploaded sheet of the same name, or the one it's mapped to.
+
+    Args:
+        sheet_mapping: Uploaded sheet name for original sheets whose uploaded sheet has a different name.
+
+    Returns:
+        The SheetPairs, largest first. Raises a PairingError listing every original sheet without an uploaded sheet, every uploaded sheet
+        without an original sheet and every name in the sheet_mapping which isn't in its workbook.
+    """
+    sheet_mapping = sheet_mapping or {}
+    original_sizes = sheet_sizes(original_workbook_path)
+    uploaded_sizes = sheet_sizes(uploaded_workbook_path)
+    problems = []
+
+    for original_sheet_name, uploaded_sheet_name in sheet_mapping.items():
+        if original_sheet_name not in original_sizes:
+            problems.append(f'"{original_sheet_name}" is mapped but is not a sheet of the original workbook.')
+        if uploaded_sheet_name not in uploaded_sizes:
+            problems.append(f'"{uploaded_sheet_name}" is mapped but is not a sheet of the uploaded workbook.')
+
+    sheet_pairs = []
+    paired_uploaded_sheet_names = set()
+    for tab_number, original_sheet_name in enumerate(original_sizes):
+        uploaded_sheet_name = sheet_mapping.get(original_sheet_name, original_sheet_name)
+        if uploaded_sheet_name not in uploaded_sizes:
+            if original_sheet_name not in sheet_mapping:
+                problems.append(f'"{original_sheet_name}", cannot find the sheet in the uploaded workbook.')
+            continue
+        if uploaded_sheet_name in paired_uploaded_sheet_names:
+            problems.append(f'"{uploaded_sheet_name}" is the uploaded sheet of more than one original sheet.')
+            continue
+        paired_uploaded_sheet_names.add(uploaded_sheet_name)
+        sheet_pairs.append(SheetPair(uploaded_sheet_name, original_sheet_name, tab_number, uploaded_sizes[uploaded_sheet_name] + original_sizes[original_sheet_name]))
+
+    for uploaded_sheet_name in uploaded_sizes:
+        if uploaded_sheet_name not in paired_uploaded_sheet_names and uploaded_sheet_name not in sheet_mapping.values():
+            problems.append(f'"{uploaded_sheet_name}", cannot find any original sheet for it.')
+
+    if len(problems):
+        raise PairingError(f'STOP: {len(problems)} sheet(s) could not be paired. ' + ' '.join(problems))
+
+    # Largest first, sorted is stable so pairs of the same size stay in the order of the original workbook's tabs
+    sheet_pairs.sort(key=lambda sheet_pair: sheet_pair.size_bytes, reverse=True)
+    return sheet_pairs
+
+def _compare_and_write_sheet_pair(instrument: bool, output_dir: str, output_to_excel: bool, output_format: OUTPUT_FORMAT, **comparison_options) -> tuple:
+    """
+    Compares a sheet pair while writing its issue log, runs in a worker process.
+
+    Returns:
+        The ISSUES_MAIN, the path of its issue log or None if it had no issues, and the PhaseRecords measured.
+    """
+    instrumentation = Instrumentation() if instrument else None
+    issues, log_file_path = find_and_write_discrepancies(output_dir=output_dir, use_excel=output_to_excel, output_format=output_format, instrumentation=instrumentation, **comparison_options)
+    return issues, log_file_path, instrumentation.records if instrument else []
+
+def write_summary(report_dir: str, uploaded_workbook_path: str, original_workbook_path: str, sheet_pairs: list[SheetPair], issues_list: list[ISSUES_MAIN]) -> str:
+    """ Writes a line for each sheet pair with its issue counts, returning the summary's path. """
+    summary_path = os.path.join(report_dir, SUMMARY_FILE_NAME)
+    with open(summary_path, 'w', encoding='utf-8') as f:
+        f.write(f'Compared {len(sheet_pairs)} sheet(s) of {uploaded_workbook_path} against {original_workbook_path}\n\n')
+        for sheet_pair, issues in zip(sheet_pairs, issues_list):
+            sheet_names = sheet_pair.original_sheet_name
+            if sheet_pair.uploaded_sheet_name != sheet_pair.original_sheet_name:
+                sheet_names += f' (uploaded as {sheet_pair.uploaded_sheet_name})'
+            nature_of_issues = ' '.join(nature.value for nature in issues.nature_of_issues) or NATURE_OF_ISSUES.OK.value
+            issue_counts = ', '.join(f'{issue_type.name}: {count}' for issue_type, count in issues.issue_counts.items() if count)
+            f.write(f'{sheet_names}: {nature_of_issues}' + (f' ({issue_counts})' if issue_counts else '') + '\n')
+    return summary_path
+
+def compare_and_write_workbooks(uploaded_workbook_path: str,
+                                original_workbook_path: str,
+                                output_dir: str = "",
+                                sheet_mapping: dict = None,
+                                progress_to_show_in_gui = None,
+                                status_to_show_in_gui = None,
+                                output_to_excel: bool = False,
+                                output_format: OUTPUT_FORMAT = None,
+                                max_workers: int = None,
+                                instrumentation: Instrumentation = None,
+                                **comparison_options) -> tuple:
+    """
+    Compares every sheet pair of two workbooks, see the top of this file.
+    The issue log of each sheet pair is written into a new report folder in output_dir as its issues are found.
+
+    Args:
+        sheet_mapping: Uploaded sheet name for original sheets whose uploaded sheet has a different name, see plan_sheet_pairs.
+        max_workers: Number of sheet pairs to compare at once, defaults to the number of cores.
+        comparison_options: Options of find_discrepancies for every sheet pair, e.g. comparison_engine.
+
+    Returns:
+        A list of ISSUES_MAIN, one per sheet pair in the order of the original workbook's tabs, and the report folder
+        or None if no sheet pair had issues. Each ISSUES_MAIN counts its issues but doesn't hold them, they're in the issue logs.
+    """
+    if status_to_show_in_gui:
+        status_to_show_in_gui('Pairing sheets.')
+
+    # Pair every sheet up front, largest first so the biggest pairs don't hold up the end of the run
+    sheet_pairs = plan_sheet_pairs(uploaded_workbook_path, original_workbook_path, sheet_mapping)
+
+    workbook_name = os.path.basename(original_workbook_path).split('.')[0]
+    report_dir = f'{output_dir}/issues_{workbook_name}_{time.strftime("%Y_%m_%d_%H_%M_%S", time.gmtime())}'
+    os.makedirs(report_dir, exist_ok=True)
+
+    if status_to_show_in_gui:
+        status_to_show_in_gui(f'Comparing {len(sheet_pairs)} sheet(s) of {workbook_name}.')
+    p = Progress(len(sheet_pairs), progress_to_show_in_gui)
+    num_workers = max(1, min(len(sheet_pairs), max_workers or os.cpu_count()))
+
+    def sheet_pair_options(sheet_pair: SheetPair) -> dict:
+        return {"uploaded_file_path": uploaded_workbook_path,
+                "original_file_path": original_workbook_path,
+                "uploaded_sheet_name": sheet_pair.uploaded_sheet_name,
+                "original_sheet_name": sheet_pair.original_sheet_name,
+                **comparison_options}
+
+    results = {}
+    if num_workers == 1:
+        # Nothing to run alongside, so it isn't worth starting a worker process
+        for sheet_pair in sheet_pairs:
+            issues, log_file_path = find_and_write_discrepancies(output_dir=report_dir, use_excel=output_to_excel, output_format=output_format, instrumentation=instrumentation, **sheet_pair_options(sheet_pair))
+            results[sheet_pair.original_sheet_name] = (issues, log_file_path)
+            p.update_progress()
+    else:
+        # Only imported when processes are used, starting up is much faster without it
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = {executor.submit(_compare_and_write_sheet_pair,
+                                       instrumentation != None,
+                                       report_dir,
+                                       output_to_excel,
+                                       output_format,
+                                       **sheet_pair_options(sheet_pair)): sheet_pair
+                       for sheet_pair in sheet_pairs}
+            for future in as_completed(futures):
+                sheet_pair = futures[future]
+                try:
+                    issues, log_file_path, phase_records = future.result()
+                except Exception as e:
+                    # Don't start any more comparisons, the run has failed
+                    for pending_future in futures:
+                        pending_future.cancel()
+                    raise RuntimeError(f'STOP: sheet "{sheet_pair.original_sheet_name}" could not be compared. {type(e).__name__}: {e}') from e
+                for phase_record in phase_records:
+                    instrumentation.add(phase_record)
+                results[sheet_pair.original_sheet_name] = (issues, log_file_path)
+                p.update_progress()
+
+    # Report the sheets in the order of the original workbook's tabs rather than the order they finished
+    sheet_pairs.sort(key=lambda sheet_pair: sheet_pair.tab_number)
+    issues_list = [results[sheet_pair.original_sheet_name][0] for sheet_pair in sheet_pairs]
+
+    if not any(log_file_path != None for _, log_file_path in results.values()):
+        os.rmdir(report_dir)
+        if status_to_show_in_gui != None:
+            status_to_show_in_gui(f'Done! No issues found ᕙ(⇀‸↼‶)ᕗ')
+        return issues_list, None
+
+    write_summary(report_dir, uploaded_workbook_path, original_workbook_path, sheet_pairs, issues_list)
+    if status_to_show_in_gui != None:
+        status_to_show_in_gui(f'Done! Check {report_dir}.')
+    return issues_list, report_dir